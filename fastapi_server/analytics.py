@@ -0,0 +1,287 @@
+"""
+Vectorized analytics over the transactions of one book.
+
+The columns of a book are read straight into NumPy arrays, no Transaction or
+TransactionRow is built, and every series is computed on whole arrays.
+numpy is an optional dependency, only these endpoints need it:
+
+    pip install numpy
+"""
+
+import sqlite3
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - depends on the install
+    np = None
+
+from config import ROLLING_AVERAGE_MAX_DAYS
+from cus_exceptions import AnalyticsUnavailableError, RequireInfoLostException
+from db_api import (
+    CATEGORY_BY_CODE,
+    MINOR_UNITS,
+    AccountBook,
+    IncomeType,
+    datetime_to_epoch,
+)
+
+SECONDS_PER_DAY = 86400
+# grouping key of uncategorized outcome rows, uncategorized income keeps code 0
+_UNCATEGORIZED_OUTCOME = -(10**6)
+
+
+class BookColumns(NamedTuple):
+    """The transactions of a book in time order, one int64 array per column."""
+
+    time_epoch: "np.ndarray"
+    amount_minor: "np.ndarray"
+    category_code: "np.ndarray"  # 0 for uncategorized rows
+    opening_minor: int  # balance of the book before the first row
+
+
+class RollingSeries(NamedTuple):
+    days: List[str]  # every day of the range, YYYY-MM-DD
+    income: "np.ndarray"  # per day totals
+    outcome: "np.ndarray"
+    net: "np.ndarray"
+    rolling_income: "np.ndarray"  # trailing mean over the window
+    rolling_outcome: "np.ndarray"
+    rolling_net: "np.ndarray"
+
+
+class CategoryPercentiles(NamedTuple):
+    category: Optional[str]  # IncomeType / OutcomeType name, None if uncategorized
+    income: bool
+    count: int
+    values: "np.ndarray"  # of the absolute amounts, one per requested percentile
+
+
+class BalanceCurve(NamedTuple):
+    days: List[str]  # days with at least one transaction
+    balance: "np.ndarray"  # balance at the end of each day
+
+
+def _require_numpy() -> None:
+    if np is None:
+        raise AnalyticsUnavailableError(
+            "analytics needs numpy, install it with 'pip install numpy'"
+        )
+
+
+def load_columns(
+    conn: sqlite3.Connection,
+    token: str,
+    account_book_id: int,
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+) -> BookColumns:
+    """
+    Read (time_epoch, amount_minor, category_code) of the book's transactions
+    in the range, ordered by time, into NumPy arrays.
+    Token is verified and book ownership checked.
+    """
+    _require_numpy()
+    AccountBook.check_access(conn, token, account_book_id)
+    where = " WHERE account_book_id = ?"
+    params: List = [account_book_id]
+    opening = 0
+    if start_time is not None:
+        start = datetime_to_epoch(start_time)
+        opening = conn.execute(
+            "SELECT COALESCE(SUM(amount_minor), 0) FROM transactions"
+            + where
+            + " AND time_epoch < ?",
+            (account_book_id, start),
+        ).fetchone()[0]
+        where += " AND time_epoch >= ?"
+        params.append(start)
+    if end_time is not None:
+        where += " AND time_epoch <= ?"
+        params.append(datetime_to_epoch(end_time))
+    cur = conn.execute(
+        "SELECT time_epoch, amount_minor, COALESCE(category_code, 0) "
+        "FROM transactions" + where + " ORDER BY time_epoch",
+        params,
+    )
+    # the flat values of every row, reshaped into columns
+    flat = np.fromiter((value for row in cur for value in row), dtype=np.int64).reshape(
+        -1, 3
+    )
+    return BookColumns(
+        time_epoch=flat[:, 0],
+        amount_minor=flat[:, 1],
+        category_code=flat[:, 2],
+        opening_minor=opening,
+    )
+
+
+def _day_strings(days: "np.ndarray") -> List[str]:
+    stamps = (days * SECONDS_PER_DAY).astype("datetime64[s]")
+    return np.datetime_as_string(stamps, unit="D").tolist()
+
+
+def _trailing_mean(values: "np.ndarray", window: int) -> "np.ndarray":
+    # mean of values[i - window + 1 .. i], fewer values at the start
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    idx = np.arange(1, len(values) + 1)
+    lower = np.maximum(idx - window, 0)
+    return (sums[idx] - sums[lower]) / (idx - lower)
+
+
+def rolling_average(
+    columns: BookColumns,
+    window: int = 7,
+    first_day: Optional[int] = None,
+    last_day: Optional[int] = None,
+    max_days: int = ROLLING_AVERAGE_MAX_DAYS,
+) -> RollingSeries:
+    """
+    Daily income / outcome / net totals over every day of the range, days
+    without transactions count as 0, and their trailing ``window`` day mean.
+
+    The range is first_day .. last_day (days since 1970-01-01) when given,
+    so the quiet days at its edges are part of the series and of the window;
+    a missing bound is the day of the first / last transaction. A range of
+    more than ``max_days`` days raises RequireInfoLostException, the series
+    has one entry per day.
+    """
+    _require_numpy()
+    if window < 1:
+        raise ValueError("window must be at least one day")
+    day = columns.time_epoch // SECONDS_PER_DAY
+    if len(day):
+        first = int(day[0]) if first_day is None else first_day
+        last = int(day[-1]) if last_day is None else last_day
+    else:
+        first, last = first_day, last_day
+    if first is None or last is None or last < first:
+        empty = np.zeros(0)
+        return RollingSeries([], *([empty] * 6))
+    n_days = last - first + 1
+    if n_days > max_days:
+        raise RequireInfoLostException(
+            f"rolling average range is {n_days} days, at most {max_days} are allowed"
+        )
+    index = day - first
+    amount = columns.amount_minor / MINOR_UNITS
+    income = np.bincount(
+        index, weights=np.where(amount >= 0, amount, 0.0), minlength=n_days
+    )
+    outcome = np.bincount(
+        index, weights=np.where(amount < 0, amount, 0.0), minlength=n_days
+    )
+    net = income + outcome
+    return RollingSeries(
+        days=_day_strings(np.arange(first, first + n_days)),
+        income=income,
+        outcome=outcome,
+        net=net,
+        rolling_income=_trailing_mean(income, window),
+        rolling_outcome=_trailing_mean(outcome, window),
+        rolling_net=_trailing_mean(net, window),
+    )
+
+
+def category_percentiles(
+    columns: BookColumns, percentiles: Sequence[float] = (50, 90, 99)
+) -> List[CategoryPercentiles]:
+    """
+    Percentiles of the absolute transaction amount per category, categories
+    ordered by code (outcome first).
+    """
+    _require_numpy()
+    if any(not 0 <= p <= 100 for p in percentiles):
+        raise ValueError("percentiles must be between 0 and 100")
+    codes = columns.category_code
+    # uncategorized rows are split by the sign of the amount
+    keys = np.where(
+        (codes == 0) & (columns.amount_minor < 0), _UNCATEGORIZED_OUTCOME, codes
+    )
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    amounts = np.abs(columns.amount_minor[order]) / MINOR_UNITS
+    unique, starts, counts = np.unique(
+        sorted_keys, return_index=True, return_counts=True
+    )
+    result = []
+    for key, start, count in zip(unique.tolist(), starts, counts):
+        category = CATEGORY_BY_CODE.get(key)
+        result.append(
+            CategoryPercentiles(
+                category=None if category is None else category.name,
+                income=(
+                    isinstance(category, IncomeType)
+                    if category is not None
+                    else key == 0
+                ),
+                count=int(count),
+                values=np.percentile(amounts[start : start + count], percentiles),
+            )
+        )
+    return result
+
+
+def balance_curve(columns: BookColumns) -> BalanceCurve:
+    """Running balance of the book at the end of every day with transactions."""
+    _require_numpy()
+    if len(columns.time_epoch) == 0:
+        return BalanceCurve([], np.zeros(0))
+    running = columns.opening_minor + np.cumsum(columns.amount_minor)
+    day = columns.time_epoch // SECONDS_PER_DAY
+    # the last row of each day: where the next row starts another day
+    last = np.flatnonzero(np.append(np.diff(day) != 0, True))
+    return BalanceCurve(
+        days=_day_strings(day[last]),
+        balance=running[last] / MINOR_UNITS,
+    )
+
+
+# ------------------------- db executor entry points ------------------------- #
+# load and compute in one job, so the numpy work runs on the db worker thread
+# and not on the event loop
+
+
+def book_rolling_average(
+    conn: sqlite3.Connection,
+    token: str,
+    account_book_id: int,
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    window: int = 7,
+) -> RollingSeries:
+    columns = load_columns(conn, token, account_book_id, start_time, end_time)
+    return rolling_average(
+        columns,
+        window,
+        first_day=None
+        if start_time is None
+        else datetime_to_epoch(start_time) // SECONDS_PER_DAY,
+        last_day=None
+        if end_time is None
+        else datetime_to_epoch(end_time) // SECONDS_PER_DAY,
+    )
+
+
+def book_category_percentiles(
+    conn: sqlite3.Connection,
+    token: str,
+    account_book_id: int,
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    percentiles: Sequence[float] = (50, 90, 99),
+) -> List[CategoryPercentiles]:
+    columns = load_columns(conn, token, account_book_id, start_time, end_time)
+    return category_percentiles(columns, percentiles)
+
+
+def book_balance_curve(
+    conn: sqlite3.Connection,
+    token: str,
+    account_book_id: int,
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+) -> BalanceCurve:
+    columns = load_columns(conn, token, account_book_id, start_time, end_time)
+    return balance_curve(columns)
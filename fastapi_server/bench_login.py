@@ -0,0 +1,114 @@
+"""
+/login throughput and latency under concurrency, with the KDF in the hasher pool.
+
+The first round logs in accounts that still hold a legacy (client) hash, so
+every login also rehashes; the next rounds verify scrypt hashes. A probe
+requests /metrics/db meanwhile, its latency shows whether the event loop
+stays responsive during the login storm.
+
+    python bench_login.py --users 100 --rounds 3 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from typing import List
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def _run(users: int, rounds: int, concurrency: int) -> None:
+    import httpx
+
+    import fast_router
+    from db_api import Account
+    from passwords import is_legacy
+
+    with fast_router.pool.connection() as conn:
+        for i in range(users):
+            # stored as sent by the client, like rows written before passwords.py
+            Account.register(conn, f"user{i}", f"user{i}@bench.com", f"pwd{i}")
+
+    transport = httpx.ASGITransport(app=fast_router.app)
+    async with (
+        fast_router.lifespan(fast_router.app),
+        httpx.AsyncClient(transport=transport, base_url="http://bench") as client,
+    ):
+        slots = asyncio.Semaphore(concurrency)
+
+        async def login(i: int) -> float:
+            async with slots:
+                begin = time.perf_counter()
+                r = await client.post(
+                    "/CoinVerse/login",
+                    json=dict(
+                        name_or_email=f"user{i}",
+                        pwd_hash=f"pwd{i}",
+                        maintain_online=True,
+                    ),
+                )
+                assert r.json().get("access_token"), r.text
+                return time.perf_counter() - begin
+
+        probe_latency: List[float] = []
+        storm = True
+
+        async def probe() -> None:
+            while storm:
+                begin = time.perf_counter()
+                await client.get("/CoinVerse/metrics/db")
+                probe_latency.append(time.perf_counter() - begin)
+                await asyncio.sleep(0.01)
+
+        # warm up the process pool outside of the measurements
+        await fast_router.hasher.hash("warm up")
+        print(
+            f"{'round':<8} {'logins/s':>10} {'p50 ms':>10} {'p99 ms':>10} "
+            f"{'max ms':>10} {'probe p99':>10}"
+        )
+        for r in range(rounds):
+            probe_latency.clear()
+            storm = True
+            prober = asyncio.create_task(probe())
+            begin = time.perf_counter()
+            latency = await asyncio.gather(*(login(i) for i in range(users)))
+            elapsed = time.perf_counter() - begin
+            storm = False
+            await prober
+            name = "legacy" if r == 0 else f"scrypt{r}"
+            print(
+                f"{name:<8} {users / elapsed:>10.1f} "
+                f"{_percentile(latency, 50) * 1000:>10.1f} "
+                f"{_percentile(latency, 99) * 1000:>10.1f} "
+                f"{max(latency) * 1000:>10.1f} "
+                f"{_percentile(probe_latency, 99) * 1000:>10.1f}"
+            )
+
+        with fast_router.pool.connection() as conn:
+            stored = [row[0] for row in conn.execute("SELECT pwd FROM accounts")]
+        print(f"{sum(map(is_legacy, stored))} legacy hash(es) left of {len(stored)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark /login under load.")
+    parser.add_argument("--users", type=int, default=100, help="logins per round")
+    parser.add_argument("--rounds", type=int, default=3, help="first one rehashes")
+    parser.add_argument("--concurrency", type=int, default=32, help="in flight")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # read by config.py, before fast_router opens the database
+        os.environ["COINVERSE_DB_PATH"] = os.path.join(tmp, "login.db")
+        asyncio.run(_run(args.users, args.rounds, args.concurrency))
+
+
+# the hasher pool spawns processes which import this module again
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Per-row cost of loading transactions: validating constructor vs trusted load vs raw rows.
+
+    python bench_rows.py --rows 100000
+"""
+
+import argparse
+import logging
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+from db_api import (
+    CATEGORY_BY_CODE,
+    MINOR_UNITS,
+    IncomeType,
+    OutcomeType,
+    Transaction,
+    TransactionRow,
+    connect,
+    epoch_to_datetime,
+    init,
+)
+from storage_profile import PROFILES
+
+SQL = (
+    "SELECT id, amount_minor, time_epoch, note, category_code "
+    "FROM transactions ORDER BY time_epoch"
+)
+
+
+def _fill(conn, rows: int) -> None:
+    conn.execute(
+        "INSERT INTO accounts (name, email, pwd, token) VALUES ('b', 'b', 'x', 'x')"
+    )
+    conn.execute("INSERT INTO account_books (name, account_id) VALUES ('b', 1)")
+    start = datetime(2020, 1, 1)
+    Transaction.execute_db_add_many(
+        conn,
+        [
+            Transaction(
+                amount=float(i % 100) if i % 3 else -float(i % 100 + 1),
+                account_book_id=1,
+                category=IncomeType.SALARY if i % 3 else OutcomeType.FOOD,
+                time=start + timedelta(minutes=i),
+                note=f"row {i}",
+            )
+            for i in range(rows)
+        ],
+    )
+
+
+def _validated(rows: List[Tuple]) -> list:
+    # what execute_db_query / get_transaction_list did before the trusted load
+    result = []
+    for tx_id, amount_minor, time_epoch, t_note, t_code in rows:
+        result.append(
+            Transaction(
+                amount=amount_minor / MINOR_UNITS,
+                account_book_id=1,
+                time=epoch_to_datetime(time_epoch),
+                note=t_note,
+                category=None if t_code is None else CATEGORY_BY_CODE[t_code],
+                id=tx_id,
+            )
+        )
+    return result
+
+
+def _trusted(rows: List[Tuple]) -> list:
+    return [Transaction._from_db_row(row, 1) for row in rows]
+
+
+def _raw_rows(rows: List[Tuple]) -> list:
+    return list(map(TransactionRow._make, rows))
+
+
+def _time_it(
+    fn: Callable[[List[Tuple]], list], rows: List[Tuple], repeat: int
+) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fn(rows)
+        best = min(best, time.perf_counter() - begin)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark transaction row loading.")
+    parser.add_argument("--rows", type=int, default=100000, help="rows loaded")
+    parser.add_argument("--repeat", type=int, default=5, help="best of N runs")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = connect(Path(tmp) / "rows.db", PROFILES["fast"])
+        init(conn)
+        _fill(conn, args.rows)
+        rows = conn.execute(SQL).fetchall()
+        fetch = _time_it(lambda _: conn.execute(SQL).fetchall(), rows, args.repeat)
+        conn.close()
+
+    print(f"{'path':<28} {'total ms':>10} {'us / row':>10}")
+    print(
+        f"{'fetchall only':<28} {fetch * 1000:>10.1f} {fetch / args.rows * 1e6:>10.3f}"
+    )
+    for name, fn in (
+        ("Transaction() + validation", _validated),
+        ("trusted _from_db_row", _trusted),
+        ("TransactionRow (no decode)", _raw_rows),
+    ):
+        cost = _time_it(fn, rows, args.repeat)
+        print(f"{name:<28} {cost * 1000:>10.1f} {cost / args.rows * 1e6:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Insert / read throughput of the db_api write and read paths under every storage profile.
+
+    python bench_storage.py --rows 5000 --readers 4
+"""
+
+import argparse
+import logging
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List
+
+from db_api import Account, AccountBook, IncomeType, Transaction, connect, init
+from storage_profile import PROFILES, StorageProfile
+
+
+def _prepare(db_path: Path, profile: StorageProfile) -> str:
+    conn = connect(db_path, profile)
+    init(conn)
+    Account.register(conn, name="bench", email="bench@bench.com", pwd_hash="x")
+    acc = Account.login(conn, "bench", "x")
+    assert acc is not None
+    Account.create_book(conn, acc.token, "bench book")
+    conn.close()
+    return acc.token
+
+
+def _bench_insert(db_path: Path, profile: StorageProfile, rows: int) -> float:
+    conn = connect(db_path, profile)
+    start_time = datetime(2020, 1, 1)
+    begin = time.perf_counter()
+    for i in range(rows):
+        # one INSERT + commit per row, exactly like /book/transactions/add_income
+        Transaction.execute_db_add(
+            conn,
+            Transaction(
+                amount=float(i % 100 + 1),
+                account_book_id=1,
+                category=IncomeType.SALARY,
+                time=start_time + timedelta(minutes=i),
+                note=f"bench {i}",
+            ),
+        )
+    elapsed = time.perf_counter() - begin
+    conn.close()
+    return rows / elapsed
+
+
+def _bench_read(
+    db_path: Path, profile: StorageProfile, token: str, readers: int, seconds: float
+) -> float:
+    done: List[int] = [0] * readers
+    stop_at = time.perf_counter() + seconds
+
+    def reader(idx: int) -> None:
+        conn = connect(db_path, profile)
+        while time.perf_counter() < stop_at:
+            txs = AccountBook.get_transaction_list(
+                conn,
+                token,
+                1,
+                start_time=datetime(2020, 1, 1),
+                end_time=datetime(2020, 1, 2),
+            )
+            done[idx] += len(txs)
+        conn.close()
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(done) / seconds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark sqlite storage profiles.")
+    parser.add_argument("--rows", type=int, default=2000, help="rows inserted")
+    parser.add_argument("--readers", type=int, default=4, help="reader threads")
+    parser.add_argument("--seconds", type=float, default=3.0, help="read duration")
+    parser.add_argument(
+        "--profiles", nargs="*", default=list(PROFILES), choices=list(PROFILES)
+    )
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    results: Dict[str, Dict[str, float]] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.profiles:
+            profile = PROFILES[name]
+            db_path = Path(tmp) / f"{name}.db"
+            token = _prepare(db_path, profile)
+            results[name] = {
+                "insert": _bench_insert(db_path, profile, args.rows),
+                "read": _bench_read(
+                    db_path, profile, token, args.readers, args.seconds
+                ),
+            }
+
+    print(f"{'profile':<10} {'insert rows/s':>14} {'read rows/s':>14}")
+    for name, res in results.items():
+        print(f"{name:<10} {res['insert']:>14.0f} {res['read']:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+add_income throughput under concurrency, one commit per request vs the group
+commit writer (COINVERSE_WRITE_BATCH=1). Each mode runs in a process of its
+own since the writer is chosen when fast_router is imported.
+
+    python bench_writes.py --requests 2000 --concurrency 64 --profile durable
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def _run(requests: int, concurrency: int) -> None:
+    import httpx
+
+    import fast_router
+    from db_api import Account
+
+    with fast_router.pool.connection() as conn:
+        Account.register(conn, "bench", "bench@bench.com", "pwd")
+    transport = httpx.ASGITransport(app=fast_router.app)
+    async with (
+        fast_router.lifespan(fast_router.app),
+        httpx.AsyncClient(transport=transport, base_url="http://bench") as client,
+    ):
+        r = await client.post(
+            "/CoinVerse/login",
+            json=dict(name_or_email="bench", pwd_hash="pwd", maintain_online=True),
+        )
+        token = r.json()["access_token"]
+        r = await client.post(
+            "/CoinVerse/create_book", json=dict(token=token, book_name="bench")
+        )
+        slots = asyncio.Semaphore(concurrency)
+
+        async def add(i: int) -> float:
+            async with slots:
+                begin = time.perf_counter()
+                r = await client.post(
+                    "/CoinVerse/book/transactions/add_income",
+                    json=dict(
+                        token=token,
+                        account_book_id=1,
+                        amount=i % 100 + 1,
+                        time="",
+                        note=f"bench {i}",
+                        income_idx=1,
+                    ),
+                )
+                assert r.json().get("success"), r.text
+                return time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        latency = await asyncio.gather(*(add(i) for i in range(requests)))
+        elapsed = time.perf_counter() - begin
+        metrics = (await client.get("/CoinVerse/metrics/db")).json()
+
+    batches = metrics["write_batcher"].get("batches") or requests
+    mode = "group" if fast_router.batcher is not None else "per-request"
+    print(
+        f"{mode:<12} {requests / elapsed:>10.1f} "
+        f"{_percentile(latency, 50) * 1000:>10.1f} "
+        f"{_percentile(latency, 99) * 1000:>10.1f} "
+        f"{requests / batches:>10.1f}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark add_income commits.")
+    parser.add_argument("--requests", type=int, default=2000, help="inserts")
+    parser.add_argument("--concurrency", type=int, default=64, help="in flight")
+    parser.add_argument("--profile", default="durable", help="storage profile")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    if args.child:
+        asyncio.run(_run(args.requests, args.concurrency))
+        return
+    print(
+        f"{'mode':<12} {'rows/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'rows/commit':>10}"
+    )
+    for batch in ("0", "1"):
+        with tempfile.TemporaryDirectory() as tmp:
+            # read by config.py, before fast_router opens the database
+            env = dict(
+                os.environ,
+                COINVERSE_DB_PATH=os.path.join(tmp, "writes.db"),
+                COINVERSE_STORAGE_PROFILE=args.profile,
+                COINVERSE_WRITE_BATCH=batch,
+            )
+            subprocess.run(
+                [sys.executable, __file__, "--child", *sys.argv[1:]],
+                env=env,
+                check=True,
+            )
+
+
+# the hasher pool spawns processes which import this module again
+if __name__ == "__main__":
+    main()
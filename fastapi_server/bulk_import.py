@@ -0,0 +1,309 @@
+import codecs
+import csv
+import math
+import sqlite3
+from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Union,
+)
+
+from db_api import (
+    MAX_AMOUNT_MINOR,
+    MINOR_UNITS,
+    AccountBook,
+    IncomeType,
+    OutcomeType,
+    Transaction,
+)
+from cus_exceptions import (
+    BulkImportInterruptedError,
+    IncomeValueError,
+    InvalidOutcomeIncomeValueError,
+    OutcomeValueError,
+    RequireInfoLostException,
+    TimeFormatError,
+)
+from utils import str_to_datetime
+
+# errors of a single row, reported back instead of failing the whole import
+ROW_ERRORS = (
+    IncomeValueError,
+    InvalidOutcomeIncomeValueError,
+    OutcomeValueError,
+    RequireInfoLostException,
+    TimeFormatError,
+    ValueError,
+)
+
+CSV_COLUMNS = ("time", "amount", "note", "category")
+
+
+class ImportRecord(NamedTuple):
+    row: int  # 1-based position in the upload, reported with errors
+    amount: Union[float, str]
+    time: str = ""
+    note: str = ""
+    category: Union[int, str, None] = None
+
+
+class ImportResult(NamedTuple):
+    inserted: int
+    failed: int
+    errors: List[tuple]  # (row, message), at most max_errors of them
+
+
+def build_transaction(record: ImportRecord) -> Transaction:
+    """
+    Turn one raw record into a Transaction, applying the same rules as the
+    single row add_income / add_outcome endpoints:
+      - empty time means now
+      - the category is an index (like income_idx / outcome_idx) or an enum
+        name, resolved against IncomeType for amount >= 0, OutcomeType otherwise
+      - Transaction() rejects a category that does not match the amount sign
+    Amounts that can not be stored (nan, inf, beyond int64 minor units) raise
+    ValueError like any unparsable one.
+    """
+    amount = float(record.amount)
+    if not math.isfinite(amount) or abs(amount * MINOR_UNITS) > MAX_AMOUNT_MINOR:
+        raise ValueError(f"amount out of range: {record.amount}")
+    time = str_to_datetime(record.time) if len(record.time) > 1 else datetime.now()
+    return Transaction(
+        amount=amount,
+        account_book_id=0,  # set by AccountBook.import_transactions
+        category=_resolve_category(record.category, amount >= 0),
+        time=time,
+        note=record.note,
+    )
+
+
+@lru_cache(maxsize=256)
+def _resolve_category(
+    raw: Union[int, str, None], income: bool
+) -> Union[IncomeType, OutcomeType]:
+    # an import repeats a handful of categories, resolve each one once
+    if isinstance(raw, str) and raw.strip().lstrip("-").isdigit():
+        raw = int(raw)
+    if raw is None or raw == "":
+        return IncomeType.OTHER if income else OutcomeType.OTHER
+    if isinstance(raw, int):
+        return (
+            IncomeType.index_2_income_type(raw)
+            if income
+            else OutcomeType.index_2_outcome_type(raw)
+        )
+    # names are looked up on the side of the amount only: OTHER exists on both
+    name = raw.strip().upper()
+    members = IncomeType.__members__ if income else OutcomeType.__members__
+    if name in members:
+        return members[name]
+    raise ValueError(f"unknown category '{raw}'")
+
+
+def import_records(
+    conn: sqlite3.Connection,
+    token: str,
+    account_book_id: int,
+    records: Iterable[ImportRecord],
+    chunk_size: int = 5000,
+    max_errors: int = 1000,
+) -> ImportResult:
+    """
+    Validate and insert records in chunks of ``chunk_size`` rows, each chunk is
+    one executemany inside one transaction. Invalid rows are skipped and
+    reported, the valid rows of the upload are still imported. A failure
+    after the first committed chunk raises BulkImportInterruptedError.
+    """
+    # up front: an upload without a single valid row is refused all the same
+    AccountBook.check_access(conn, token, account_book_id)
+    inserted = 0
+    failed = 0
+    errors: List[tuple] = []
+    it = iter(records)
+    try:
+        while True:
+            chunk = list(islice(it, chunk_size))
+            if not chunk:
+                break
+            txs: List[Transaction] = []
+            for record in chunk:
+                try:
+                    txs.append(build_transaction(record))
+                except ROW_ERRORS as e:
+                    failed += 1
+                    if len(errors) < max_errors:
+                        errors.append((record.row, str(e) or type(e).__name__))
+            inserted += AccountBook.import_transactions(
+                conn, token, account_book_id, txs
+            )
+    except Exception as e:
+        if inserted == 0:
+            raise
+        raise _interrupted(inserted, e) from e
+    return ImportResult(inserted, failed, errors)
+
+
+def _interrupted(inserted: int, e: Exception) -> BulkImportInterruptedError:
+    # once rows are committed a failure must say so: the upload is partly
+    # imported and must not be applied again as a whole
+    if isinstance(e, BulkImportInterruptedError):
+        return BulkImportInterruptedError(inserted + e.inserted, e.reason)
+    return BulkImportInterruptedError(inserted, str(e) or type(e).__name__)
+
+
+def parse_csv_header(line: str) -> List[str]:
+    """
+    Column names of the upload, ``amount`` is required, ``time``, ``note`` and
+    ``category`` are optional and unknown columns are ignored.
+    """
+    header = [col.strip().lower() for col in next(csv.reader([line]))]
+    if "amount" not in header:
+        raise RequireInfoLostException("csv header has no 'amount' column")
+    return header
+
+
+def iter_csv_records(
+    lines: Iterable[str], header: List[str], first_row: int
+) -> Iterator[ImportRecord]:
+    """
+    Parse data lines (header excluded) into ImportRecords. ``lines`` must end on
+    a record boundary, see CsvRecordSplitter.
+    """
+    idx = {name: header.index(name) for name in CSV_COLUMNS if name in header}
+    for offset, values in enumerate(csv.reader(lines)):
+        if not values:
+            continue
+
+        def col(name: str) -> str:
+            pos = idx.get(name)
+            return values[pos].strip() if pos is not None and pos < len(values) else ""
+
+        yield ImportRecord(
+            row=first_row + offset,
+            amount=col("amount"),
+            time=col("time"),
+            note=col("note"),
+            category=col("category") or None,
+        )
+
+
+class CsvRecordSplitter:
+    """
+    Cuts a streamed csv upload into lists of complete lines.
+
+    A newline only ends a record when it is outside a quoted field, i.e. when
+    the number of double quotes seen so far is even, so a chunk handed to
+    csv.reader never stops in the middle of a multi-line field.
+    """
+
+    def __init__(self) -> None:
+        self._pending = ""
+        self._record = ""
+        self._quotes = 0
+
+    def feed(self, text: str) -> List[str]:
+        lines = (self._pending + text).split("\n")
+        self._pending = lines.pop()
+        return self._complete(lines)
+
+    def close(self) -> List[str]:
+        lines = [self._pending] if self._pending else []
+        self._pending = ""
+        done = self._complete(lines)
+        if self._record:
+            done.append(self._record)
+            self._record = ""
+        return done
+
+    def _complete(self, lines: List[str]) -> List[str]:
+        done: List[str] = []
+        for line in lines:
+            self._record = f"{self._record}\n{line}" if self._record else line
+            self._quotes += line.count('"')
+            if self._quotes % 2 == 0:
+                done.append(self._record.rstrip("\r"))
+                self._record = ""
+                self._quotes = 0
+        return done
+
+
+async def import_csv_stream(
+    chunks: AsyncIterator[bytes],
+    run: Callable[..., Awaitable[ImportResult]],
+    token: str,
+    account_book_id: int,
+    chunk_size: int = 5000,
+    max_errors: int = 1000,
+) -> ImportResult:
+    """
+    Import a csv upload while it is still being received: complete records are
+    collected until ``chunk_size`` of them are pending, then handed to
+    import_records through ``run`` (the db executor), so memory stays bounded
+    by one chunk whatever the upload size.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    splitter = CsvRecordSplitter()
+    header: Optional[List[str]] = None
+    pending: List[str] = []
+    next_row = 1
+    inserted = failed = 0
+    errors: List[tuple] = []
+
+    async def flush() -> None:
+        nonlocal next_row, inserted, failed
+        result = await run(
+            import_records,
+            token=token,
+            account_book_id=account_book_id,
+            # parsed lazily on the db worker thread, not on the event loop
+            records=iter_csv_records(pending[:], header, next_row),
+            chunk_size=chunk_size,
+            max_errors=max_errors - len(errors),
+        )
+        next_row += len(pending)
+        inserted += result.inserted
+        failed += result.failed
+        errors.extend(result.errors)
+        pending.clear()
+
+    async def consume(lines: List[str]) -> None:
+        nonlocal header
+        for line in lines:
+            if header is None:
+                if line.strip():
+                    header = parse_csv_header(line)
+                continue
+            pending.append(line)
+            if len(pending) >= chunk_size:
+                await flush()
+
+    def decode(chunk: bytes, final: bool = False) -> str:
+        try:
+            return decoder.decode(chunk, final)
+        except UnicodeDecodeError:
+            raise RequireInfoLostException("csv upload is not valid utf-8") from None
+
+    try:
+        async for chunk in chunks:
+            await consume(splitter.feed(decode(chunk)))
+        await consume(splitter.feed(decode(b"", final=True)) + splitter.close())
+        if header is None:
+            raise RequireInfoLostException(
+                "csv upload is empty, a header row is required"
+            )
+        # even without data rows, so that token and ownership are always checked
+        await flush()
+    except Exception as e:
+        if inserted == 0 and not isinstance(e, BulkImportInterruptedError):
+            raise
+        raise _interrupted(inserted, e) from e
+    return ImportResult(inserted, failed, errors)
@@ -0,0 +1,240 @@
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+class SessionCache:
+    """
+    token -> account_id cache in front of ``SELECT ... FROM sessions WHERE token = ?``.
+
+    Entries are evicted least recently used first once ``max_entries`` is reached
+    and never outlive the token itself: an entry expires at ``expires_at`` or
+    after ``max_ttl`` seconds, whichever comes first. ``max_ttl`` bounds how long
+    another worker process may keep accepting a token that was logged out or
+    replaced here, explicit invalidation only reaches the local process.
+
+    A reader filling a miss takes ``generation()`` before its query and hands it
+    to put(): an invalidation that ran in between bumps the generation, and the
+    row read before it, possibly of a token just logged out, is not cached.
+    """
+
+    def __init__(self, max_entries: int = 10000, max_ttl: float = 60.0) -> None:
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        # token -> (account_id, cache entry deadline)
+        self._entries: OrderedDict[str, Tuple[int, float]] = OrderedDict()
+        self._tokens_by_account: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+        # bumped by every invalidation, see put()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def get(self, token: str) -> Optional[int]:
+        """Return the cached account_id of ``token``, None on miss or expiry."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            account_id, deadline = entry
+            if now >= deadline:
+                self._remove(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return account_id
+
+    def put(
+        self,
+        token: str,
+        account_id: int,
+        expires_at: Optional[int],
+        generation: Optional[int] = None,
+    ) -> None:
+        """
+        Cache a token verified against the db, ``expires_at`` is epoch seconds.
+        Skipped if an invalidation ran since ``generation`` was taken.
+        """
+        deadline = time.time() + self.max_ttl
+        if expires_at is not None:
+            deadline = min(deadline, float(expires_at))
+        if deadline <= time.time() or self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if token in self._entries:
+                self._remove(token)
+            self._entries[token] = (account_id, deadline)
+            self._tokens_by_account.setdefault(account_id, set()).add(token)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def invalidate(self, token: str) -> None:
+        with self._lock:
+            # even when not cached: a reader may be about to put it
+            self._generation += 1
+            if token in self._entries:
+                self._remove(token)
+
+    def invalidate_account(self, account_id: int) -> None:
+        """Drop every cached token of an account, e.g. after change_pwd."""
+        with self._lock:
+            self._generation += 1
+            for token in list(self._tokens_by_account.get(account_id, ())):
+                self._remove(token)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._tokens_by_account.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _remove(self, token: str) -> None:
+        # caller holds the lock
+        account_id, _ = self._entries.pop(token)
+        tokens = self._tokens_by_account.get(account_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_account[account_id]
+
+
+class BookOwnershipCache:
+    """
+    account_id -> ids of the account books it owns, filled by Account._load_books.
+
+    A cached set is always complete for its account: it is only created from a
+    full book listing and afterwards kept coherent by create_book /
+    remove_account_book. Accounts are evicted least recently used first.
+    A book created by another worker process is a cache miss here, callers fall
+    back to the db and reload the set.
+    """
+
+    def __init__(self, max_accounts: int = 10000) -> None:
+        self.max_accounts = max_accounts
+        self._books: OrderedDict[int, Set[int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def owns(self, account_id: int, book_id: int) -> Optional[bool]:
+        """True / False if the account is cached, None if it has to be loaded."""
+        with self._lock:
+            books = self._books.get(account_id)
+            if books is None or book_id not in books:
+                self.misses += 1
+                return None if books is None else False
+            self._books.move_to_end(account_id)
+            self.hits += 1
+            return True
+
+    def set_books(self, account_id: int, book_ids: Iterable[int]) -> None:
+        if self.max_accounts <= 0:
+            return
+        with self._lock:
+            self._books[account_id] = set(book_ids)
+            self._books.move_to_end(account_id)
+            while len(self._books) > self.max_accounts:
+                self._books.popitem(last=False)
+
+    def add(self, account_id: int, book_id: int) -> None:
+        # only extend complete sets, a lone book id would hide the others
+        with self._lock:
+            books = self._books.get(account_id)
+            if books is not None:
+                books.add(book_id)
+
+    def discard(self, account_id: int, book_id: int) -> None:
+        with self._lock:
+            books = self._books.get(account_id)
+            if books is not None:
+                books.discard(book_id)
+
+    def invalidate_account(self, account_id: int) -> None:
+        with self._lock:
+            self._books.pop(account_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._books.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._books),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class LastSeenBuffer:
+    """
+    token -> last time it was used, collected in memory by every authenticated
+    request and written to ``sessions.last_seen`` in one batch by flush().
+
+    Only the latest time of each token is kept, so the buffer is bounded by the
+    number of sessions active between two flushes. Once ``max_entries`` tokens
+    are pending further touches are dropped until the next flush: last_seen is
+    informational and may lag, it never decides whether a token is valid.
+    """
+
+    def __init__(self, max_entries: int = 100000) -> None:
+        self.max_entries = max_entries
+        self._pending: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.dropped = 0
+        self.flushed = 0
+
+    def touch(self, token: str, now: Optional[int] = None) -> None:
+        now = int(time.time()) if now is None else now
+        with self._lock:
+            if token not in self._pending and len(self._pending) >= self.max_entries:
+                self.dropped += 1
+                return
+            self._pending[token] = now
+
+    def discard(self, token: str) -> None:
+        with self._lock:
+            self._pending.pop(token, None)
+
+    def take(self, limit: Optional[int] = None) -> List[Tuple[int, str]]:
+        """Up to ``limit`` (default: all) pending (last_seen, token) pairs, removed."""
+        with self._lock:
+            if limit is None or limit >= len(self._pending):
+                pending, self._pending = self._pending, {}
+            else:
+                tokens = list(islice(self._pending, limit))
+                pending = {token: self._pending.pop(token) for token in tokens}
+            self.flushed += len(pending)
+        return [(seen, token) for token, seen in pending.items()]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pending.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._pending),
+                "flushed": self.flushed,
+                "dropped": self.dropped,
+            }
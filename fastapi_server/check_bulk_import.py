@@ -0,0 +1,178 @@
+"""
+Regression check of the bulk import endpoints, run against a throwaway
+database:
+
+    python check_bulk_import.py
+
+Exits 1 on the first failed check.
+"""
+
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+from typing import Any, Dict
+
+# before fast_router reads the config
+os.environ["COINVERSE_DB_PATH"] = os.path.join(tempfile.mkdtemp(), "check.db")
+logging.disable(logging.INFO)
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import fast_router  # noqa: E402
+from config import BULK_IMPORT_CHUNK_SIZE  # noqa: E402
+from db_api import AccountBook  # noqa: E402
+
+P = "/CoinVerse"
+
+
+def _check(ok: bool, what: str) -> None:
+    if not ok:
+        raise AssertionError(what)
+    print(f"ok  {what}")
+
+
+def run_checks(client: TestClient) -> None:
+    def post(path: str, **kw: Any) -> Dict[str, Any]:
+        return client.post(P + path, json=kw).json()
+
+    post("/register", name="check", email="check@example.com", pwd_hash="x")
+    token = post("/login", name_or_email="check", pwd_hash="x", maintain_online=True)[
+        "access_token"
+    ]
+    post("/create_book", token=token, book_name="import")
+    books = client.put(P + "/list_books", json={"token": token}).json()
+    book = books["book_summaries"][0]["book_id"]
+
+    # ---- amounts that can not be stored are rejected per row ---- #
+    r = post(
+        "/book/transactions/bulk_import",
+        token=token,
+        account_book_id=book,
+        transactions=[
+            {"amount": "nan"},
+            {"amount": 1e300},
+            {"amount": "-inf"},
+            {"amount": 12.5},
+        ],
+    )
+    _check(
+        r.get("inserted") == 1 and [e["row"] for e in r["errors"]] == [1, 2, 3],
+        "json: nan, inf and out of range amounts are row errors",
+    )
+    r = client.post(
+        P + "/book/transactions/bulk_import_csv",
+        params={"account_book_id": book},
+        headers={"token": token},
+        content=b"amount,note\nnan,a\ninf,b\n1e300,c\n-3,d\n",
+    ).json()
+    _check(
+        r.get("inserted") == 1 and [e["row"] for e in r["errors"]] == [1, 2, 3],
+        "csv: nan, inf and out of range amounts are row errors",
+    )
+
+    # ---- imported notes are indexed for the search ---- #
+    client.post(
+        P + "/book/transactions/bulk_import_csv",
+        params={"account_book_id": book},
+        headers={"token": token},
+        content=b"amount,note\n-4,grocery store\n-5,coffee\n",
+    )
+    r = post("/books_detail/search", token=token, account_book_id=book, query="groc*")
+    _check(
+        [t["note"] for t in r["transactions"]] == ["grocery store"],
+        "imported notes are found by the search",
+    )
+
+    # ---- a retried csv upload is replayed, another one under its key refused ---- #
+    def upload(content: bytes, key: str) -> Any:
+        return client.post(
+            P + "/book/transactions/bulk_import_csv",
+            params={"account_book_id": book},
+            headers={"token": token, "Idempotency-Key": key},
+            content=content,
+        )
+
+    first = upload(b"amount\n1\n", "csv-1")
+    retry = upload(b"amount\n1\n", "csv-1")
+    _check(
+        retry.headers.get("Idempotent-Replayed") == "true"
+        and retry.json() == first.json(),
+        "csv: a retry with the same body is replayed",
+    )
+    other = upload(b"amount\nx\n", "csv-1").json()
+    _check(
+        other["code"] == 1021,
+        "csv: another body under the same key is a key conflict",
+    )
+
+    # ---- a failure after a committed chunk keeps the key ---- #
+    import_transactions = AccountBook.import_transactions
+    calls = []
+
+    def failing_second_chunk(*args: Any) -> int:
+        calls.append(1)
+        if len(calls) == 2:
+            raise sqlite3.OperationalError("disk I/O error")
+        return import_transactions(*args)
+
+    fast_router.BULK_IMPORT_CHUNK_SIZE = 2
+    AccountBook.import_transactions = failing_second_chunk
+    json_import = {
+        "url": P + "/book/transactions/bulk_import",
+        "json": {
+            "token": token,
+            "account_book_id": book,
+            "transactions": [{"amount": i} for i in range(1, 5)],
+        },
+        "headers": {"Idempotency-Key": "json-2"},
+    }
+    try:
+        first = upload(b"amount\n1\n2\n3\n4\n", "csv-2").json()
+        calls.clear()
+        first_json = client.post(**json_import).json()
+    finally:
+        AccountBook.import_transactions = import_transactions
+        fast_router.BULK_IMPORT_CHUNK_SIZE = BULK_IMPORT_CHUNK_SIZE
+    retry = upload(b"amount\n1\n2\n3\n4\n", "csv-2")
+    _check(
+        first["code"] == 1024 and "after 2 rows" in first["msg"],
+        "csv: a failure after a committed chunk reports the imported rows",
+    )
+    _check(
+        retry.headers.get("Idempotent-Replayed") == "true" and retry.json() == first,
+        "csv: its retry is answered from the key, not imported again",
+    )
+    retry = client.post(**json_import)
+    _check(
+        first_json["code"] == 1024
+        and retry.headers.get("Idempotent-Replayed") == "true",
+        "json: an import interrupted after a chunk is not imported again",
+    )
+
+    # ---- an upload that is not utf-8 is refused with a code ---- #
+    r = client.post(
+        P + "/book/transactions/bulk_import_csv",
+        params={"account_book_id": book},
+        headers={"token": token},
+        content="amount,note\n-3,café\n".encode("latin-1"),
+    )
+    _check(
+        r.status_code == 200 and r.json()["code"] == 1006,
+        "csv: an upload that is not utf-8 is a business error",
+    )
+
+
+def main() -> None:
+    try:
+        with TestClient(fast_router.app) as client:
+            run_checks(client)
+    except AssertionError as e:
+        print(f"FAIL {e}")
+        sys.exit(1)
+    print("bulk import: all checks passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""
+Integration check of the postgres ledger backend against a running PostgreSQL,
+e.g. a local one:
+
+    COINVERSE_POSTGRES_DSN=postgresql://coinverse@localhost:5432/coinverse \
+        python check_postgres_ledger.py
+
+Skipped (exit 0) when COINVERSE_POSTGRES_DSN is not set. Everything runs in a
+schema of its own, dropped at the end, so the check may point at a database in
+use. The accounts are registered through the backend, a second instance plays
+another server node using the tokens of the first; set COINVERSE_TOKEN_MODE
+(and COINVERSE_TOKEN_KEYS) to check signed tokens. The sqlite side is not
+involved. Exits 1 on the first failed check.
+"""
+
+import asyncio
+import os
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional, Tuple, Type, Union
+
+from cus_exceptions import (
+    AccessDenialAccountBookError,
+    DuplicatedAccountBookError,
+    EmailFormatError,
+    RequireInfoLostException,
+    TokenExpireException,
+    TokenNotFoundError,
+)
+from db_api import IncomeType, OutcomeType, Transaction, datetime_to_epoch
+from tokens import is_signed
+
+DSN_ENV = "COINVERSE_POSTGRES_DSN"
+BASE = datetime(2024, 1, 1)
+
+
+def _check(ok: bool, what: str) -> None:
+    if not ok:
+        raise AssertionError(what)
+    print(f"ok  {what}")
+
+
+async def _raises(
+    exc: Union[Type[Exception], Tuple[Type[Exception], ...]],
+    what: str,
+    call: Callable[[], Awaitable[object]],
+) -> None:
+    try:
+        await call()
+    except exc:
+        _check(True, what)
+        return
+    _check(False, f"{what}: not raised")
+
+
+def _expected(
+    rows: List[Tuple[int, int, str]],
+    start: Optional[datetime],
+    end: datetime,
+    note: Optional[str],
+    after: Optional[Tuple[int, int]] = None,
+) -> List[int]:
+    # (id, time_epoch, note) filtered the way the queries do, ids in key order
+    keep = [
+        (t, i)
+        for i, t, n in rows
+        if t <= datetime_to_epoch(end)
+        and (start is None or t >= datetime_to_epoch(start))
+        and (note is None or note.lower() in n.lower())
+        and (after is None or (t, i) > after)
+    ]
+    return [i for _, i in sorted(keep)]
+
+
+async def run_checks(dsn: str) -> None:
+    import asyncpg
+
+    from postgres_ledger import PostgresLedger
+
+    schema = f"coinverse_check_{os.getpid()}"
+    admin = await asyncpg.connect(dsn)
+    await admin.execute(f"CREATE SCHEMA {schema}")
+    # the pool connections find the tables of the check first
+    separator = "&" if "?" in dsn else "?"
+    dsn = f"{dsn}{separator}search_path={schema}"
+    ledger = PostgresLedger(dsn, min_size=1)
+    # another server node, reading every revocation at once
+    node = PostgresLedger(dsn, min_size=1, revocation_refresh=0)
+    try:
+        await ledger.start()
+        await ledger.close()
+        await ledger.start()  # the schema of a restart is created again, harmlessly
+        await node.start()
+
+        # ---- accounts and sessions ---- #
+        await ledger.register("alice", "alice@example.com", "hash-a")
+        await ledger.register("bob", "bob@example.com", "hash-b")
+        await _raises(
+            sqlite3.IntegrityError,
+            "register refuses a taken name",
+            lambda: ledger.register("alice", "other@example.com", "x"),
+        )
+        await _raises(
+            sqlite3.IntegrityError,
+            "register refuses a taken email",
+            lambda: node.register("carol", "alice@example.com", "x"),
+        )
+        await _raises(
+            EmailFormatError,
+            "register refuses a bad email",
+            lambda: ledger.register("carol", "not an email", "x"),
+        )
+        alice_id, stored = await ledger.get_credentials("alice@example.com")
+        _check(
+            stored == "hash-a"
+            and await node.get_credentials("alice") == (alice_id, "hash-a")
+            and await ledger.get_credentials("mallory") is None,
+            "get_credentials finds an account by name or email",
+        )
+        alice = await ledger.complete_login(alice_id, "hash-a", rehashed="hash-a2")
+        _check(
+            (await ledger.get_credentials("alice"))[1] == "hash-a2",
+            "complete_login stores the rehashed password",
+        )
+        await ledger.complete_login(alice_id, "hash-a", rehashed="stale")
+        _check(
+            (await ledger.get_credentials("alice"))[1] == "hash-a2",
+            "complete_login keeps a password changed in the meantime",
+        )
+        bob_id = (await ledger.get_credentials("bob"))[0]
+        bob = await ledger.complete_login(bob_id, "hash-b")
+        _check(
+            await ledger.authenticate(alice) == alice_id
+            and await node.authenticate(alice) == alice_id
+            and await node.authenticate(bob) == bob_id,
+            "a token is accepted by every node",
+        )
+        _check(
+            await node.get_profile(alice) == ("alice", "alice@example.com"),
+            "get_profile returns name and email",
+        )
+        old = await ledger.complete_login(alice_id, "hash-a2")
+        await node.authenticate(old)  # cached by the other node
+        new = await ledger.refresh_token(old)
+        _check(
+            new is not None and await node.authenticate(new) == alice_id,
+            "refresh_token issues a token valid on every node",
+        )
+        await _raises(
+            (TokenExpireException, TokenNotFoundError),
+            "a refreshed token is refused by the node that refreshed it",
+            lambda: ledger.authenticate(old),
+        )
+        _check(
+            await ledger.refresh_token("unknown") is None,
+            "refresh_token of an unknown token is None",
+        )
+        _check(await ledger.logout(new), "logout succeeds")
+        _check(await ledger.logout(new), "logging out twice succeeds")
+        await _raises(
+            TokenExpireException,
+            "a logged out token is refused",
+            lambda: ledger.authenticate(new),
+        )
+        # a token the other node has not cached yet: it reads the logout
+        other = await ledger.complete_login(alice_id, "hash-a2")
+        await ledger.logout(other)
+        await _raises(
+            TokenExpireException,
+            "a token logged out on one node is refused by the others",
+            lambda: node.authenticate(other),
+        )
+        await ledger.set_password(alice_id, "hash-a3")
+        _check(
+            (await node.get_credentials("alice"))[1] == "hash-a3"
+            and await ledger.authenticate(alice) == alice_id,
+            "set_password changes the password, sessions stay valid",
+        )
+        if not is_signed(alice):
+            _check(
+                await ledger.flush_last_seen() > 0
+                and (await ledger.purge_expired(now=2**62))[0] > 0,
+                "last_seen is flushed and expired sessions are purged",
+            )
+        alice = await ledger.complete_login(alice_id, "hash-a3")
+        bob = await ledger.complete_login(bob_id, "hash-b")
+
+        # ---- books ---- #
+        book = await ledger.create_book(alice, "daily")
+        other = await ledger.create_book(alice, "travel")
+        bobs = await ledger.create_book(bob, "daily")
+        _check(len({book, other, bobs}) == 3, "create_book returns new ids")
+        await _raises(
+            DuplicatedAccountBookError,
+            "create_book refuses a duplicated name",
+            lambda: ledger.create_book(alice, "daily"),
+        )
+        await _raises(
+            RequireInfoLostException,
+            "create_book refuses an empty name",
+            lambda: ledger.create_book(alice, "  "),
+        )
+        await _raises(
+            TokenNotFoundError,
+            "an unknown token is refused",
+            lambda: ledger.list_books("mallory"),
+        )
+
+        # ---- transactions ---- #
+        notes = ["Salary", "lunch", "LUNCH with team", "coffee", "salary bonus"]
+        rows: List[Tuple[int, int, str]] = []  # (id, time_epoch, note)
+        for i in range(40):
+            note = notes[i % len(notes)]
+            income = "alary" in note
+            # two rows per day: equal times are ordered by id
+            tx = Transaction(
+                amount=(i + 1) * (1 if income else -1),
+                account_book_id=book,
+                category=IncomeType.SALARY if income else OutcomeType.FOOD,
+                time=BASE + timedelta(days=i // 2),
+                note=note,
+            )
+            tx_id = await ledger.add_transaction(alice, tx)
+            if tx.id != tx_id:
+                _check(False, "add_transaction sets the id of the transaction")
+            rows.append((tx_id, datetime_to_epoch(tx.time), note))
+        _check(len({r[0] for r in rows}) == 40, "add_transaction returns new ids")
+        await _raises(
+            AccessDenialAccountBookError,
+            "add_transaction refuses a book of another account",
+            lambda: ledger.add_transaction(
+                bob,
+                Transaction(-1, book, OutcomeType.FOOD, BASE, "intruder"),
+            ),
+        )
+
+        books = {b.id: b for b in await ledger.list_books(alice)}
+        expected_balance = sum(
+            (i + 1) * (1 if "alary" in notes[i % 5] else -1) for i in range(40)
+        )
+        _check(set(books) == {book, other}, "list_books lists the account's books")
+        _check(
+            books[book].balance == expected_balance and books[book].tx_count == 40,
+            "list_books balance and count follow the inserts",
+        )
+        _check(
+            books[book].last_time == (BASE + timedelta(days=19)).isoformat(),
+            "list_books reports the latest transaction time",
+        )
+        _check(
+            books[other].balance == 0 and books[other].last_time is None,
+            "an empty book has no balance and no activity",
+        )
+
+        # ---- the range queries, every filter combination ---- #
+        end = BASE + timedelta(days=30)
+        starts = (None, BASE + timedelta(days=5))
+        filters = (None, "lunch")
+        for start in starts:
+            for note in filters:
+                got = await ledger.get_transaction_rows(
+                    alice, book, start_time=start, end_time=end, note=note
+                )
+                _check(
+                    [r.id for r in got] == _expected(rows, start, end, note),
+                    f"get_transaction_rows start={start is not None} note={note}",
+                )
+                for after in (
+                    None,
+                    (datetime_to_epoch(BASE + timedelta(days=8)), rows[16][0]),
+                ):
+                    txs, next_key = await ledger.get_transaction_page(
+                        alice,
+                        book,
+                        start_time=start,
+                        end_time=end,
+                        note=note,
+                        after=after,
+                        limit=3,
+                    )
+                    want = _expected(rows, start, end, note, after)
+                    _check(
+                        [tx.id for tx in txs] == want[:3]
+                        and (next_key is not None) == (len(want) > 3),
+                        f"get_transaction_page start={start is not None} "
+                        f"note={note} after={after is not None}",
+                    )
+        # paging through the whole book, two rows share every time
+        seen: List[int] = []
+        key: Optional[Tuple[int, int]] = None
+        while True:
+            txs, key = await ledger.get_transaction_page(
+                alice, book, end_time=end, after=key, limit=7
+            )
+            seen.extend(tx.id for tx in txs)
+            if key is None:
+                break
+        _check(seen == _expected(rows, None, end, None), "pages cover the book once")
+        await _raises(
+            AccessDenialAccountBookError,
+            "reads of a book of another account are refused",
+            lambda: ledger.get_transaction_rows(bob, book),
+        )
+
+        # ---- removal ---- #
+        await _raises(
+            AccessDenialAccountBookError,
+            "remove_book refuses a book of another account",
+            lambda: ledger.remove_book(bob, book),
+        )
+        await ledger.remove_book(alice, book)
+        _check(
+            [b.id for b in await ledger.list_books(alice)] == [other],
+            "remove_book removes the book",
+        )
+        async with ledger._connection() as conn:
+            left = await conn.fetchval(
+                "SELECT COUNT(*) FROM transactions WHERE account_book_id = $1", book
+            )
+        _check(left == 0, "remove_book removes the book's transactions")
+        await _raises(
+            AccessDenialAccountBookError,
+            "a removed book can not be removed again",
+            lambda: ledger.remove_book(alice, book),
+        )
+    finally:
+        await node.close()
+        await ledger.close()
+        await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+
+def main() -> None:
+    dsn = os.environ.get(DSN_ENV, "").strip()
+    if not dsn:
+        print(f"skipped: {DSN_ENV} is not set")
+        return
+    try:
+        asyncio.run(run_checks(dsn))
+    except AssertionError as e:
+        print(f"FAIL {e}")
+        sys.exit(1)
+    print("postgres ledger: all checks passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import os
+from pathlib import Path
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return int(value)
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return float(value)
+
+
+# database file, can be moved away from the repo with COINVERSE_DB_PATH
+DB_PATH = Path(
+    os.environ.get(
+        "COINVERSE_DB_PATH", str(Path(__file__).parent / ".." / "db" / "account.db")
+    )
+)
+
+# ------------------------- connection pool ------------------------- #
+# max number of sqlite connections opened by one worker process
+DB_POOL_SIZE = _env_int("COINVERSE_DB_POOL_SIZE", 8)
+# seconds a request waits for a free connection before giving up
+DB_POOL_TIMEOUT = _env_float("COINVERSE_DB_POOL_TIMEOUT", 10.0)
+# a connection idle longer than this is pinged before it is handed out
+DB_POOL_HEALTH_CHECK_INTERVAL = _env_float("COINVERSE_DB_POOL_HEALTH_CHECK", 30.0)
+
+# ------------------------- db executor ------------------------- #
+# worker threads running the blocking db_api calls, more than DB_POOL_SIZE is useless
+DB_EXECUTOR_WORKERS = _env_int("COINVERSE_DB_EXECUTOR_WORKERS", DB_POOL_SIZE)
+
+# ------------------------- storage ------------------------- #
+# PRAGMA set applied to every connection, see storage_profile.PROFILES
+STORAGE_PROFILE = os.environ.get("COINVERSE_STORAGE_PROFILE", "balanced")
+
+# ------------------------- ledger backend ------------------------- #
+# where books and transactions live: "sqlite" (the DB_PATH file) or "postgres"
+# (POSTGRES_DSN, needs asyncpg); accounts and sessions always stay in sqlite
+LEDGER_BACKEND = os.environ.get("COINVERSE_LEDGER_BACKEND", "sqlite")
+POSTGRES_DSN = os.environ.get(
+    "COINVERSE_POSTGRES_DSN", "postgresql://coinverse@localhost:5432/coinverse"
+)
+# connections of the postgres pool per worker process
+POSTGRES_POOL_MIN = _env_int("COINVERSE_POSTGRES_POOL_MIN", 2)
+POSTGRES_POOL_MAX = _env_int("COINVERSE_POSTGRES_POOL_MAX", 10)
+# seconds a request waits for a free postgres connection / for a query
+POSTGRES_TIMEOUT = _env_float("COINVERSE_POSTGRES_TIMEOUT", 5.0)
+# prepared statements kept per postgres connection
+POSTGRES_STATEMENT_CACHE = _env_int("COINVERSE_POSTGRES_STATEMENT_CACHE", 256)
+
+# ------------------------- write batching ------------------------- #
+# 1: add_income / add_outcome rows are inserted by one writer in group commits,
+# sqlite ledger backend only
+WRITE_BATCH = _env_int("COINVERSE_WRITE_BATCH", 0)
+# rows of one group commit at most
+WRITE_BATCH_MAX_ROWS = _env_int("COINVERSE_WRITE_BATCH_MAX_ROWS", 256)
+# seconds the writer waits for more rows before it commits a batch
+WRITE_BATCH_MAX_DELAY = _env_float("COINVERSE_WRITE_BATCH_MAX_DELAY", 0.005)
+
+# ------------------------- caches ------------------------- #
+# token -> account_id entries kept per worker process
+SESSION_CACHE_SIZE = _env_int("COINVERSE_SESSION_CACHE_SIZE", 10000)
+# upper bound of an entry's life, also how long other workers may miss a logout
+SESSION_CACHE_TTL = _env_float("COINVERSE_SESSION_CACHE_TTL", 60.0)
+# accounts whose book id set is kept for the ownership check of transaction writes
+OWNERSHIP_CACHE_SIZE = _env_int("COINVERSE_OWNERSHIP_CACHE_SIZE", 10000)
+
+# ------------------------- bulk import ------------------------- #
+# rows per executemany / transaction
+BULK_IMPORT_CHUNK_SIZE = _env_int("COINVERSE_BULK_IMPORT_CHUNK_SIZE", 5000)
+# rejected rows listed in the response, the count of rejected rows is always exact
+BULK_IMPORT_MAX_ERRORS = _env_int("COINVERSE_BULK_IMPORT_MAX_ERRORS", 1000)
+
+# ------------------------- analytics ------------------------- #
+# days of one rolling average series at most, a longer range is refused
+ROLLING_AVERAGE_MAX_DAYS = _env_int("COINVERSE_ROLLING_AVERAGE_MAX_DAYS", 3660)
+
+# ------------------------- book detail ------------------------- #
+# rows fetched per query by the NDJSON stream, bounds its memory per request
+BOOK_DETAIL_STREAM_PAGE_SIZE = _env_int("COINVERSE_BOOK_DETAIL_STREAM_PAGE_SIZE", 500)
+
+# ------------------------- passwords ------------------------- #
+# scrypt cost of newly stored hashes, older parameters are upgraded on login
+SCRYPT_N = _env_int("COINVERSE_SCRYPT_N", 2**14)
+SCRYPT_R = _env_int("COINVERSE_SCRYPT_R", 8)
+SCRYPT_P = _env_int("COINVERSE_SCRYPT_P", 1)
+# processes running the KDF, bounds the CPU a login storm can take
+PASSWORD_HASH_WORKERS = _env_int(
+    "COINVERSE_PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)
+)
+# hash jobs queued or running at once, further logins wait for a slot
+PASSWORD_HASH_MAX_PENDING = _env_int("COINVERSE_PASSWORD_HASH_MAX_PENDING", 64)
+# seconds a login waits for a slot before it is rejected as busy
+PASSWORD_HASH_TIMEOUT = _env_float("COINVERSE_PASSWORD_HASH_TIMEOUT", 10.0)
+
+# ------------------------- tokens ------------------------- #
+# "opaque": random tokens looked up in sessions (cached), "signed": HMAC signed
+# tokens carrying account id and expiry, verified without the db
+TOKEN_MODE = os.environ.get("COINVERSE_TOKEN_MODE", "opaque")
+# signing keys "kid:secret,kid:secret", the first one signs new tokens and all
+# of them verify, so a key is rotated by putting a new one first
+TOKEN_KEYS = os.environ.get("COINVERSE_TOKEN_KEYS", "")
+# lifetime of an issued token in seconds
+TOKEN_TTL = _env_int("COINVERSE_TOKEN_TTL", 3600 * 24 * 15)
+# seconds between two reads of the logouts made by other worker processes
+TOKEN_REVOCATION_REFRESH = _env_float("COINVERSE_TOKEN_REVOCATION_REFRESH", 5.0)
+
+# ------------------------- sessions ------------------------- #
+# seconds between two batched writes of sessions.last_seen
+SESSION_LAST_SEEN_FLUSH = _env_float("COINVERSE_SESSION_LAST_SEEN_FLUSH", 30.0)
+# tokens whose last use waits for the next write, further ones are not recorded
+SESSION_LAST_SEEN_MAX = _env_int("COINVERSE_SESSION_LAST_SEEN_MAX", 100000)
+# seconds between two deletions of expired sessions
+SESSION_PURGE_INTERVAL = _env_float("COINVERSE_SESSION_PURGE_INTERVAL", 3600.0)
+
+# ------------------------- sync ------------------------- #
+# seconds a change_log entry is kept, a client that stayed offline longer resets
+SYNC_CHANGE_LOG_RETENTION = _env_int(
+    "COINVERSE_SYNC_CHANGE_LOG_RETENTION", 3600 * 24 * 90
+)
+
+# ------------------------- ops batch / idempotency ------------------------- #
+# operations accepted by one /ops request
+OPS_BATCH_MAX_OPS = _env_int("COINVERSE_OPS_BATCH_MAX_OPS", 500)
+# seconds an idempotency key and its stored result are kept
+IDEMPOTENCY_TTL = _env_int("COINVERSE_IDEMPOTENCY_TTL", 3600 * 24)
+# seconds after which a key whose request never finished (crashed worker) may
+# be used again; a retry arriving earlier is answered "in progress"
+IDEMPOTENCY_PENDING_TIMEOUT = _env_int("COINVERSE_IDEMPOTENCY_PENDING_TIMEOUT", 60)
+
+# ------------------------- maintenance ------------------------- #
+# rows deleted by one slice of a purge, each slice is one short write transaction
+SWEEP_BATCH = _env_int("COINVERSE_SWEEP_BATCH", 1000)
+# slices of one job per run, the rest waits for the next run
+SWEEP_MAX_SLICES = _env_int("COINVERSE_SWEEP_MAX_SLICES", 50)
+# seconds between two purges of expired revocations and orphaned link rows
+SWEEP_INTERVAL = _env_float("COINVERSE_SWEEP_INTERVAL", 3600.0)
+# free pages given back to the file system by one incremental_vacuum slice
+SWEEP_VACUUM_PAGES = _env_int("COINVERSE_SWEEP_VACUUM_PAGES", 256)
+# seconds between two runs of PRAGMA optimize (ANALYZE of the changed tables)
+SWEEP_ANALYZE_INTERVAL = _env_float("COINVERSE_SWEEP_ANALYZE_INTERVAL", 6 * 3600.0)
+# rows per index read by ANALYZE, bounds the time of the optimize slice
+SWEEP_ANALYSIS_LIMIT = _env_int("COINVERSE_SWEEP_ANALYSIS_LIMIT", 1000)
@@ -66,3 +66,63 @@ class InvalidOutcomeIncomeValueError(Exception):
 
 class LoginFailedError(Exception):
     pass
+
+
+class DBPoolExhaustedError(Exception):
+    """Raised when no database connection becomes free in time."""
+
+    pass
+
+
+class DBPoolClosedError(Exception):
+    pass
+
+
+class InvalidCursorError(Exception):
+    """Raised when a pagination cursor can not be decoded."""
+
+    pass
+
+
+class AnalyticsUnavailableError(Exception):
+    """Raised when the optional numpy dependency of analytics is missing."""
+
+    pass
+
+
+class PasswordHasherBusyError(Exception):
+    """Raised when the password hashing pool stays saturated for too long."""
+
+    pass
+
+
+class IdempotencyKeyConflictError(Exception):
+    """Raised when an idempotency key is reused for a different request."""
+
+    pass
+
+
+class IdempotencyKeyInProgressError(Exception):
+    """Raised when a request with the same idempotency key is still running."""
+
+    pass
+
+
+class LedgerBackendUnavailableError(Exception):
+    """Raised when the configured ledger backend can not serve a request."""
+
+    pass
+
+
+class BulkImportInterruptedError(Exception):
+    """
+    Raised when a bulk import fails after some of its chunks were committed:
+    ``inserted`` rows stay imported, the rest of the upload is not.
+    """
+
+    def __init__(self, inserted: int, reason: str) -> None:
+        super().__init__(
+            f"import stopped after {inserted} rows were imported: {reason}"
+        )
+        self.inserted = inserted
+        self.reason = reason
@@ -2,17 +2,36 @@ from __future__ import annotations
 
 import sqlite3
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import time
 from enum import Enum, auto
-from typing import Optional, Union, List, Tuple
+from typing import Dict, Iterable, NamedTuple, Optional, Sequence, Union, List, Tuple
 
 import secrets
 import hashlib
+import math
 
 import logging
 
-from utils import verify_email_format
+from caches import BookOwnershipCache, LastSeenBuffer, SessionCache
+from config import (
+    DB_PATH,
+    OWNERSHIP_CACHE_SIZE,
+    SESSION_CACHE_SIZE,
+    SESSION_CACHE_TTL,
+    SESSION_LAST_SEEN_MAX,
+    STORAGE_PROFILE,
+    SYNC_CHANGE_LOG_RETENTION,
+    TOKEN_KEYS,
+    TOKEN_MODE,
+    TOKEN_REVOCATION_REFRESH,
+    TOKEN_TTL,
+)
+from migrations import migrate
+import passwords
+from storage_profile import StorageProfile, get_storage_profile
+from tokens import RevocationList, TokenClaims, TokenSigner, is_signed
+from utils import build_fts_query, verify_email_format
 from cus_exceptions import (
     DuplicatedAccountBookError,
     EmailFormatError,
@@ -27,8 +46,7 @@ from cus_exceptions import (
     AccessDenialAccountBookError,
 )
 
-DB_PATH = Path(__file__).parent / ".." / "db" / "account.db"
-DB_PATH.parent.mkdir(exist_ok=True)
+DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -80,7 +98,92 @@ class DebtType(Enum):
     CREDIT_CARD = auto()
 
 
+# ------------------------- storage format ------------------------- #
+# amounts are stored as integer minor units (cents)
+MINOR_UNITS = 100
+# amounts are stored as int64 minor units
+MAX_AMOUNT_MINOR = 2**63 - 1
+_EPOCH = datetime(1970, 1, 1)
+
+# stored category code: the IncomeType value for income, minus the OutcomeType
+# value for outcome, so the code alone tells the enum and the member
+CATEGORY_BY_CODE = {
+    **{member.value: member for member in IncomeType},
+    **{-member.value: member for member in OutcomeType},
+}
+
+
+def category_code(category: Optional[Union[IncomeType, OutcomeType]]) -> Optional[int]:
+    if category is None:
+        return None
+    return category.value if isinstance(category, IncomeType) else -category.value
+
+
+def amount_to_minor(amount: float) -> int:
+    return round(amount * MINOR_UNITS)
+
+
+def datetime_to_epoch(dt: datetime) -> int:
+    """
+    Seconds since 1970-01-01 of the wall clock time: naive datetimes are stored
+    as if they were UTC (no local timezone involved), aware ones are converted
+    to UTC first. Sub-second precision is dropped.
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return (dt - _EPOCH) // timedelta(seconds=1)
+
+
+def epoch_to_datetime(ts: int) -> datetime:
+    """Inverse of datetime_to_epoch, a naive datetime."""
+    return _EPOCH + timedelta(seconds=ts)
+
+
+_INSERT_TRANSACTION_SQL = """
+    INSERT INTO transactions (
+        account_book_id,
+        amount_minor,
+        time_epoch,
+        note,
+        category_code
+    ) VALUES (?, ?, ?, ?, ?)
+"""
+
+
+# notes of the rows inserted while fts_bulk_load was set, see migration 12
+_INDEX_NOTES_AFTER_SQL = """
+    INSERT INTO transactions_fts (rowid, note, account_book_id)
+    SELECT id, note, account_book_id FROM transactions WHERE id > ?
+"""
+
+
+class TransactionRow(NamedTuple):
+    """
+    A transactions row as stored, without building a Transaction: the
+    zero-object fast path for callers that only serialize rows (e.g. /books_detail).
+    """
+
+    id: int
+    amount_minor: int
+    time_epoch: int
+    note: str
+    category_code: Optional[int]
+
+    @property
+    def amount(self) -> float:
+        return self.amount_minor / MINOR_UNITS
+
+    @property
+    def category(self) -> Optional[str]:
+        """IncomeType / OutcomeType member name."""
+        if self.category_code is None:
+            return None
+        return CATEGORY_BY_CODE[self.category_code].name
+
+
 class Transaction:
+    __slots__ = ("amount", "account_book_id", "time", "note", "id", "category")
+
     def __init__(
         self,
         amount: float,
@@ -107,6 +210,9 @@ class Transaction:
         self.note = note
         self.id = id
         self.category = category
+        # nan, inf and amounts beyond int64 minor units can not be stored
+        if not math.isfinite(amount) or abs(amount * MINOR_UNITS) > MAX_AMOUNT_MINOR:
+            raise InvalidOutcomeIncomeValueError(f"amount out of range: {amount}")
         # Validate that category is provided and matches the sign of amount
         try:
             if isinstance(self.category, IncomeType) and self.amount < 0:
@@ -123,40 +229,75 @@ class Transaction:
             )
 
     @staticmethod
-    def execute_db_add(conn: sqlite3.Connection, tx: Transaction) -> Optional[int]:
+    def execute_db_add(
+        conn: sqlite3.Connection, tx: Transaction, commit: bool = True
+    ) -> Optional[int]:
         """
         Add a new transaction to the database.
 
         Args:
             conn: The open sqlite3.Connection object.
             tx: The Transaction object to insert (must have category set).
+            commit: commit right away, False leaves it to the caller's transaction.
 
         Returns:
             int: The auto-generated ID of the new transaction.
         """
-        sql = """
-            INSERT INTO transactions (
-                account_book_id,
-                amount,
-                time,
-                note,
-                category
-            ) VALUES (?, ?, ?, ?, ?)
-        """
-        cur = conn.execute(
-            sql,
-            (
-                tx.account_book_id,
-                tx.amount,
-                tx.time.isoformat(timespec="seconds"),
-                tx.note,
-                tx.category.name if tx.category is not None else None,
-            ),
-        )
-        conn.commit()
+        cur = conn.execute(_INSERT_TRANSACTION_SQL, tx._to_db_row())
+        if commit:
+            conn.commit()
         tx.id = cur.lastrowid
         return tx.id
 
+    @staticmethod
+    def execute_db_add_many(
+        conn: sqlite3.Connection, txs: Sequence[Transaction], commit: bool = True
+    ) -> int:
+        """
+        Insert many transactions with a single executemany.
+
+        Args:
+            conn: The open sqlite3.Connection object.
+            txs: The Transaction objects to insert, their ids are not filled in.
+            commit: commit right away, False leaves it to the caller's transaction.
+
+        Returns:
+            int: The number of inserted rows.
+        """
+        if not txs:
+            return 0
+        conn.executemany(_INSERT_TRANSACTION_SQL, [tx._to_db_row() for tx in txs])
+        if commit:
+            conn.commit()
+        return len(txs)
+
+    @staticmethod
+    def _from_db_row(row: Tuple, account_book_id: int) -> Transaction:
+        """
+        Trusted load of a (id, amount_minor, time_epoch, note, category_code)
+        row: the row was validated by __init__ when it was written, so the
+        validation block is skipped and the attributes are set directly.
+        """
+        tx_id, amount_minor, time_epoch, t_note, t_code = row
+        tx = Transaction.__new__(Transaction)
+        tx.amount = amount_minor / MINOR_UNITS
+        tx.account_book_id = account_book_id
+        tx.time = _EPOCH + timedelta(seconds=time_epoch)
+        tx.note = t_note
+        tx.id = tx_id
+        tx.category = None if t_code is None else CATEGORY_BY_CODE[t_code]
+        return tx
+
+    def _to_db_row(self) -> Tuple:
+        """Column values in the order of _INSERT_TRANSACTION_SQL."""
+        return (
+            self.account_book_id,
+            amount_to_minor(self.amount),
+            datetime_to_epoch(self.time),
+            self.note,
+            category_code(self.category),
+        )
+
     @staticmethod
     def execute_db_remove(
         conn: sqlite3.Connection, remove_transaction_ids: Union[int, List[int]]
@@ -197,7 +338,7 @@ class Transaction:
         Query transactions with optional filters. Returns a list of Transaction objects.
         """
         sql = """
-            SELECT t.id, t.amount, t.time, t.note, t.category
+            SELECT t.id, t.amount_minor, t.time_epoch, t.note, t.category_code
             FROM transactions AS t
             JOIN account_books AS ab ON t.account_book_id = ab.account_book_id
             JOIN accounts AS a ON ab.account_id = a.account_id
@@ -211,8 +352,10 @@ class Transaction:
             sql += " AND t.id = ?"
             params.append(transaction_id)
         if time is not None:
-            sql += " AND DATE(t.time) = DATE(?)"
-            params.append(time.isoformat())
+            # the whole day of ``time``, as an index friendly range
+            day = datetime_to_epoch(time.replace(hour=0, minute=0, second=0))
+            sql += " AND t.time_epoch >= ? AND t.time_epoch < ?"
+            params.extend((day, day + 86400))
         if note is not None:
             sql += " AND t.note LIKE ?"
             params.append(f"%{note}%")
@@ -223,29 +366,116 @@ class Transaction:
             sql += " AND ab.name = ?"
             params.append(account_book_name)
         rows = conn.execute(sql, params).fetchall()
-        result: List[Transaction] = []
-        for row in rows:
-            tx_id, amount, t_time, t_note, t_category = row
-            # Determine category enum from stored name and amount sign
-            if t_category is None:
-                category_enum = None
-            else:
-                category_name: str = t_category  # e.g., "SALARY" or "FOOD"
-                if amount >= 0:
-                    category_enum = IncomeType[category_name]
-                else:
-                    category_enum = OutcomeType[category_name]
-            result.append(
-                Transaction(
-                    amount=amount,
-                    account_book_id=account_book_id,
-                    time=datetime.fromisoformat(t_time),
-                    note=t_note,
-                    category=category_enum,
-                    id=tx_id,
-                )
-            )
-        return result
+        return [Transaction._from_db_row(row, account_book_id) for row in rows]
+
+
+# token -> account_id of live tokens, shared by every connection of this process
+session_cache = SessionCache(max_entries=SESSION_CACHE_SIZE, max_ttl=SESSION_CACHE_TTL)
+# token -> last use of the opaque tokens seen since the last Account.flush_last_seen
+last_seen = LastSeenBuffer(max_entries=SESSION_LAST_SEEN_MAX)
+
+
+if TOKEN_MODE not in ("opaque", "signed"):
+    raise ValueError(f"unknown token mode '{TOKEN_MODE}', use 'opaque' or 'signed'")
+
+# signed tokens are verified whenever keys exist, TOKEN_MODE picks what login issues
+token_signer: Optional[TokenSigner] = (
+    TokenSigner.from_config(TOKEN_KEYS)
+    if TOKEN_MODE == "signed" or TOKEN_KEYS
+    else None
+)
+# ids of logged out signed tokens
+revocations = RevocationList(refresh_interval=TOKEN_REVOCATION_REFRESH)
+
+
+def issue_token(account_id: int) -> Tuple[str, int]:
+    """A new token of the configured TOKEN_MODE and its expiry (epoch seconds)."""
+    if TOKEN_MODE == "signed":
+        return token_signer.issue(account_id, TOKEN_TTL)
+    return secrets.token_urlsafe(32), int(time.time()) + TOKEN_TTL
+
+
+def _start_session(conn: sqlite3.Connection, account_id: int) -> str:
+    """
+    Issue a token for a new session of ``account_id``, the other sessions of
+    the account are left alone. An opaque token gets its sessions row (not
+    committed), a signed one carries its own expiry and needs none.
+    """
+    token, expire = issue_token(account_id)
+    if not is_signed(token):
+        now = int(time.time())
+        conn.execute(
+            """
+            INSERT INTO sessions (token, account_id, created_at, expires_at, last_seen)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (token, account_id, now, expire, now),
+        )
+    return token
+
+
+def _verify_signed(
+    conn: sqlite3.Connection,
+    token: str,
+    check_expiry: bool = True,
+    check_revoked: bool = True,
+) -> TokenClaims:
+    """
+    Signature, expiry and revocation check of a signed token, in memory
+    except for the periodic read of new revocations.
+    """
+    if token_signer is None:
+        raise TokenNotFoundError("Token not found.")
+    claims = token_signer.verify(token, check_expiry)
+    if check_revoked and revocations.is_revoked(conn, claims.jti):
+        # a logged out opaque token reads as expired too
+        raise TokenExpireException("Token expired.")
+    return claims
+
+
+def _resolve_token(conn: sqlite3.Connection, token: str) -> int:
+    """
+    Return the account_id owning ``token``.
+    A signed token is verified in CPU. For an opaque one the answer comes from
+    session_cache when possible, otherwise the sessions row is read and cached
+    until min(expires_at, now + SESSION_CACHE_TTL). The use is recorded in
+    ``last_seen`` and written later in a batch, never by the request itself.
+    Raises TokenNotFoundError or TokenExpireException if token is invalid/expired.
+    """
+    if is_signed(token):
+        return _verify_signed(conn, token).account_id
+    account_id = session_cache.get(token)
+    if account_id is None:
+        # taken before the read, so a logout racing with it is not undone
+        generation = session_cache.generation()
+        row = conn.execute(
+            "SELECT account_id, expires_at FROM sessions WHERE token = ?",
+            (token,),
+        ).fetchone()
+        if row is None:
+            raise TokenNotFoundError("Token not found.")
+        account_id, expires_at = row
+        if int(time.time()) > expires_at:
+            raise TokenExpireException("Token expired.")
+        session_cache.put(token, account_id, expires_at, generation)
+    last_seen.touch(token)
+    return account_id
+
+
+# account_id -> owned book ids, lets transaction writes skip the ownership query
+ownership_cache = BookOwnershipCache(max_accounts=OWNERSHIP_CACHE_SIZE)
+
+
+def _owns_book(conn: sqlite3.Connection, account_id: int, book_id: int) -> bool:
+    """
+    Check that ``book_id`` belongs to ``account_id``, without touching the db
+    when the account's books are cached.
+    """
+    if ownership_cache.owns(account_id, book_id):
+        return True
+    # unknown account, or a book created by another worker: reload the full set
+    books = Account._load_books(conn, account_id)
+    return any(book._id == book_id for book in books)
 
 
 def _hash_pwd(pwd: str) -> str:
@@ -287,6 +517,10 @@ class Account:
     def register(
         conn: sqlite3.Connection, name: str, email: str, pwd_hash: str
     ) -> bool:
+        """
+        ``pwd_hash`` is stored as given, pass passwords.hash_password() of the
+        client hash; a bare client hash still works and is upgraded at login.
+        """
         if not verify_email_format(email):
             raise EmailFormatError("Invalid email format")
 
@@ -307,129 +541,225 @@ class Account:
     def login(
         conn: sqlite3.Connection, name_or_email: str, pwd_hash: str
     ) -> Optional["Account"]:
-        import secrets
-
-        row = conn.execute(
-            """
-            SELECT account_id, name, email, pwd, token
-            FROM accounts
-            WHERE name = ? OR email = ?
-            """,
-            (name_or_email, name_or_email),
-        ).fetchone()
-        if not row:
+        """
+        Blocking login, the KDF runs on the calling thread. The /login route
+        runs the same three steps with the KDF in the PasswordHasher pool:
+        get_credentials -> passwords.verify_and_upgrade -> complete_login.
+        """
+        credentials = Account.get_credentials(conn, name_or_email)
+        if credentials is None:
             return None
-        acc_id, name, email, db_hash, _ = row
-        if pwd_hash != db_hash:
+        acc_id, db_hash = credentials
+        ok, rehashed = passwords.verify_and_upgrade(pwd_hash, db_hash)
+        if not ok:
             raise PwdNotMatchError(
                 "Invalid password hash code, consider using wrong password or hash compute error"
             )
-        # Generate new token and expire time
-        new_token = secrets.token_urlsafe(32)
-        expire = int(time.time()) + 3600 * 24 * 15  #  15 day expiry
-        conn.execute(
-            "UPDATE accounts SET token = ?, token_expire = ? WHERE account_id = ?",
-            (new_token, expire, acc_id),
-        )
+        return Account.complete_login(conn, acc_id, db_hash, rehashed)
+
+    @staticmethod
+    def get_credentials(
+        conn: sqlite3.Connection, name_or_email: str
+    ) -> Optional[Tuple[int, str]]:
+        """(account_id, stored password hash) of the account, None if unknown."""
+        return conn.execute(
+            "SELECT account_id, pwd FROM accounts WHERE name = ? OR email = ?",
+            (name_or_email, name_or_email),
+        ).fetchone()
+
+    @staticmethod
+    def complete_login(
+        conn: sqlite3.Connection,
+        account_id: int,
+        old_hash: str,
+        rehashed: Optional[str] = None,
+    ) -> "Account":
+        """
+        Issue a new token for an account whose password was verified against
+        ``old_hash``, and store ``rehashed`` in place of a legacy / outdated
+        hash, unless the password changed in the meantime.
+        """
+        # a new session, the other devices of the account stay logged in
+        new_token = _start_session(conn, account_id)
+        if rehashed is not None:
+            conn.execute(
+                "UPDATE accounts SET pwd = ? WHERE account_id = ? AND pwd = ?",
+                (rehashed, account_id, old_hash),
+            )
         conn.commit()
-        books = Account._load_books(conn, acc_id)
-        return Account(acc_id, name, email, db_hash, new_token, books)
+        name, email, db_hash = conn.execute(
+            "SELECT name, email, pwd FROM accounts WHERE account_id = ?",
+            (account_id,),
+        ).fetchone()
+        books = Account._load_books(conn, account_id)
+        return Account(account_id, name, email, db_hash, new_token, books)
 
     # ------------------------- Token 登录 --------------------- #
     @staticmethod
     def login_by_token(conn: sqlite3.Connection, token: str) -> Optional["Account"]:
         row = conn.execute(
-            "SELECT account_id, name, email, pwd, token FROM accounts WHERE token = ?",
+            """
+            SELECT a.account_id, a.name, a.email, a.pwd
+            FROM sessions s
+            JOIN accounts a ON a.account_id = s.account_id
+            WHERE s.token = ?
+            """,
             (token,),
         ).fetchone()
         if not row:
             return None
-        acc_id, name, email, pwd_hash, token = row
+        acc_id, name, email, pwd_hash = row
         books = Account._load_books(conn, acc_id)
         return Account(acc_id, name, email, pwd_hash, token, books)
 
     @staticmethod
     def refresh_token(conn: sqlite3.Connection, old_token: str) -> Optional["Account"]:
-        import secrets
-
+        if is_signed(old_token):
+            return Account._refresh_signed_token(conn, old_token)
         row = conn.execute(
             """
-            SELECT account_id, name, email, pwd, token, token_expire
-            FROM accounts
-            WHERE token = ?
+            SELECT a.account_id, a.name, a.email, a.pwd, s.expires_at
+            FROM sessions s
+            JOIN accounts a ON a.account_id = s.account_id
+            WHERE s.token = ?
             """,
             (old_token,),
         ).fetchone()
         if not row:
             return None
-        acc_id, name, email, db_hash, token, token_expire = row
+        acc_id, name, email, db_hash, expires_at = row
         now = int(time.time())
-        if token_expire is not None and now > token_expire:
+        if now > expires_at:
             raise TokenExpireException("Token expired")
-        # 生成新 token 和过期时间
-        new_token = secrets.token_urlsafe(32)
-        expire = now + 3600 * 24 * 15  # 15 day expire
-        conn.execute(
-            "UPDATE accounts SET token = ?, token_expire = ? WHERE account_id = ?",
-            (new_token, expire, acc_id),
-        )
+        # 生成新 token 和过期时间, the new session replaces only this one
+        new_token = _start_session(conn, acc_id)
+        conn.execute("DELETE FROM sessions WHERE token = ?", (old_token,))
         conn.commit()
+        session_cache.invalidate(old_token)
+        last_seen.discard(old_token)
         books = Account._load_books(conn, acc_id)
         return Account(acc_id, name, email, db_hash, new_token, books)
 
+    @staticmethod
+    def _refresh_signed_token(conn: sqlite3.Connection, old_token: str) -> "Account":
+        # the old token is revoked, other tokens of the account stay valid
+        claims = _verify_signed(conn, old_token)
+        row = conn.execute(
+            "SELECT name, email, pwd FROM accounts WHERE account_id = ?",
+            (claims.account_id,),
+        ).fetchone()
+        if not row:
+            raise TokenNotFoundError("Token not found")
+        name, email, db_hash = row
+        new_token = _start_session(conn, claims.account_id)
+        revocations.revoke(conn, claims.jti, claims.expires_at)  # commits
+        books = Account._load_books(conn, claims.account_id)
+        return Account(claims.account_id, name, email, db_hash, new_token, books)
+
     @staticmethod
     def logout(conn: sqlite3.Connection, token: str) -> bool:
+        if is_signed(token):
+            # logging out twice succeeds, like for an opaque token
+            claims = _verify_signed(
+                conn, token, check_expiry=False, check_revoked=False
+            )
+            if time.time() <= claims.expires_at and not revocations.is_revoked(
+                conn, claims.jti
+            ):
+                revocations.revoke(conn, claims.jti, claims.expires_at)
+            return True
         row = conn.execute(
-            "SELECT account_id, token_expire FROM accounts WHERE token = ?",
+            "SELECT expires_at FROM sessions WHERE token = ?",
             (token,),
         ).fetchone()
         if not row:
             raise TokenNotFoundError("Token not found")
-        account_id, token_expire = row
         now = int(time.time())
-        if token_expire is not None and now > token_expire:
+        if now > row[0]:
             return True
-        # 使 token 立即过期
+        # 使 token 立即过期, only this session; the purge deletes the row later
         conn.execute(
-            "UPDATE accounts SET token_expire = ? WHERE account_id = ?",
-            (now - 1, account_id),
+            "UPDATE sessions SET expires_at = ? WHERE token = ?",
+            (now - 1, token),
         )
         conn.commit()
+        session_cache.invalidate(token)
+        last_seen.discard(token)
         return True
 
+    @staticmethod
+    def flush_last_seen(conn: sqlite3.Connection, limit: Optional[int] = None) -> int:
+        """
+        Write up to ``limit`` (default: all) of the uses buffered in ``last_seen``
+        to sessions.last_seen in one transaction. Returns the number of tokens
+        written.
+        """
+        pending = last_seen.take(limit if limit else None)
+        if not pending:
+            return 0
+        conn.executemany(
+            "UPDATE sessions SET last_seen = MAX(last_seen, ?) WHERE token = ?",
+            pending,
+        )
+        conn.commit()
+        return len(pending)
+
+    @staticmethod
+    def purge_sessions(
+        conn: sqlite3.Connection, limit: Optional[int] = None, now: Optional[int] = None
+    ) -> int:
+        """
+        Delete up to ``limit`` (default: all) sessions expired or logged out
+        before ``now`` (default: the current time). Returns the number of
+        deleted rows.
+        """
+        now = int(time.time()) if now is None else now
+        cur = conn.execute(
+            """
+            DELETE FROM sessions WHERE token IN (
+                SELECT token FROM sessions WHERE expires_at < ? LIMIT ?
+            )
+            """,
+            (now, limit if limit else -1),
+        )
+        conn.commit()
+        return cur.rowcount
+
+    @staticmethod
+    def authenticate(conn: sqlite3.Connection, token: str) -> int:
+        """
+        The account_id of a valid token, for callers running several
+        operations of one account (see ops_batch).
+        Raises TokenNotFoundError or TokenExpireException.
+        """
+        return _resolve_token(conn, token)
+
     @staticmethod
     def get_profile(conn: sqlite3.Connection, token: str) -> "Account":
+        acc_id = _resolve_token(conn, token)
         row = conn.execute(
-            "SELECT account_id, name, email, pwd, token, token_expire FROM accounts WHERE token = ?",
-            (token,),
+            "SELECT name, email, pwd FROM accounts WHERE account_id = ?",
+            (acc_id,),
         ).fetchone()
         if not row:
             raise TokenNotFoundError("Token not found")
-        acc_id, name, email, pwd_hash, token, token_expire = row
-        now = int(time.time())
-        if token_expire is not None and now > token_expire:
-            raise TokenExpireException("Token expired")
+        name, email, pwd_hash = row
         books = Account._load_books(conn, acc_id)
         return Account(acc_id, name, email, pwd_hash, token, books)
 
     # ------------------------- 其它接口（基本保持不变） -------- #
     @staticmethod
     def create_book(
-        conn: sqlite3.Connection, token: str, book_name: str
+        conn: sqlite3.Connection, token: str, book_name: str, commit: bool = True
     ) -> AccountBook:
+        """
+        ``commit=False`` leaves the insert to the caller's transaction; the book
+        is then not added to ownership_cache, it is found by the reload of a
+        cache miss once visible.
+        """
         if book_name is None or book_name.strip() == "":
             raise RequireInfoLostException("Book name is required.")
-        cur = conn.execute(
-            "SELECT account_id, token_expire FROM accounts WHERE token = ?",
-            (token,),
-        )
-        row = cur.fetchone()
-        if row is None:
-            raise TokenNotFoundError("Token not found.")
-        account_id, token_expire = row
-        now = int(time.time())
-        if token_expire is not None and now > token_expire:
-            raise TokenExpireException("Token expired.")
+        account_id = _resolve_token(conn, token)
         dup_cur = conn.execute(
             "SELECT 1 FROM account_books WHERE name = ? AND account_id = ?",
             (book_name, account_id),
@@ -442,54 +772,33 @@ class Account:
             "INSERT INTO account_books (name, account_id) VALUES (?, ?)",
             (book_name, account_id),
         )
-        conn.commit()
         book_id = cur.lastrowid
         if book_id is None:
             raise RuntimeError("Failed to create account book, no ID returned.")
+        if commit:
+            conn.commit()
+            ownership_cache.add(account_id, book_id)
         return AccountBook(id=book_id, name=book_name, account_id=account_id)
 
     @staticmethod
     def list_books(conn: sqlite3.Connection, token: str) -> List[AccountBook]:
-        row = conn.execute(
-            "SELECT account_id, token_expire FROM accounts WHERE token = ?",
-            (token,),
-        ).fetchone()
-        if row is None:
-            raise TokenNotFoundError("Token not found.")
-        account_id, token_expire = row
-        now = int(time.time())
-        if token_expire is not None and now > token_expire:
-            raise TokenExpireException("Token expired.")
+        account_id = _resolve_token(conn, token)
         return Account._load_books(conn, account_id)
 
     @staticmethod
-    def remove_account_book(conn: sqlite3.Connection, token: str, book_id: int) -> bool:
-        # Check token validity and expiry
-        row = conn.execute(
-            "SELECT account_id, token_expire FROM accounts WHERE token = ?",
-            (token,),
-        ).fetchone()
-        if row is None:
-            raise TokenNotFoundError("Token not found.")
-        account_id, token_expire = row
-        now = int(time.time())
-        if token_expire is not None and now > token_expire:
-            raise TokenExpireException("Token expired.")
-        # Check if the account_book belongs to the account
-        book_row = conn.execute(
-            "SELECT 1 FROM account_books WHERE account_book_id = ? AND account_id = ?",
-            (book_id, account_id),
-        ).fetchone()
-        if book_row is None:
-            raise AccessDenialAccountBookError(
-                "Account book not found or does not belong to this account."
-            )
+    def remove_account_book(
+        conn: sqlite3.Connection, token: str, book_id: int, commit: bool = True
+    ) -> bool:
+        account_id = AccountBook.check_access(conn, token, book_id)
         # Remove the account_book
         conn.execute(
             "DELETE FROM account_books WHERE account_book_id = ?",
             (book_id,),
         )
-        conn.commit()
+        if commit:
+            conn.commit()
+        # dropped even if the caller rolls back: a missing book is only a cache miss
+        ownership_cache.discard(account_id, book_id)
         return True
 
     @staticmethod
@@ -499,18 +808,21 @@ class Account:
         old_pwd_hash: str,
         new_pwd_hash: str,
     ) -> bool:
-        row = conn.execute(
-            "SELECT account_id, pwd FROM accounts WHERE name = ? OR email = ?",
-            (email_or_name, email_or_name),
-        ).fetchone()
-        if not row or row[1] != old_pwd_hash:
+        """Blocking version of the /users/me/change_password route, see login."""
+        row = Account.get_credentials(conn, email_or_name)
+        if not row or not passwords.verify_password(old_pwd_hash, row[1]):
             raise PasswordWrongError
-        account_id = row[0]
+        return Account.set_password(conn, row[0], passwords.hash_password(new_pwd_hash))
+
+    @staticmethod
+    def set_password(conn: sqlite3.Connection, account_id: int, new_hash: str) -> bool:
+        """Store an already computed password hash, see passwords.hash_password."""
         conn.execute(
             "UPDATE accounts SET pwd = ? WHERE account_id = ?",
-            (new_pwd_hash, account_id),
+            (new_hash, account_id),
         )
         conn.commit()
+        session_cache.invalidate_account(account_id)
         return True
 
     @staticmethod
@@ -519,8 +831,247 @@ class Account:
             "SELECT account_book_id, name FROM account_books WHERE account_id = ?",
             (account_id,),
         ).fetchall()
+        ownership_cache.set_books(account_id, (r[0] for r in rows))
         return [AccountBook(id=r[0], name=r[1], account_id=account_id) for r in rows]
 
+    # ------------------------- 增量同步 --------------------- #
+    @staticmethod
+    def get_changes(
+        conn: sqlite3.Connection, token: str, since: int, limit: int = 500
+    ) -> "ChangeSet":
+        """
+        The books and transactions of the account changed after change_log seq
+        ``since``, at most ``limit`` log entries per call. Each entity appears
+        once, in its current state, or among the deleted ids when it no longer
+        exists. The deleted books stand for all their transactions.
+
+        ``reset`` is set when ``since`` can't be served: 0 (a new client), a seq
+        ahead of the log, or older than the pruned part of the log. The client
+        then keeps ``next_since``, reloads everything with /list_books and
+        /books_detail, and syncs from there; changes made during the reload are
+        sent again, applying them twice is harmless.
+        """
+        account_id = _resolve_token(conn, token)
+        # read before the entries: a change logged in between is sent again
+        # next time instead of being skipped
+        head_row = conn.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'change_log'"
+        ).fetchone()
+        head = head_row[0] if head_row else 0
+        floor = conn.execute("SELECT MIN(seq) FROM change_log").fetchone()[0]
+        floor = head + 1 if floor is None else floor
+        if since < floor - 1 or since > head:
+            return ChangeSet(
+                [], [], [], [], next_since=head, has_more=False, reset=True
+            )
+
+        rows = conn.execute(
+            """
+            SELECT seq, entity, entity_id, deleted
+            FROM change_log
+            WHERE account_id = ? AND seq > ?
+            ORDER BY seq
+            LIMIT ?
+            """,
+            (account_id, since, limit + 1),
+        ).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        # the last entry of an entity wins
+        latest: Dict[Tuple[str, int], int] = {}
+        for _, entity, entity_id, deleted in rows:
+            latest[(entity, entity_id)] = deleted
+        book_ids = [i for (e, i), d in latest.items() if e == "book" and not d]
+        tx_ids = [i for (e, i), d in latest.items() if e == "transaction" and not d]
+
+        books: List[Tuple[int, str]] = []
+        for chunk in _chunks(book_ids, 500):
+            books += conn.execute(
+                f"""
+                SELECT account_book_id, name FROM account_books
+                WHERE account_id = ? AND account_book_id IN ({",".join("?" * len(chunk))})
+                """,
+                (account_id, *chunk),
+            ).fetchall()
+        transactions: List[Transaction] = []
+        for chunk in _chunks(tx_ids, 500):
+            rows_tx = conn.execute(
+                f"""
+                SELECT t.id, t.amount_minor, t.time_epoch, t.note, t.category_code,
+                       t.account_book_id
+                FROM transactions t
+                JOIN account_books ab ON ab.account_book_id = t.account_book_id
+                WHERE ab.account_id = ? AND t.id IN ({",".join("?" * len(chunk))})
+                """,
+                (account_id, *chunk),
+            ).fetchall()
+            transactions += [Transaction._from_db_row(r[:5], r[5]) for r in rows_tx]
+
+        # updated and deleted again later: the row is gone
+        found_books = {book_id for book_id, _ in books}
+        found_txs = {tx.id for tx in transactions}
+        deleted_books = [
+            i
+            for (e, i), d in latest.items()
+            if e == "book" and (d or i not in found_books)
+        ]
+        deleted_txs = [
+            i
+            for (e, i), d in latest.items()
+            if e == "transaction" and (d or i not in found_txs)
+        ]
+        return ChangeSet(
+            books,
+            deleted_books,
+            transactions,
+            deleted_txs,
+            next_since=rows[-1][0] if has_more else head,
+            has_more=has_more,
+            reset=False,
+        )
+
+    @staticmethod
+    def prune_change_log(
+        conn: sqlite3.Connection,
+        limit: int,
+        max_age: int = SYNC_CHANGE_LOG_RETENTION,
+    ) -> int:
+        """
+        Delete change_log entries older than ``max_age`` seconds, looking at
+        the ``limit`` oldest entries only. Clients behind the pruned part are
+        told to reset by get_changes.
+        """
+        cur = conn.execute(
+            """
+            DELETE FROM change_log WHERE seq IN (
+                SELECT seq FROM (
+                    SELECT seq, changed_at FROM change_log ORDER BY seq LIMIT ?
+                )
+                WHERE changed_at < ?
+            )
+            """,
+            (limit, int(time.time()) - max_age),
+        )
+        conn.commit()
+        return cur.rowcount
+
+
+def _chunks(items: List[int], size: int) -> Iterable[List[int]]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+class ChangeSet(NamedTuple):
+    books: List[Tuple[int, str]]  # (account_book_id, name), created or renamed
+    deleted_book_ids: List[int]
+    transactions: List[Transaction]  # created or updated, with account_book_id
+    deleted_transaction_ids: List[int]
+    next_since: int  # the seq to pass as ``since`` next time
+    has_more: bool  # more changes are waiting, call again right away
+    reset: bool  # ``since`` is unusable, reload everything, see Account.get_changes
+
+
+class BookStats(NamedTuple):
+    id: int
+    name: str
+    balance: float
+    tx_count: int
+    last_time: Optional[str]
+
+
+class SummaryRow(NamedTuple):
+    bucket: str  # first day of the bucket, YYYY-MM-DD
+    category: Optional[str]  # IncomeType / OutcomeType member name
+    income: bool
+    total: float
+    count: int
+
+
+# bucket -> SQL expression of the first day of the bucket of t.time_epoch,
+# weeks start on monday
+SUMMARY_BUCKETS = {
+    "day": "date(t.time_epoch, 'unixepoch')",
+    "week": "date(t.time_epoch, 'unixepoch', 'weekday 0', '-6 days')",
+    "month": "date(t.time_epoch, 'unixepoch', 'start of month')",
+    "year": "date(t.time_epoch, 'unixepoch', 'start of year')",
+}
+# the same for r.month of book_monthly_rollups
+_ROLLUP_BUCKETS = {
+    "month": "r.month",
+    "year": "substr(r.month, 1, 4) || '-01-01'",
+}
+
+
+def _month_floor(ts: int) -> int:
+    """Epoch of the first second of the month of ``ts``."""
+    day = epoch_to_datetime(ts)
+    return datetime_to_epoch(datetime(day.year, day.month, 1))
+
+
+def _month_ceil(ts: int) -> int:
+    """``ts`` if it starts a month, else the first second of the next month."""
+    floor = _month_floor(ts)
+    if floor == ts:
+        return ts
+    day = epoch_to_datetime(floor)
+    return datetime_to_epoch(
+        datetime(day.year + day.month // 12, day.month % 12 + 1, 1)
+    )
+
+
+def _summary_scan(
+    conn: sqlite3.Connection,
+    account_book_id: int,
+    bucket: str,
+    start: Optional[int],
+    end: Optional[int],
+) -> sqlite3.Cursor:
+    # (bucket, category_code or 0, total_minor, count) summed from transactions
+    sql = f"""
+        SELECT {SUMMARY_BUCKETS[bucket]} AS bucket,
+               COALESCE(t.category_code, 0) AS code,
+               SUM(t.amount_minor),
+               COUNT(*)
+        FROM transactions AS t
+        WHERE t.account_book_id = ?
+    """
+    params: List = [account_book_id]
+    if start is not None:
+        sql += " AND t.time_epoch >= ?"
+        params.append(start)
+    if end is not None:
+        sql += " AND t.time_epoch <= ?"
+        params.append(end)
+    sql += " GROUP BY bucket, code"
+    return conn.execute(sql, params)
+
+
+def _summary_rollups(
+    conn: sqlite3.Connection,
+    account_book_id: int,
+    bucket: str,
+    start: Optional[int],
+    end: Optional[int],
+) -> sqlite3.Cursor:
+    # the same from book_monthly_rollups, for the whole months in [start, end)
+    sql = f"""
+        SELECT {_ROLLUP_BUCKETS[bucket]} AS bucket,
+               r.category_code,
+               SUM(r.total_minor),
+               SUM(r.tx_count)
+        FROM book_monthly_rollups AS r
+        WHERE r.account_book_id = ?
+    """
+    params: List = [account_book_id]
+    if start is not None:
+        sql += " AND r.month >= ?"
+        params.append(epoch_to_datetime(start).date().isoformat())
+    if end is not None:
+        sql += " AND r.month < ?"
+        params.append(epoch_to_datetime(end).date().isoformat())
+    sql += " GROUP BY bucket, r.category_code"
+    return conn.execute(sql, params)
+
 
 class AccountBook:
     def __init__(self, id: int, name: str, account_id: int):
@@ -551,26 +1102,30 @@ class AccountBook:
         Raises TokenNotFoundError or TokenExpireException if token is invalid/expired.
         Returns True if ownership is verified, otherwise raises RuntimeError.
         """
-        row = conn.execute(
-            "SELECT account_id, token_expire FROM accounts WHERE token = ?",
-            (token,),
-        ).fetchone()
-        if row is None:
-            raise TokenNotFoundError("Token not found.")
-        account_id, token_expire = row
-        now = int(time.time())
-        if token_expire is not None and now > token_expire:
-            raise TokenExpireException("Token expired.")
-        book_row = conn.execute(
-            "SELECT 1 FROM account_books WHERE account_book_id = ? AND account_id = ?",
-            (account_book_id, account_id),
-        ).fetchone()
-        if book_row is None:
+        account_id = _resolve_token(conn, token)
+        if not _owns_book(conn, account_id, account_book_id):
             raise RuntimeError(
                 "Account book not found or does not belong to this account."
             )
         return True
 
+    @staticmethod
+    def check_access(conn: sqlite3.Connection, token: str, account_book_id: int) -> int:
+        """
+        Verify the token and that its account owns the book, for readers that
+        query the book's tables themselves (e.g. analytics).
+        Raises AccessDenialAccountBookError if it does not.
+
+        Returns:
+            int: the account_id of the token.
+        """
+        account_id = _resolve_token(conn, token)
+        if not _owns_book(conn, account_id, account_book_id):
+            raise AccessDenialAccountBookError(
+                "Account book not found or does not belong to this account."
+            )
+        return account_id
+
     @staticmethod
     def add_income(
         conn: sqlite3.Connection,
@@ -619,6 +1174,39 @@ class AccountBook:
         )
         Transaction.execute_db_add(conn, tx)
 
+    @staticmethod
+    def import_transactions(
+        conn: sqlite3.Connection,
+        token: str,
+        account_book_id: int,
+        transactions: Sequence[Transaction],
+    ) -> int:
+        """
+        Insert an already validated batch of transactions into the account book,
+        in one explicit transaction. Token and ownership are verified first.
+        The notes are added to transactions_fts by one statement for the whole
+        batch instead of the per row trigger (see migration 12).
+
+        Returns:
+            int: The number of inserted rows.
+        """
+        AccountBook.check_access(conn, token, account_book_id)
+        for tx in transactions:
+            tx.account_book_id = account_book_id
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # ids are AUTOINCREMENT: the rows of the batch are the ones above it
+            last_id = conn.execute("SELECT MAX(id) FROM transactions").fetchone()[0]
+            conn.execute("INSERT INTO fts_bulk_load (active) VALUES (1)")
+            inserted = Transaction.execute_db_add_many(conn, transactions, commit=False)
+            conn.execute("DELETE FROM fts_bulk_load")
+            conn.execute(_INDEX_NOTES_AFTER_SQL, (last_id or 0,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return inserted
+
     def execute_remove_transaction(
         self,
         conn: sqlite3.Connection,
@@ -646,154 +1234,466 @@ class AccountBook:
             Transaction.execute_db_remove(conn, tx_ids)
 
     @staticmethod
-    def get_transaction_list(
+    def get_transaction_rows(
         conn: sqlite3.Connection,
         token: str,
         account_book_id: int,
         start_time: Optional[datetime] = None,
         end_time: Optional[datetime] = None,
         note: Optional[str] = None,
-    ) -> List[Transaction]:
+    ) -> List[TransactionRow]:
         """
         Find transactions in the specified account book matching the optional filters,
         sorted by time (earlier first). Token is verified and book ownership checked.
         By default, shows all transactions.
+        Rows are returned as stored, see get_transaction_list for Transactions.
         """
-        # Verify token and get account_id
-        row = conn.execute(
-            "SELECT account_id, token_expire FROM accounts WHERE token = ?",
-            (token,),
-        ).fetchone()
-        if row is None:
-            raise TokenNotFoundError("Token not found.")
-        account_id, token_expire = row
-        now = int(time.time())
-        if token_expire is not None and now > token_expire:
-            raise TokenExpireException("Token expired.")
-
-        # Check if the account_book belongs to the account
-        book_row = conn.execute(
-            "SELECT 1 FROM account_books WHERE account_book_id = ? AND account_id = ?",
-            (account_book_id, account_id),
-        ).fetchone()
-        if book_row is None:
-            raise AccessDenialAccountBookError(
-                "Account book not found or does not belong to this account."
-            )
+        # Verify the token and that its account owns the book
+        AccountBook.check_access(conn, token, account_book_id)
 
         # Default time range: show all transactions
-        if start_time is None:
-            start_time = datetime.fromtimestamp(0)  # beginning of time
         if end_time is None:
             end_time = datetime.now()
 
         sql = """
-            SELECT t.id, t.amount, t.time, t.note, t.category
+            SELECT t.id, t.amount_minor, t.time_epoch, t.note, t.category_code
             FROM transactions AS t
             WHERE t.account_book_id = ?
-              AND t.time >= ?
-              AND t.time <= ?
+              AND t.time_epoch <= ?
         """
-        params: List = [account_book_id, start_time.isoformat(), end_time.isoformat()]
+        params: List = [account_book_id, datetime_to_epoch(end_time)]
+        if start_time is not None:
+            sql += " AND t.time_epoch >= ?"
+            params.append(datetime_to_epoch(start_time))
         if note is not None:
             sql += " AND t.note LIKE ?"
             params.append(f"%{note}%")
-        sql += " ORDER BY t.time ASC"
+        sql += " ORDER BY t.time_epoch ASC"
+        return list(map(TransactionRow._make, conn.execute(sql, params)))
+
+    @staticmethod
+    def get_transaction_list(
+        conn: sqlite3.Connection,
+        token: str,
+        account_book_id: int,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        note: Optional[str] = None,
+    ) -> List[Transaction]:
+        """
+        Same as get_transaction_rows, decoded into Transaction objects.
+        """
+        rows = AccountBook.get_transaction_rows(
+            conn, token, account_book_id, start_time, end_time, note
+        )
+        return [Transaction._from_db_row(row, account_book_id) for row in rows]
+
+    @staticmethod
+    def search_transactions(
+        conn: sqlite3.Connection,
+        token: str,
+        account_book_id: int,
+        query: str,
+        match_all: bool = True,
+        limit: int = 50,
+    ) -> List[Tuple[Transaction, float]]:
+        """
+        Full text search of the book's notes through the transactions_fts index.
+        ``query`` is split into terms, ``term*`` is a prefix query, see
+        utils.build_fts_query. Token is verified and book ownership checked.
+
+        Returns:
+            (transaction, score) pairs, best match first; the score is the
+            negated bm25 rank, higher is more relevant.
+        """
+        AccountBook.check_access(conn, token, account_book_id)
+        # the book is part of the MATCH: only its postings are intersected with
+        # the terms; its column weighs 0 in the rank
+        match = (
+            f'account_book_id : "{int(account_book_id)}"'
+            f" AND note : ({build_fts_query(query, match_all)})"
+        )
+        rows = conn.execute(
+            """
+            SELECT t.id, t.amount_minor, t.time_epoch, t.note, t.category_code,
+                   bm25(transactions_fts, 1.0, 0.0)
+            FROM transactions_fts
+            JOIN transactions AS t ON t.id = transactions_fts.rowid
+            WHERE transactions_fts MATCH ?
+            ORDER BY bm25(transactions_fts, 1.0, 0.0), t.id
+            LIMIT ?
+            """,
+            (match, limit),
+        ).fetchall()
+        return [
+            (Transaction._from_db_row(row[:5], account_book_id), -row[5])
+            for row in rows
+        ]
+
+    @staticmethod
+    def get_transaction_page(
+        conn: sqlite3.Connection,
+        token: str,
+        account_book_id: int,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        note: Optional[str] = None,
+        after: Optional[Tuple[int, int]] = None,
+        limit: int = 200,
+    ) -> Tuple[List[Transaction], Optional[Tuple[int, int]]]:
+        """
+        One page of get_transaction_list, ordered by (time, id).
+
+        Keyset pagination: ``after`` is the (time_epoch, id) of the last row of
+        the previous page, the next page starts right after it through the
+        (account_book_id, time_epoch) index, so every page costs the same no matter
+        how deep the client has scrolled.
+
+        Returns:
+            (transactions, key of the last row or None when this was the last page)
+        """
+        AccountBook.check_access(conn, token, account_book_id)
+        if end_time is None:
+            end_time = datetime.now()
+
+        sql = """
+            SELECT t.id, t.amount_minor, t.time_epoch, t.note, t.category_code
+            FROM transactions AS t
+            WHERE t.account_book_id = ?
+              AND t.time_epoch <= ?
+        """
+        params: List = [account_book_id, datetime_to_epoch(end_time)]
+        if start_time is not None:
+            sql += " AND t.time_epoch >= ?"
+            params.append(datetime_to_epoch(start_time))
+        if after is not None:
+            sql += " AND (t.time_epoch, t.id) > (?, ?)"
+            params.extend(after)
+        if note is not None:
+            sql += " AND t.note LIKE ?"
+            params.append(f"%{note}%")
+        # one extra row tells whether another page exists
+        sql += " ORDER BY t.time_epoch ASC, t.id ASC LIMIT ?"
+        params.append(limit + 1)
         rows = conn.execute(sql, params).fetchall()
-        result: List[Transaction] = []
-        for row in rows:
-            tx_id, amount, t_time, t_note, t_category = row
-            if t_category is None:
-                category_enum = None
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_key = (rows[-1][2], rows[-1][0]) if has_more else None
+        return [
+            Transaction._from_db_row(row, account_book_id) for row in rows
+        ], next_key
+
+    @staticmethod
+    def get_summary(
+        conn: sqlite3.Connection,
+        token: str,
+        account_book_id: int,
+        bucket: str = "month",
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+    ) -> List[SummaryRow]:
+        """
+        Income / outcome totals per category per time bucket (day, week, month
+        or year), aggregated by SQL so only one row per bucket and category
+        leaves the db. Month and year buckets read the whole months of the range
+        from book_monthly_rollups and only scan transactions for the partial
+        months at its edges, days and weeks are summed from the
+        (account_book_id, time_epoch) range.
+        Token is verified and book ownership checked. By default, the whole book.
+
+        Returns:
+            SummaryRows ordered by bucket, then category code.
+        """
+        if bucket not in SUMMARY_BUCKETS:
+            raise ValueError(f"unknown summary bucket '{bucket}'")
+        AccountBook.check_access(conn, token, account_book_id)
+        start = None if start_time is None else datetime_to_epoch(start_time)
+        end = None if end_time is None else datetime_to_epoch(end_time)
+
+        # (bucket, category_code or 0) -> [total_minor, count]
+        totals: Dict[Tuple[str, int], List[int]] = {}
+
+        def collect(rows: Iterable[Tuple[str, int, int, int]]) -> None:
+            for day, code, total_minor, count in rows:
+                acc = totals.setdefault((day, code), [0, 0])
+                acc[0] += total_minor
+                acc[1] += count
+
+        if bucket in ("month", "year"):
+            # whole months: [first_full, last_full_end)
+            first_full = None if start is None else _month_ceil(start)
+            last_full_end = None if end is None else _month_floor(end + 1)
+            if (
+                first_full is not None
+                and last_full_end is not None
+                and first_full >= last_full_end
+            ):
+                # the range lies inside one month
+                collect(_summary_scan(conn, account_book_id, bucket, start, end))
             else:
-                category_name: str = t_category
-                if amount >= 0:
-                    category_enum = IncomeType[category_name]
-                else:
-                    category_enum = OutcomeType[category_name]
+                collect(
+                    _summary_rollups(
+                        conn, account_book_id, bucket, first_full, last_full_end
+                    )
+                )
+                if start is not None and start < first_full:
+                    collect(
+                        _summary_scan(
+                            conn, account_book_id, bucket, start, first_full - 1
+                        )
+                    )
+                if end is not None and last_full_end <= end:
+                    collect(
+                        _summary_scan(conn, account_book_id, bucket, last_full_end, end)
+                    )
+        else:
+            collect(_summary_scan(conn, account_book_id, bucket, start, end))
+
+        result = []
+        for (day, code), (total_minor, count) in sorted(totals.items()):
+            category = CATEGORY_BY_CODE.get(code)
             result.append(
-                Transaction(
-                    amount=amount,
-                    account_book_id=account_book_id,
-                    time=datetime.fromisoformat(t_time),
-                    note=t_note,
-                    category=category_enum,
-                    id=tx_id,
+                SummaryRow(
+                    bucket=day,
+                    category=None if category is None else category.name,
+                    income=(
+                        isinstance(category, IncomeType)
+                        if category is not None
+                        else total_minor >= 0
+                    ),
+                    total=total_minor / MINOR_UNITS,
+                    count=count,
                 )
             )
         return result
 
     def get_balance(self, conn: sqlite3.Connection) -> float:
         """
-        Calculate the current balance of the account book (sum of all transaction amounts).
+        Current balance of the account book (sum of all transaction amounts),
+        read from the trigger maintained book_balances table.
         """
-        all_tx = Transaction.execute_db_query(conn, account_book_id=self._id)
-        if not all_tx:
-            return 0.0
-        total = sum(tx.amount for tx in all_tx)
-        return total
+        row = conn.execute(
+            "SELECT balance_minor FROM book_balances WHERE account_book_id = ?",
+            (self._id,),
+        ).fetchone()
+        return 0.0 if row is None else row[0] / MINOR_UNITS
 
+    @staticmethod
+    def list_book_stats(conn: sqlite3.Connection, token: str) -> List[BookStats]:
+        """
+        List the books of the token's account with balance, transaction count and
+        time of the latest transaction, in one statement: balance and count come
+        from book_balances, the latest time is an index lookup per book on
+        (account_book_id, time_epoch), so the cost does not grow with the ledger size.
+        """
+        account_id = _resolve_token(conn, token)
+        rows = conn.execute(
+            """
+            SELECT ab.account_book_id,
+                   ab.name,
+                   COALESCE(bb.balance_minor, 0),
+                   COALESCE(bb.tx_count, 0),
+                   (SELECT MAX(t.time_epoch)
+                    FROM transactions AS t
+                    WHERE t.account_book_id = ab.account_book_id)
+            FROM account_books AS ab
+            LEFT JOIN book_balances AS bb ON bb.account_book_id = ab.account_book_id
+            WHERE ab.account_id = ?
+            ORDER BY ab.account_book_id
+            """,
+            (account_id,),
+        ).fetchall()
+        # a complete listing of the account, as good as _load_books for the cache
+        ownership_cache.set_books(account_id, (r[0] for r in rows))
+        return [
+            BookStats(
+                book_id,
+                name,
+                balance_minor / MINOR_UNITS,
+                tx_count,
+                None if last is None else epoch_to_datetime(last).isoformat(),
+            )
+            for book_id, name, balance_minor, tx_count, last in rows
+        ]
 
-def init() -> Tuple[sqlite3.Connection, sqlite3.Cursor]:
-    conn = sqlite3.connect(DB_PATH)
+    @staticmethod
+    def check_balances(
+        conn: sqlite3.Connection,
+    ) -> List[Tuple[int, Optional[int], int, Optional[int], int]]:
+        """
+        Compare book_balances with the sums recomputed from transactions,
+        exactly: both are integer minor units.
+
+        Returns:
+            List of (account_book_id, stored balance, actual balance,
+            stored count, actual count) for every book that drifted, balances
+            in minor units.
+        """
+        rows = conn.execute("""
+            SELECT ab.account_book_id,
+                   bb.balance_minor,
+                   COALESCE(SUM(t.amount_minor), 0),
+                   bb.tx_count,
+                   COUNT(t.id)
+            FROM account_books AS ab
+            LEFT JOIN book_balances AS bb ON bb.account_book_id = ab.account_book_id
+            LEFT JOIN transactions AS t ON t.account_book_id = ab.account_book_id
+            GROUP BY ab.account_book_id
+        """).fetchall()
+        return [
+            (book_id, stored, actual, stored_count, actual_count)
+            for book_id, stored, actual, stored_count, actual_count in rows
+            if stored != actual or stored_count != actual_count
+        ]
+
+    @staticmethod
+    def rebuild_balances(
+        conn: sqlite3.Connection, account_book_id: Optional[int] = None
+    ) -> int:
+        """
+        Recompute book_balances from transactions, for one book or all of them.
+
+        Returns:
+            int: the number of books rewritten.
+        """
+        sql = """
+            INSERT OR REPLACE INTO book_balances (account_book_id, balance_minor, tx_count)
+            SELECT ab.account_book_id, COALESCE(SUM(t.amount_minor), 0), COUNT(t.id)
+            FROM account_books AS ab
+            LEFT JOIN transactions AS t ON t.account_book_id = ab.account_book_id
+        """
+        params: List = []
+        if account_book_id is not None:
+            sql += " WHERE ab.account_book_id = ?"
+            params.append(account_book_id)
+        sql += " GROUP BY ab.account_book_id"
+        cur = conn.execute(sql, params)
+        conn.commit()
+        return cur.rowcount
+
+    @staticmethod
+    def check_rollups(
+        conn: sqlite3.Connection,
+    ) -> List[Tuple[int, str, int, Optional[int], Optional[int], int, int]]:
+        """
+        Compare book_monthly_rollups with the sums recomputed from transactions.
+
+        Returns:
+            List of (account_book_id, month, category_code, stored total,
+            actual total, stored count, actual count) for every rollup row that
+            drifted, missing on either side counts as None / 0; totals in minor units.
+        """
+        return conn.execute("""
+            WITH actual AS (
+                SELECT account_book_id,
+                       date(time_epoch, 'unixepoch', 'start of month') AS month,
+                       COALESCE(category_code, 0) AS category_code,
+                       SUM(amount_minor) AS total_minor,
+                       COUNT(*) AS tx_count
+                FROM transactions
+                GROUP BY 1, 2, 3
+            )
+            SELECT r.account_book_id, r.month, r.category_code,
+                   r.total_minor, a.total_minor,
+                   r.tx_count, COALESCE(a.tx_count, 0)
+            FROM book_monthly_rollups AS r
+            LEFT JOIN actual AS a
+              ON a.account_book_id = r.account_book_id
+             AND a.month = r.month
+             AND a.category_code = r.category_code
+            WHERE a.total_minor IS NOT r.total_minor OR a.tx_count IS NOT r.tx_count
+            UNION ALL
+            SELECT a.account_book_id, a.month, a.category_code,
+                   NULL, a.total_minor, 0, a.tx_count
+            FROM actual AS a
+            WHERE NOT EXISTS (
+                SELECT 1 FROM book_monthly_rollups AS r
+                WHERE r.account_book_id = a.account_book_id
+                  AND r.month = a.month
+                  AND r.category_code = a.category_code
+            )
+            ORDER BY 1, 2, 3
+        """).fetchall()
+
+    @staticmethod
+    def rebuild_rollups(
+        conn: sqlite3.Connection, account_book_id: Optional[int] = None
+    ) -> int:
+        """
+        Recompute book_monthly_rollups from transactions, for one book or all
+        of them, in one transaction.
+
+        Returns:
+            int: the number of rollup rows written.
+        """
+        where = ""
+        params: List = []
+        if account_book_id is not None:
+            where = " WHERE account_book_id = ?"
+            params.append(account_book_id)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM book_monthly_rollups" + where, params)
+            cur = conn.execute(
+                """
+                INSERT INTO book_monthly_rollups
+                    (account_book_id, month, category_code, total_minor, tx_count)
+                SELECT account_book_id,
+                       date(time_epoch, 'unixepoch', 'start of month'),
+                       COALESCE(category_code, 0),
+                       SUM(amount_minor),
+                       COUNT(*)
+                FROM transactions
+                """
+                + where
+                + " GROUP BY 1, 2, 3",
+                params,
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return cur.rowcount
+
+
+def connect(
+    db_path: Optional[Path] = None, profile: Optional[StorageProfile] = None
+) -> sqlite3.Connection:
+    """
+    Open a new connection to the database file and apply the storage profile
+    (journal mode, synchronous level, cache / mmap size ...) selected at startup.
+    The connection may be used from the worker thread it is handed to, so the
+    sqlite3 same-thread check is disabled; the pool guarantees one user at a time.
+    """
+    if profile is None:
+        profile = get_storage_profile(STORAGE_PROFILE)
+    conn = sqlite3.connect(
+        DB_PATH if db_path is None else db_path, check_same_thread=False
+    )
     conn.execute("PRAGMA foreign_keys = ON")
+    # only takes effect on a new, empty file (before journal_mode = WAL writes
+    # its header): the free pages of such a database are given back in slices
+    # by the maintenance sweeper; older files keep their mode until
+    # ``python maintenance.py vacuum`` converts them
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    profile.apply(conn)
+    return conn
+
+
+def init(
+    conn: Optional[sqlite3.Connection] = None,
+) -> Tuple[sqlite3.Connection, sqlite3.Cursor]:
+    if conn is None:
+        conn = connect()
     cursor = conn.cursor()
 
-    # Create tables (with updated schema):
-    # transactions table (uses single 'category' field instead of income_type/outcome_type)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS transactions (
-        id              INTEGER PRIMARY KEY AUTOINCREMENT,
-        account_book_id INTEGER NOT NULL,
-        amount          REAL    NOT NULL,
-        time            TEXT    NOT NULL,
-        note            TEXT,
-        category        TEXT,
-        FOREIGN KEY (account_book_id)
-            REFERENCES account_books(account_book_id)
-            ON DELETE CASCADE
-    )
-    """)
-
-    # account_books table (no ON DELETE CASCADE on account_id foreign key)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS account_books (
-        account_book_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name            TEXT NOT NULL,
-        account_id      INTEGER NOT NULL,
-        FOREIGN KEY (account_id)
-            REFERENCES accounts(account_id)
-    )
-    """)
-
-    # accounts table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS accounts (
-        account_id    INTEGER PRIMARY KEY AUTOINCREMENT,
-        name          TEXT    NOT NULL UNIQUE,
-        email         TEXT    NOT NULL UNIQUE,
-        pwd           TEXT    NOT NULL,        
-        token         TEXT    NOT NULL,
-        token_expire  INTEGER 
-    );""")
-
-    # linking table for accounts and account_books (for future multi-user support)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS account_with_account_books (
-        account_id      INTEGER NOT NULL,
-        account_book_id INTEGER NOT NULL,
-        PRIMARY KEY (account_id, account_book_id),
-        FOREIGN KEY (account_id)
-            REFERENCES accounts(account_id) ON DELETE CASCADE,
-        FOREIGN KEY (account_book_id)
-            REFERENCES account_books(account_book_id) ON DELETE CASCADE
+    # tables and indexes are created / upgraded by the versioned migrations
+    version = migrate(conn)
+    logging.info(
+        "Database initialized successfully (schema v%s, journal_mode=%s).",
+        version,
+        conn.execute("PRAGMA journal_mode").fetchone()[0],
     )
-    """)
-
-    # (Removed account_books_with_transactions table as it was redundant)
-
-    conn.commit()
-    logging.info("Database initialized successfully.")
     return conn, cursor
 
 
@@ -804,5 +1704,13 @@ def delete_all():
     cursor.execute("DROP TABLE IF EXISTS account_books")
     cursor.execute("DROP TABLE IF EXISTS accounts")
     cursor.execute("DROP TABLE IF EXISTS account_with_account_books")
+    cursor.execute("DROP TABLE IF EXISTS book_balances")
+    cursor.execute("DROP TABLE IF EXISTS book_monthly_rollups")
+    cursor.execute("DROP TABLE IF EXISTS transactions_fts")
+    cursor.execute("DROP TABLE IF EXISTS revoked_tokens")
+    cursor.execute("DROP TABLE IF EXISTS sessions")
+    cursor.execute("DROP TABLE IF EXISTS change_log")
+    cursor.execute("DROP TABLE IF EXISTS idempotency_keys")
+    cursor.execute("DROP TABLE IF EXISTS schema_version")
     # Note: account_books_with_transactions table is not present anymore
     conn.close()
@@ -0,0 +1,126 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, TypeVar
+
+from db_pool import ConnectionPool
+
+T = TypeVar("T")
+
+
+class _LatencyWindow:
+    """Keeps the last ``size`` samples (seconds) to report mean / p50 / p99 / max."""
+
+    def __init__(self, size: int = 2048) -> None:
+        self._samples: Deque[float] = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value: float) -> None:
+        self._samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def snapshot(self) -> Dict[str, float]:
+        samples = sorted(self._samples)
+        if not samples:
+            return {
+                "count": 0,
+                "mean_ms": 0.0,
+                "p50_ms": 0.0,
+                "p99_ms": 0.0,
+                "max_ms": 0.0,
+            }
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000,
+            "p50_ms": samples[len(samples) // 2] * 1000,
+            "p99_ms": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+            "max_ms": samples[-1] * 1000,
+        }
+
+
+class DBExecutor:
+    """
+    Runs the blocking db_api calls on a dedicated thread pool so that the event
+    loop is never stuck behind a slow query.
+
+    Every job checks out its own connection from ``pool`` inside the worker
+    thread and receives it as first positional argument, which matches the
+    ``(conn, ...)`` signature of the Account / AccountBook / Transaction methods:
+
+        acc = await db.run(Account.login, name_or_email=..., pwd_hash=...)
+    """
+
+    def __init__(self, pool: ConnectionPool, max_workers: int = 8) -> None:
+        if max_workers < 1:
+            raise ValueError("max_workers of the db executor should be >= 1")
+        self._pool = pool
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="coinverse-db"
+        )
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._max_queued = 0
+        self._failed = 0
+        self._wait = _LatencyWindow()
+        self._run = _LatencyWindow()
+
+    async def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Execute ``fn(conn, *args, **kwargs)`` on a worker thread and await the result."""
+        enqueued_at = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+        future = self._executor.submit(self._call, fn, enqueued_at, args, kwargs)
+        future.add_done_callback(self._on_done)
+        return await asyncio.wrap_future(future)
+
+    def _call(
+        self,
+        fn: Callable[..., T],
+        enqueued_at: float,
+        args: tuple,
+        kwargs: Dict[str, Any],
+    ) -> T:
+        started_at = time.perf_counter()
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._wait.add(started_at - enqueued_at)
+        try:
+            with self._pool.connection() as conn:
+                return fn(conn, *args, **kwargs)
+        except BaseException:
+            with self._lock:
+                self._failed += 1
+            raise
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._run.add(time.perf_counter() - started_at)
+
+    def _on_done(self, future: Future) -> None:
+        # a job cancelled while still queued never reaches _call
+        if future.cancelled():
+            with self._lock:
+                self._queued -= 1
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "queue_depth": self._queued,
+                "max_queue_depth": self._max_queued,
+                "running": self._running,
+                "failed": self._failed,
+                "wait": self._wait.snapshot(),
+                "run": self._run.snapshot(),
+            }
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,172 @@
+import sqlite3
+import threading
+import time
+import logging
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, Optional, Tuple
+
+from cus_exceptions import DBPoolClosedError, DBPoolExhaustedError
+
+
+class ConnectionPool:
+    """
+    A bounded pool of sqlite3 connections.
+
+    Connections are opened lazily up to ``max_size``; once every connection is
+    checked out, ``checkout`` blocks until one is returned or ``timeout`` runs
+    out. Idle connections that have not been used for ``health_check_interval``
+    seconds are pinged before they are handed out again, broken ones are
+    dropped and replaced.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], sqlite3.Connection],
+        max_size: int = 8,
+        timeout: float = 10.0,
+        health_check_interval: float = 30.0,
+    ) -> None:
+        """
+        Args:
+            connect: factory opening a new, fully configured connection.
+            max_size: max number of connections opened at the same time.
+            timeout: default seconds ``checkout`` waits for a free connection.
+            health_check_interval: idle seconds after which a connection is pinged.
+        """
+        if max_size < 1:
+            raise ValueError("max_size of the connection pool should be >= 1")
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        # (connection, last time it was returned to the pool)
+        self._idle: Deque[Tuple[sqlite3.Connection, float]] = deque()
+        self._opened = 0
+        self._in_use = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    # ------------------------- checkout / checkin ------------------------- #
+    def checkout(self, timeout: Optional[float] = None) -> sqlite3.Connection:
+        """
+        Borrow a connection from the pool, it must be given back by ``checkin``.
+        Raises DBPoolExhaustedError if no connection is free within ``timeout``.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise DBPoolClosedError("Connection pool is closed.")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._opened < self.max_size:
+                    # reserve the slot now, the connection is opened outside the lock
+                    self._opened += 1
+                    self._in_use += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DBPoolExhaustedError(
+                        f"No free database connection within {timeout:.1f}s "
+                        f"(pool size {self.max_size})."
+                    )
+                self._cond.wait(remaining)
+
+        try:
+            if conn is None:
+                return self._connect()
+            if (
+                last_used is not None
+                and time.monotonic() - last_used > self.health_check_interval
+                and not self._is_healthy(conn)
+            ):
+                logging.warning("Dropping unhealthy pooled sqlite connection.")
+                self._close_quietly(conn)
+                return self._connect()
+            return conn
+        except BaseException:
+            self._release_slot()
+            raise
+
+    def checkin(self, conn: sqlite3.Connection) -> None:
+        """
+        Give a connection back to the pool. Unfinished transactions are rolled back,
+        a connection that can not be reset is closed instead of being reused.
+        """
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            logging.warning("Failed to reset pooled sqlite connection, discarding it.")
+            self.discard(conn)
+            return
+        with self._cond:
+            self._in_use -= 1
+            if self._closed:
+                self._opened -= 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def discard(self, conn: sqlite3.Connection) -> None:
+        """Close a checked out connection and free its slot in the pool."""
+        self._close_quietly(conn)
+        self._release_slot()
+
+    @contextmanager
+    def connection(
+        self, timeout: Optional[float] = None
+    ) -> Iterator[sqlite3.Connection]:
+        """Context manager version of checkout / checkin."""
+        conn = self.checkout(timeout)
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    # ------------------------- lifecycle / info ------------------------- #
+    def close(self) -> None:
+        """Close every idle connection, busy ones are closed when checked in."""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._opened -= 1
+                self._close_quietly(conn)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "max_size": self.max_size,
+                "opened": self._opened,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+            }
+
+    def _release_slot(self) -> None:
+        with self._cond:
+            self._opened -= 1
+            self._in_use -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _is_healthy(conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn: sqlite3.Connection) -> None:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
@@ -1,8 +1,12 @@
+import asyncio
+import hashlib
+import json
+from contextlib import asynccontextmanager
 from datetime import datetime
 
 # fast api
 from fastapi import FastAPI
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, Header, HTTPException, status
 
 # fastapi response model
 from fastapi_req_resp_type import (
@@ -12,6 +16,7 @@ from fastapi_req_resp_type import (
     AddOutcomeResponse,
     BookDetailResponse,
     BookDetailRequest,
+    BookSummary,
     ChangePasswordResponse,
     CreateAccountBookRequest,
     CreateAccountBookResponse,
@@ -30,11 +35,73 @@ from fastapi_req_resp_type import (
     ChangePasswordRequest,
     LogoutRequest,
     LogoutResponse,
+    DBMetricsResponse,
+    MaintenanceMetricsResponse,
+    BulkImportRequest,
+    BulkImportResponse,
+    BulkImportError,
+    BookDetailPageRequest,
+    BookDetailPageResponse,
+    BookSummaryRequest,
+    SearchTransactionsRequest,
+    SyncRequest,
+    OpsBatchRequest,
+    OpsBatchResponse,
+    OpResultItem,
+    SyncResponse,
+    SyncBookItem,
+    SyncTransactionItem,
+    SearchTransactionsResponse,
+    SearchHitItem,
+    BookSummaryResponse,
+    SummaryBucketItem,
+    AnalyticsRequest,
+    RollingAverageRequest,
+    RollingAverageResponse,
+    CategoryPercentilesRequest,
+    CategoryPercentileItem,
+    CategoryPercentilesResponse,
+    BalanceCurveResponse,
+    TransactionItem,
 )
 
 # the databse shits
-from sqlite3 import Connection, IntegrityError
-from db_api import Account, AccountBook, Transaction, init
+from sqlite3 import IntegrityError
+from db_api import Account, AccountBook, Transaction, connect, init
+from db_api import last_seen, ownership_cache, revocations, session_cache
+from db_pool import ConnectionPool
+from db_executor import DBExecutor
+from config import (
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_POOL_HEALTH_CHECK_INTERVAL,
+    DB_EXECUTOR_WORKERS,
+    LEDGER_BACKEND,
+    BULK_IMPORT_CHUNK_SIZE,
+    BULK_IMPORT_MAX_ERRORS,
+    BOOK_DETAIL_STREAM_PAGE_SIZE,
+    SESSION_LAST_SEEN_FLUSH,
+    SESSION_PURGE_INTERVAL,
+    SWEEP_ANALYSIS_LIMIT,
+    SWEEP_ANALYZE_INTERVAL,
+    SWEEP_BATCH,
+    SWEEP_INTERVAL,
+    SWEEP_MAX_SLICES,
+    SWEEP_VACUUM_PAGES,
+    WRITE_BATCH,
+    WRITE_BATCH_MAX_DELAY,
+    WRITE_BATCH_MAX_ROWS,
+)
+import analytics
+import passwords
+from passwords import PasswordHasher
+import bulk_import
+import ops_batch
+import idempotency
+import sweeper
+from write_batcher import WriteBatcher
+from ledger_backend import get_ledger_backend
+from sweeper import SweepJob, Sweeper
 from db_api import IncomeType, OutcomeType
 
 # the custom exceptions
@@ -54,14 +121,22 @@ from cus_exceptions import (
     PwdNotMatchError,
     TokenNotFoundError,
     AccessDenialAccountBookError,
+    DBPoolExhaustedError,
+    InvalidCursorError,
+    AnalyticsUnavailableError,
+    PasswordHasherBusyError,
+    IdempotencyKeyConflictError,
+    IdempotencyKeyInProgressError,
+    LedgerBackendUnavailableError,
+    BulkImportInterruptedError,
 )
 
 import logging
 
-from utils import verify_email_format, str_to_datetime
+from utils import verify_email_format, str_to_datetime, encode_cursor, decode_cursor
 
-from typing import Dict, Type
-from fastapi.responses import JSONResponse
+from typing import AsyncIterator, Dict, Type
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi import Request
 
 # 1️⃣  把所有自定义异常 → code 映射集中在这里
@@ -82,6 +157,14 @@ EXC_CODE_MAP: Dict[Type[Exception], int] = {
     InvalidOutcomeIncomeValueError: 1014,
     LoginFailedError: 1015,
     AccessDenialAccountBookError: 1016,
+    DBPoolExhaustedError: 1017,
+    InvalidCursorError: 1018,
+    AnalyticsUnavailableError: 1019,
+    PasswordHasherBusyError: 1020,
+    IdempotencyKeyConflictError: 1021,
+    IdempotencyKeyInProgressError: 1022,
+    LedgerBackendUnavailableError: 1023,
+    BulkImportInterruptedError: 1024,
     # ……需要时继续往下加
 }
 
@@ -92,12 +175,78 @@ logging.basicConfig(
     format="[%(asctime)s - %(name)s - %(levelname)s] - %(message)s",
 )
 
-conn: Connection
-conn, _ = init()
+# every db job borrows its own connection from the pool instead of sharing one
+pool = ConnectionPool(
+    connect,
+    max_size=DB_POOL_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL,
+)
+with pool.connection() as _init_conn:
+    init(_init_conn)
+# blocking db_api calls never run on the event loop, they all go through here
+db = DBExecutor(pool, max_workers=DB_EXECUTOR_WORKERS)
+# password KDF, in worker processes
+hasher = PasswordHasher()
+# accounts, sessions, books and transactions, sqlite through ``db`` or postgres
+ledger = get_ledger_backend(LEDGER_BACKEND, db.run)
+if WRITE_BATCH and ledger.name != "sqlite":
+    logging.warning(
+        f"COINVERSE_WRITE_BATCH is ignored by the {ledger.name} ledger backend."
+    )
+# group commit of add_income / add_outcome, optional
+batcher = (
+    WriteBatcher(db.run, max_rows=WRITE_BATCH_MAX_ROWS, max_delay=WRITE_BATCH_MAX_DELAY)
+    if WRITE_BATCH and ledger.name == "sqlite"
+    else None
+)
+# periodic purges / vacuum / ANALYZE, started by the lifespan
+maintenance = Sweeper(
+    db.run,
+    [
+        SweepJob("last_seen", Account.flush_last_seen, SESSION_LAST_SEEN_FLUSH),
+        SweepJob(
+            "sessions", Account.purge_sessions, SESSION_PURGE_INTERVAL, SWEEP_BATCH
+        ),
+        SweepJob(
+            "revoked_tokens", sweeper.purge_revoked_tokens, SWEEP_INTERVAL, SWEEP_BATCH
+        ),
+        SweepJob(
+            "orphan_links", sweeper.purge_orphan_links, SWEEP_INTERVAL, SWEEP_BATCH
+        ),
+        SweepJob(
+            "change_log",
+            Account.prune_change_log,
+            SWEEP_INTERVAL,
+            SWEEP_BATCH,
+        ),
+        SweepJob("idempotency_keys", idempotency.purge, SWEEP_INTERVAL, SWEEP_BATCH),
+        SweepJob(
+            "incremental_vacuum",
+            sweeper.incremental_vacuum,
+            SWEEP_INTERVAL,
+            SWEEP_VACUUM_PAGES,
+        ),
+        SweepJob(
+            "optimize",
+            sweeper.make_optimize(SWEEP_ANALYSIS_LIMIT),
+            SWEEP_ANALYZE_INTERVAL,
+        ),
+    ],
+    max_slices=SWEEP_MAX_SLICES,
+)
 
 router: APIRouter = APIRouter(prefix="/CoinVerse", tags=["interfaces"])
 
 
+def _require_sqlite_ledger() -> None:
+    """For the routes reading the sqlite ledger tables directly."""
+    if ledger.name != "sqlite":
+        raise LedgerBackendUnavailableError(
+            f"Not available with the {ledger.name} ledger backend."
+        )
+
+
 @router.post(
     "/register",
     response_model=RegisterResponse,
@@ -105,7 +254,11 @@ router: APIRouter = APIRouter(prefix="/CoinVerse", tags=["interfaces"])
     summary="create new user account",
 )
 async def register_user(data: RegisterRequest) -> RegisterResponse:
-    Account.register(conn, name=data.name, email=data.email, pwd_hash=data.pwd_hash)
+    await ledger.register(
+        name=data.name,
+        email=data.email,
+        pwd_hash=await hasher.hash(data.pwd_hash),
+    )
     logging.info(f"User {data.name} registered successfully.")
     return RegisterResponse(success=True, msg="User registered successfully.")
 
@@ -116,32 +269,40 @@ async def register_user(data: RegisterRequest) -> RegisterResponse:
     summary="name / email + pwd to login, return the token",
 )
 async def login(data: LoginRequest) -> LoginResponse:
-    temp_acc = Account.login(
-        conn=conn,
-        name_or_email=data.name_or_email,
-        pwd_hash=data.pwd_hash,
-    )
-    if temp_acc is None:
+    # db lookup, KDF in the hasher pool, db update: no step holds both a db
+    # connection and a CPU for the duration of the hash
+    credentials = await ledger.get_credentials(data.name_or_email)
+    # an unknown account is verified against a dummy hash to take the same time
+    stored = credentials[1] if credentials is not None else passwords.DUMMY_HASH
+    ok, rehashed = await hasher.verify_and_upgrade(data.pwd_hash, stored)
+    if credentials is None:
         logging.error("Login failed, unkown error: returned Account is None")
         raise LoginFailedError("login failed, unknown error with Account is None")
-    return LoginResponse(
-        success=True, msg="Login successful", access_token=temp_acc.token
+    if not ok:
+        raise PwdNotMatchError(
+            "Invalid password hash code, consider using wrong password or hash compute error"
+        )
+    token = await ledger.complete_login(
+        account_id=credentials[0],
+        old_hash=stored,
+        rehashed=rehashed,
     )
+    return LoginResponse(success=True, msg="Login successful", access_token=token)
 
 
 @router.post(
     "/refresh_token", response_model=RefreshTokenResponse, summary="refresh the token"
 )
 async def refresh_token(data: RefreshTokenRequest) -> RefreshTokenResponse:
-    temp_acc = Account.refresh_token(conn=conn, old_token=data.old_token)
-    if temp_acc is None:
+    token = await ledger.refresh_token(data.old_token)
+    if token is None:
         raise TokenExpireException(
             "Invalid or expired token",
         )
     return RefreshTokenResponse(
         sucess=True,
         expired=False,
-        access_token=temp_acc.token,
+        access_token=token,
         msg="successfully update the token",
     )
 
@@ -152,7 +313,7 @@ async def refresh_token(data: RefreshTokenRequest) -> RefreshTokenResponse:
     summary="logout, invalidate the token (expire it)",
 )
 async def logout(data: LogoutRequest) -> LogoutResponse:
-    status = Account.logout(conn=conn, token=data.old_token)
+    status = await ledger.logout(data.old_token)
     return LogoutResponse(
         success=status, msg="Logout successful" if status else "Logout failed"
     )
@@ -162,12 +323,12 @@ async def logout(data: LogoutRequest) -> LogoutResponse:
     "/users/me", response_model=GetUserProfileResponse, summary="get the user info"
 )
 async def get_profile(data: GetUserProfileRequest) -> GetUserProfileResponse:
-    temp_account = Account.get_profile(conn=conn, token=data.token)
+    profile = await ledger.get_profile(data.token)
     return GetUserProfileResponse(
         success=True,
         msg="Profile retrieved successfully",
-        name=temp_account.name,
-        email=temp_account.email,
+        name=profile.name,
+        email=profile.email,
     )
 
 
@@ -182,11 +343,16 @@ async def change_password(data: ChangePasswordRequest) -> ChangePasswordResponse
         return ChangePasswordResponse(
             success=False, msg="Old password and new password cannot be the same"
         )
-    Account.change_pwd(
-        conn=conn,
-        email_or_name=data.name_or_email,  # pyright: ignore[reportArgumentType] # it has been checked before this line
-        old_pwd_hash=data.old_pwd_hash,
-        new_pwd_hash=data.new_pwd_hash,
+    credentials = await ledger.get_credentials(
+        data.name_or_email,  # pyright: ignore[reportArgumentType] # it has been checked before this line
+    )
+    if credentials is None or not await hasher.verify(
+        data.old_pwd_hash, credentials[1]
+    ):
+        raise PasswordWrongError
+    await ledger.set_password(
+        account_id=credentials[0],
+        new_hash=await hasher.hash(data.new_pwd_hash),
     )
     return ChangePasswordResponse(success=True, msg="Password changed successfully")
 
@@ -197,7 +363,7 @@ async def change_password(data: ChangePasswordRequest) -> ChangePasswordResponse
     summary="create a new account book (need token)",
 )
 async def create_acc_book(data: CreateAccountBookRequest) -> CreateAccountBookResponse:
-    Account.create_book(conn=conn, token=data.token, book_name=data.book_name)
+    await ledger.create_book(data.token, data.book_name)
     return CreateAccountBookResponse(
         success=True, code=0, msg="Book created successfully"
     )
@@ -209,7 +375,7 @@ async def create_acc_book(data: CreateAccountBookRequest) -> CreateAccountBookRe
     summary="list the books in the account (need token)",
 )
 async def list_acc_book(data: ListBookRequest) -> ListBookResponse:
-    temp_acc_books_list = Account.list_books(conn=conn, token=data.token)
+    temp_acc_books_list = await ledger.list_books(data.token)
     if len(temp_acc_books_list) == 0:
         logging.info("No books found for the account")
         return ListBookResponse(success=True, code=0, msg="No books found", books=[])
@@ -220,13 +386,17 @@ async def list_acc_book(data: ListBookRequest) -> ListBookResponse:
             code=0,
             msg="Books found",
             books=[
-                {
-                    single_book._id: (
-                        single_book.name,
-                        single_book.get_balance(conn=conn),
-                    )
-                }
-                for single_book in temp_acc_books_list
+                {book.id: (book.name, book.balance)} for book in temp_acc_books_list
+            ],
+            book_summaries=[
+                BookSummary(
+                    book_id=book.id,
+                    name=book.name,
+                    balance=book.balance,
+                    transaction_count=book.tx_count,
+                    last_activity=book.last_time,
+                )
+                for book in temp_acc_books_list
             ],
         )
 
@@ -237,7 +407,7 @@ async def list_acc_book(data: ListBookRequest) -> ListBookResponse:
     summary="remove the book by book_id (need token)",
 )
 async def remove_book(data: RemoveBookRequest) -> RemoveBookResponse:
-    Account.remove_account_book(conn=conn, token=data.token, book_id=data.book_id)
+    await ledger.remove_book(data.token, data.book_id)
     return RemoveBookResponse(success=True, code=0, msg="Book removed successfully")
 
 
@@ -255,8 +425,7 @@ async def get_book_detail(data: BookDetailRequest) -> BookDetailResponse:
     )
 
     temp_note = None if len(data.note) == 0 else data.note
-    temp = AccountBook.get_transaction_list(
-        conn=conn,
+    temp = await ledger.get_transaction_rows(
         token=data.token,
         account_book_id=data.account_book_id,
         start_time=temp_start_time,
@@ -268,13 +437,257 @@ async def get_book_detail(data: BookDetailRequest) -> BookDetailResponse:
         code=0,
         msg="Success",
         transactions=[
-            {tx.id: (str(tx.category.name), tx.note, tx.amount)}
-            for tx in temp
-            if tx.id is not None and tx.category is not None
+            {row.id: (row.category, row.note, row.amount)}
+            for row in temp
+            if row.category is not None
+        ],
+    )
+
+
+def _transaction_item(tx: Transaction) -> TransactionItem:
+    return TransactionItem(
+        id=tx.id,
+        category=tx.category.name if tx.category is not None else "",
+        note=tx.note,
+        amount=tx.amount,
+        time=tx.time.isoformat(),
+    )
+
+
+@router.post(
+    "/books_detail/page",
+    response_model=BookDetailPageResponse,
+    summary="one page of the book detail, keyset cursor on (time, id) (need token)",
+)
+async def get_book_detail_page(data: BookDetailPageRequest) -> BookDetailPageResponse:
+    txs, next_key = await ledger.get_transaction_page(
+        token=data.token,
+        account_book_id=data.account_book_id,
+        start_time=str_to_datetime(data.start_time) if data.start_time else None,
+        end_time=str_to_datetime(data.end_time) if data.end_time else None,
+        note=data.note or None,
+        after=decode_cursor(data.cursor) if data.cursor else None,
+        limit=data.limit,
+    )
+    return BookDetailPageResponse(
+        success=True,
+        code=0,
+        msg="Success",
+        transactions=[_transaction_item(tx) for tx in txs],
+        next_cursor=encode_cursor(next_key) if next_key is not None else None,
+    )
+
+
+@router.post(
+    "/books_detail/stream",
+    summary="the whole book detail as NDJSON, one transaction per line (need token)",
+)
+async def stream_book_detail(data: BookDetailPageRequest) -> StreamingResponse:
+    query = dict(
+        token=data.token,
+        account_book_id=data.account_book_id,
+        start_time=str_to_datetime(data.start_time) if data.start_time else None,
+        end_time=str_to_datetime(data.end_time) if data.end_time else None,
+        note=data.note or None,
+        limit=BOOK_DETAIL_STREAM_PAGE_SIZE,
+    )
+    after = decode_cursor(data.cursor) if data.cursor else None
+    # the first page is read here so token / ownership errors still get a code
+    first_page = await ledger.get_transaction_page(after=after, **query)
+
+    async def ndjson():
+        txs, next_key = first_page
+        while True:
+            if txs:
+                yield "".join(
+                    _transaction_item(tx).model_dump_json() + "\n" for tx in txs
+                )
+            if next_key is None:
+                break
+            txs, next_key = await ledger.get_transaction_page(after=next_key, **query)
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+@router.post(
+    "/books_detail/search",
+    response_model=SearchTransactionsResponse,
+    summary="full text search of the notes, ranked by relevance (need token)",
+)
+async def search_transactions(
+    data: SearchTransactionsRequest,
+) -> SearchTransactionsResponse:
+    _require_sqlite_ledger()
+    hits = await db.run(
+        AccountBook.search_transactions,
+        token=data.token,
+        account_book_id=data.account_book_id,
+        query=data.query,
+        match_all=data.match_all,
+        limit=data.limit,
+    )
+    return SearchTransactionsResponse(
+        success=True,
+        code=0,
+        msg="Success",
+        transactions=[
+            SearchHitItem(**_transaction_item(tx).model_dump(), score=score)
+            for tx, score in hits
+        ],
+    )
+
+
+@router.post(
+    "/sync",
+    response_model=SyncResponse,
+    summary="books / transactions changed since a change log seq (need token)",
+)
+async def sync_changes(data: SyncRequest) -> SyncResponse:
+    _require_sqlite_ledger()
+    changes = await db.run(
+        Account.get_changes, token=data.token, since=data.since, limit=data.limit
+    )
+    return SyncResponse(
+        success=True,
+        code=0,
+        msg="Success",
+        books=[SyncBookItem(book_id=i, name=name) for i, name in changes.books],
+        deleted_book_ids=changes.deleted_book_ids,
+        transactions=[
+            SyncTransactionItem(
+                **_transaction_item(tx).model_dump(),
+                account_book_id=tx.account_book_id,
+            )
+            for tx in changes.transactions
+        ],
+        deleted_transaction_ids=changes.deleted_transaction_ids,
+        next_since=changes.next_since,
+        has_more=changes.has_more,
+        reset=changes.reset,
+    )
+
+
+@router.post(
+    "/books_detail/summary",
+    response_model=BookSummaryResponse,
+    summary="income / outcome totals per category per day, week, month or year (need token)",
+)
+async def get_book_summary(data: BookSummaryRequest) -> BookSummaryResponse:
+    _require_sqlite_ledger()
+    rows = await db.run(
+        AccountBook.get_summary,
+        token=data.token,
+        account_book_id=data.account_book_id,
+        bucket=data.bucket,
+        start_time=str_to_datetime(data.start_time) if data.start_time else None,
+        end_time=str_to_datetime(data.end_time) if data.end_time else None,
+    )
+    return BookSummaryResponse(
+        success=True,
+        code=0,
+        msg="Success",
+        buckets=[
+            SummaryBucketItem(
+                bucket=row.bucket,
+                kind="income" if row.income else "outcome",
+                category=row.category or "",
+                total=row.total,
+                count=row.count,
+            )
+            for row in rows
+        ],
+        income_total=sum(row.total for row in rows if row.income),
+        outcome_total=sum(row.total for row in rows if not row.income),
+    )
+
+
+@router.post(
+    "/books_detail/analytics/rolling",
+    response_model=RollingAverageResponse,
+    summary="daily income / outcome / net with their rolling average (need token)",
+)
+async def get_rolling_average(data: RollingAverageRequest) -> RollingAverageResponse:
+    _require_sqlite_ledger()
+    series = await db.run(
+        analytics.book_rolling_average,
+        token=data.token,
+        account_book_id=data.account_book_id,
+        start_time=str_to_datetime(data.start_time) if data.start_time else None,
+        end_time=str_to_datetime(data.end_time) if data.end_time else None,
+        window=data.window,
+    )
+    return RollingAverageResponse(
+        success=True,
+        code=0,
+        msg="Success",
+        window=data.window,
+        days=series.days,
+        income=series.income.tolist(),
+        outcome=series.outcome.tolist(),
+        net=series.net.tolist(),
+        rolling_income=series.rolling_income.tolist(),
+        rolling_outcome=series.rolling_outcome.tolist(),
+        rolling_net=series.rolling_net.tolist(),
+    )
+
+
+@router.post(
+    "/books_detail/analytics/percentiles",
+    response_model=CategoryPercentilesResponse,
+    summary="percentiles of the transaction amount per category (need token)",
+)
+async def get_category_percentiles(
+    data: CategoryPercentilesRequest,
+) -> CategoryPercentilesResponse:
+    _require_sqlite_ledger()
+    groups = await db.run(
+        analytics.book_category_percentiles,
+        token=data.token,
+        account_book_id=data.account_book_id,
+        start_time=str_to_datetime(data.start_time) if data.start_time else None,
+        end_time=str_to_datetime(data.end_time) if data.end_time else None,
+        percentiles=data.percentiles,
+    )
+    return CategoryPercentilesResponse(
+        success=True,
+        code=0,
+        msg="Success",
+        percentiles=data.percentiles,
+        categories=[
+            CategoryPercentileItem(
+                kind="income" if group.income else "outcome",
+                category=group.category or "",
+                count=group.count,
+                values=group.values.tolist(),
+            )
+            for group in groups
         ],
     )
 
 
+@router.post(
+    "/books_detail/analytics/balance_curve",
+    response_model=BalanceCurveResponse,
+    summary="balance of the book at the end of every day (need token)",
+)
+async def get_balance_curve(data: AnalyticsRequest) -> BalanceCurveResponse:
+    _require_sqlite_ledger()
+    curve = await db.run(
+        analytics.book_balance_curve,
+        token=data.token,
+        account_book_id=data.account_book_id,
+        start_time=str_to_datetime(data.start_time) if data.start_time else None,
+        end_time=str_to_datetime(data.end_time) if data.end_time else None,
+    )
+    return BalanceCurveResponse(
+        success=True,
+        code=0,
+        msg="Success",
+        days=curve.days,
+        balance=curve.balance.tolist(),
+    )
+
+
 @router.post(
     "/book/transactions/add_income",
     response_model=AddIncomeResponse,
@@ -285,15 +698,17 @@ async def add_income(data: AddIncomeRequest):
         temp = data.time
     else:
         temp = datetime.now().isoformat()
-    AccountBook.add_income(
-        conn=conn,
-        account_book_id=data.account_book_id,
-        token=data.token,
+    tx = Transaction(
         amount=data.amount,
+        account_book_id=data.account_book_id,
+        category=IncomeType.index_2_income_type(data.income_idx),
         time=str_to_datetime(temp),
         note=data.note,
-        income_type=IncomeType.index_2_income_type(data.income_idx),
     )
+    if batcher is not None:
+        await batcher.add(data.token, tx)
+    else:
+        await ledger.add_transaction(data.token, tx)
     return AddIncomeResponse(success=True, msg="Income added successfully", code=0)
 
 
@@ -307,21 +722,346 @@ async def add_outcome(data: AddOutcomeRequest) -> AddOutcomeResponse:
         temp = data.time
     else:
         temp = datetime.now().isoformat()
-    AccountBook.add_outcome(
-        conn=conn,
-        account_book_id=data.account_book_id,
-        token=data.token,
+    tx = Transaction(
         amount=data.amount,
+        account_book_id=data.account_book_id,
+        category=OutcomeType.index_2_outcome_type(data.outcome_idx),
         time=str_to_datetime(temp),
         note=data.note,
-        outcome_type=OutcomeType.index_2_outcome_type(data.outcome_idx),
     )
+    if batcher is not None:
+        await batcher.add(data.token, tx)
+    else:
+        await ledger.add_transaction(data.token, tx)
     return AddOutcomeResponse(success=True, msg="Outcome added successfully", code=0)
 
 
-app = FastAPI(title="CoinVerse", version="0.1.0")
+def _bulk_import_response(result: bulk_import.ImportResult) -> BulkImportResponse:
+    return BulkImportResponse(
+        success=True,
+        msg=f"{result.inserted} transactions imported, {result.failed} rejected",
+        code=0 if result.failed == 0 else 1,
+        inserted=result.inserted,
+        failed=result.failed,
+        errors=[BulkImportError(row=row, msg=msg) for row, msg in result.errors],
+    )
+
+
+@router.post(
+    "/book/transactions/bulk_import",
+    response_model=BulkImportResponse,
+    summary="import a json array of transactions into the book (need token)",
+)
+async def bulk_import_json(data: BulkImportRequest) -> BulkImportResponse:
+    _require_sqlite_ledger()
+    result = await db.run(
+        bulk_import.import_records,
+        token=data.token,
+        account_book_id=data.account_book_id,
+        records=(
+            bulk_import.ImportRecord(
+                row=i + 1,
+                amount=item.amount,
+                time=item.time,
+                note=item.note,
+                category=item.category,
+            )
+            for i, item in enumerate(data.transactions)
+        ),
+        chunk_size=BULK_IMPORT_CHUNK_SIZE,
+        max_errors=BULK_IMPORT_MAX_ERRORS,
+    )
+    return _bulk_import_response(result)
+
+
+@router.post(
+    "/book/transactions/bulk_import_csv",
+    response_model=BulkImportResponse,
+    summary="stream a csv (time,amount,note,category) into the book (need token)",
+)
+async def bulk_import_csv(
+    request: Request, account_book_id: int, token: str = Header(...)
+) -> BulkImportResponse:
+    _require_sqlite_ledger()
+    # raw text/csv body instead of a multipart form, read while it is uploaded
+    result = await bulk_import.import_csv_stream(
+        _hashed_stream(request),
+        db.run,
+        token=token,
+        account_book_id=account_book_id,
+        chunk_size=BULK_IMPORT_CHUNK_SIZE,
+        max_errors=BULK_IMPORT_MAX_ERRORS,
+    )
+    return _bulk_import_response(result)
+
+
+async def _hashed_stream(request: Request) -> AsyncIterator[bytes]:
+    # the body of a streamed route, its sha256 is left in request.state for
+    # idempotency_middleware once the whole upload went through
+    digest = hashlib.sha256()
+    async for chunk in request.stream():
+        digest.update(chunk)
+        yield chunk
+    request.state.body_sha256 = digest.hexdigest()
+
+
+def _op_result_item(result: ops_batch.OpResult) -> OpResultItem:
+    if result.error is not None:
+        e = result.error
+        return OpResultItem(
+            index=result.index,
+            key=result.key,
+            success=False,
+            code=EXC_CODE_MAP.get(type(e), DEFAULT_ERR_CODE),
+            msg=str(e) or type(e).__name__,
+        )
+    return OpResultItem(
+        index=result.index,
+        key=result.key,
+        success=True,
+        code=0,
+        msg="Success",
+        replayed=result.replayed,
+        **result.result,
+    )
+
+
+@router.post(
+    "/ops",
+    response_model=OpsBatchResponse,
+    summary="apply a list of write operations in one transaction (need token)",
+)
+async def apply_ops(data: OpsBatchRequest) -> OpsBatchResponse:
+    _require_sqlite_ledger()
+    results = await db.run(
+        ops_batch.execute_ops,
+        token=data.token,
+        ops=[
+            ops_batch.Op(
+                kind=op.op,
+                params=op.model_dump(exclude={"op", "key"}),
+                key=op.key,
+            )
+            for op in data.ops
+        ],
+    )
+    items = [_op_result_item(result) for result in results]
+    failed = sum(1 for item in items if not item.success)
+    return OpsBatchResponse(
+        success=True,
+        msg=f"{len(items) - failed} operations applied, {failed} rejected",
+        code=0 if failed == 0 else 1,
+        applied=len(items) - failed,
+        failed=failed,
+        results=items,
+    )
+
+
+@router.get(
+    "/metrics/db",
+    response_model=DBMetricsResponse,
+    summary="db executor queue depth / wait time and connection pool usage",
+)
+async def db_metrics() -> DBMetricsResponse:
+    return DBMetricsResponse(
+        success=True,
+        msg="Success",
+        executor=db.metrics(),
+        pool=pool.stats(),
+        caches={
+            "session": session_cache.stats(),
+            "ownership": ownership_cache.stats(),
+            "revocations": revocations.stats(),
+            "last_seen": last_seen.stats(),
+        },
+        write_batcher=batcher.stats() if batcher is not None else {},
+    )
+
+
+@router.get(
+    "/metrics/maintenance",
+    response_model=MaintenanceMetricsResponse,
+    summary="runs / rows / slice timings of the background maintenance jobs",
+)
+async def maintenance_metrics() -> MaintenanceMetricsResponse:
+    return MaintenanceMetricsResponse(
+        success=True, msg="Success", jobs=maintenance.stats()
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await ledger.start()
+    sweeping = asyncio.create_task(maintenance.run_forever())
+    if batcher is not None:
+        batcher.start()
+    yield
+    if batcher is not None:
+        # the rows still queued are written before the pool goes away
+        await batcher.stop()
+    sweeping.cancel()
+    try:
+        await sweeping
+    except asyncio.CancelledError:
+        pass
+    # keep the last uses of this process
+    await db.run(Account.flush_last_seen)
+    await ledger.close()
+    db.shutdown()
+    pool.close()
+    hasher.shutdown()
+
+
+app = FastAPI(title="CoinVerse", version="0.1.0", lifespan=lifespan)
 app.include_router(router)
 
+# writes whose retries are answered from the idempotency store when the request
+# carries an Idempotency-Key header; not /login and /refresh_token: their
+# response is a credential, which is not to be stored, and issuing another
+# token on a retry does no harm
+IDEMPOTENT_ROUTES = {
+    router.prefix + path
+    for path in (
+        "/register",
+        "/logout",
+        "/users/me/change_password",
+        "/create_book",
+        "/books/remove_book",
+        "/book/transactions/add_income",
+        "/book/transactions/add_outcome",
+        "/book/transactions/bulk_import",
+        "/book/transactions/bulk_import_csv",
+        "/ops",
+    )
+}
+# bodies consumed while they are uploaded (through _hashed_stream): the key is
+# reserved before the body is known, the body hash is kept with the response
+# and compared when the key is used again
+_STREAMED_ROUTES = {router.prefix + "/book/transactions/bulk_import_csv"}
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+
+
+def _idempotency_scope(request: Request, body: bytes) -> str:
+    # keys of different clients never meet: scoped by the token of the request,
+    # requests without one (/register, change_password) by their body, so a
+    # key only ever matches a retry of the very same request
+    credential = request.headers.get("token", "")
+    if not credential and body:
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict):
+            credential = payload.get("token") or payload.get("old_token") or ""
+    if not isinstance(credential, str) or not credential:
+        return "http:anonymous:" + hashlib.sha256(body).hexdigest()[:32]
+    return "http:" + hashlib.sha256(credential.encode()).hexdigest()[:32]
+
+
+@app.middleware("http")
+async def idempotency_middleware(request: Request, call_next):
+    """
+    A write retried with the same Idempotency-Key header gets the stored
+    response of the first attempt (header Idempotent-Replayed: true) instead of
+    being applied again. The key is reserved before the route runs and keeps
+    its response only when the route succeeded, any error gives it back but
+    BulkImportInterruptedError: rows are committed, the error is kept as the
+    response of the key so that a retry does not import them a second time.
+    Registered before global_exception_middleware, so it runs inside it and
+    its errors are answered with a code.
+    """
+    key = request.headers.get("idempotency-key")
+    if not key or request.url.path not in IDEMPOTENT_ROUTES:
+        return await call_next(request)
+    if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise RequireInfoLostException(
+            f"Idempotency-Key is longer than {IDEMPOTENCY_KEY_MAX_LENGTH} characters."
+        )
+    streamed = request.url.path in _STREAMED_ROUTES
+    if streamed:
+        body = b""
+        content = "streamed"
+    else:
+        body = await request.body()
+        content = hashlib.sha256(body).hexdigest()
+    scope = _idempotency_scope(request, body)
+    request_fingerprint = idempotency.fingerprint(
+        request.method, request.url.path, str(request.query_params), content
+    )
+    stored = await db.run(
+        idempotency.reserve,
+        scope=scope,
+        key=key,
+        request_fingerprint=request_fingerprint,
+    )
+    if stored is not None:
+        if streamed and stored.get("content") is not None:
+            digest = hashlib.sha256()
+            async for chunk in request.stream():
+                digest.update(chunk)
+            if digest.hexdigest() != stored["content"]:
+                raise IdempotencyKeyConflictError(
+                    f"Idempotency key '{key}' was already used for a different request."
+                )
+        return JSONResponse(
+            status_code=stored["status"],
+            content=stored["body"],
+            headers={"Idempotent-Replayed": "true"},
+        )
+
+    try:
+        response = await call_next(request)
+        response_body = b"".join([chunk async for chunk in response.body_iterator])
+    except BulkImportInterruptedError as e:
+        await db.run(
+            idempotency.complete,
+            scope=scope,
+            key=key,
+            request_fingerprint=request_fingerprint,
+            response={
+                "status": 200,
+                "body": _error_body(e),
+                "content": getattr(request.state, "body_sha256", None),
+            },
+        )
+        raise
+    except BaseException:
+        await db.run(idempotency.release, scope=scope, key=key)
+        raise
+    try:
+        payload = json.loads(response_body)
+    except ValueError:
+        payload = None
+    if (
+        200 <= response.status_code < 300  # /register answers 201
+        and isinstance(payload, dict)
+        and payload.get("success") is True
+    ):
+        await db.run(
+            idempotency.complete,
+            scope=scope,
+            key=key,
+            request_fingerprint=request_fingerprint,
+            response={
+                "status": response.status_code,
+                "body": payload,
+                "content": getattr(request.state, "body_sha256", None),
+            },
+        )
+    else:
+        # rejected: nothing was written, a retry may succeed
+        await db.run(idempotency.release, scope=scope, key=key)
+    return Response(
+        content=response_body,
+        status_code=response.status_code,
+        headers=dict(response.headers),
+        media_type=response.media_type,
+    )
+
+
+def _error_body(e: Exception) -> dict:
+    return {"success": False, "code": EXC_CODE_MAP[type(e)], "msg": str(e)}
+
 
 @app.middleware("http")
 async def global_exception_middleware(request: Request, call_next):
@@ -335,11 +1075,10 @@ async def global_exception_middleware(request: Request, call_next):
         return await call_next(request)
 
     except tuple(EXC_CODE_MAP.keys()) as e:
-        code = EXC_CODE_MAP[type(e)]
         logging.warning(f"[Handled] {type(e).__name__}: {e}")
         return JSONResponse(
             status_code=200,  # 业务错误仍返回 200，前端靠 code 判断
-            content={"success": False, "code": code, "msg": str(e)},
+            content=_error_body(e),
         )
 
     except Exception as e:
@@ -1,6 +1,8 @@
-from typing import Optional, List, Dict, Tuple
+from typing import Annotated, Any, Literal, Optional, List, Dict, Tuple, Union
 from pydantic import BaseModel, Field
 
+from config import OPS_BATCH_MAX_OPS
+
 
 class RegisterRequest(BaseModel):
     name: str = Field(..., min_length=1, max_length=20)
@@ -101,6 +103,14 @@ class ListBookRequest(BaseModel):
     token: str = Field(...)
 
 
+class BookSummary(BaseModel):
+    book_id: int
+    name: str
+    balance: float
+    transaction_count: int
+    last_activity: Optional[str]  # time of the latest transaction, None if empty
+
+
 class ListBookResponse(BaseModel):
     """
     Attributes:
@@ -111,12 +121,14 @@ class ListBookResponse(BaseModel):
             # 2 token expired
         msg: info ops
         books: list of books
+        book_summaries: the same books with transaction count and last activity
     """
 
     success: bool = Field(...)
     code: int = Field(...)
     msg: str = Field(...)
     books: List[Dict[int, Tuple[str, float]]]
+    book_summaries: List[BookSummary] = Field(default_factory=list)
 
 
 class RemoveBookRequest(BaseModel):
@@ -167,6 +179,215 @@ class BookDetailResponse(BaseModel):
     transactions: List[Dict[int, Tuple[str, str, float]]]
 
 
+class BookDetailPageRequest(BaseModel):
+    token: str = Field(...)
+    account_book_id: int
+    start_time: str = ""  # empty -> from the first transaction
+    end_time: str = ""  # empty -> now
+    note: str = ""
+    cursor: str = ""  # next_cursor of the previous page, empty for the first one
+    limit: int = Field(200, ge=1, le=1000)
+
+
+class TransactionItem(BaseModel):
+    id: int
+    category: str
+    note: str
+    amount: float
+    time: str
+
+
+class BookDetailPageResponse(BaseModel):
+    """
+    Attributes:
+        success: status
+        code:
+            # 0 success
+        transactions: one page, ordered by time then id
+        next_cursor: pass it back to get the next page, None on the last page
+    """
+
+    success: bool = Field(...)
+    msg: str = Field(...)
+    code: int = Field(...)
+    transactions: List[TransactionItem]
+    next_cursor: Optional[str] = None
+
+
+class SyncRequest(BaseModel):
+    token: str = Field(...)
+    since: int = Field(0, ge=0)  # next_since of the previous sync, 0 the first time
+    limit: int = Field(500, ge=1, le=5000)  # change log entries per call
+
+
+class SyncBookItem(BaseModel):
+    book_id: int
+    name: str
+
+
+class SyncTransactionItem(TransactionItem):
+    account_book_id: int
+
+
+class SyncResponse(BaseModel):
+    """
+    Attributes:
+        success: status
+        code:
+            # 0 success
+        books: books created or renamed since ``since``, current state
+        deleted_book_ids: removed books, their transactions are gone too
+        transactions: transactions created or updated since ``since``
+        deleted_transaction_ids: removed transactions
+        next_since: the ``since`` of the next call
+        has_more: more changes are waiting, call again with next_since
+        reset: ``since`` can't be served, reload everything then sync from next_since
+    """
+
+    success: bool = Field(...)
+    msg: str = Field(...)
+    code: int = Field(...)
+    books: List[SyncBookItem] = Field(default_factory=list)
+    deleted_book_ids: List[int] = Field(default_factory=list)
+    transactions: List[SyncTransactionItem] = Field(default_factory=list)
+    deleted_transaction_ids: List[int] = Field(default_factory=list)
+    next_since: int = Field(...)
+    has_more: bool = False
+    reset: bool = False
+
+
+class SearchTransactionsRequest(BaseModel):
+    token: str = Field(...)
+    account_book_id: int
+    query: str = Field(..., min_length=1)  # terms, 'term*' for a prefix
+    match_all: bool = True  # False: any of the terms
+    limit: int = Field(50, ge=1, le=500)
+
+
+class SearchHitItem(TransactionItem):
+    score: float  # higher is more relevant
+
+
+class SearchTransactionsResponse(BaseModel):
+    """
+    Attributes:
+        success: status
+        code:
+            # 0 success
+        transactions: the matching transactions, most relevant first
+    """
+
+    success: bool = Field(...)
+    msg: str = Field(...)
+    code: int = Field(...)
+    transactions: List[SearchHitItem]
+
+
+class BookSummaryRequest(BaseModel):
+    token: str = Field(...)
+    account_book_id: int
+    bucket: Literal["day", "week", "month", "year"] = "month"
+    start_time: str = ""  # empty -> from the first transaction
+    end_time: str = ""  # empty -> up to the last transaction
+
+
+class SummaryBucketItem(BaseModel):
+    bucket: str  # first day of the bucket, YYYY-MM-DD
+    kind: Literal["income", "outcome"]
+    category: str  # IncomeType / OutcomeType name, "" when uncategorized
+    total: float
+    count: int
+
+
+class BookSummaryResponse(BaseModel):
+    """
+    Attributes:
+        success: status
+        code:
+            # 0 success
+        buckets: one item per bucket and category, ordered by bucket
+        income_total: sum of the income of the range
+        outcome_total: sum of the outcome of the range (negative)
+    """
+
+    success: bool = Field(...)
+    msg: str = Field(...)
+    code: int = Field(...)
+    buckets: List[SummaryBucketItem]
+    income_total: float = 0.0
+    outcome_total: float = 0.0
+
+
+class AnalyticsRequest(BaseModel):
+    token: str = Field(...)
+    account_book_id: int
+    start_time: str = ""  # empty -> from the first transaction
+    end_time: str = ""  # empty -> up to the last transaction
+
+
+class RollingAverageRequest(AnalyticsRequest):
+    window: int = Field(7, ge=1, le=366)  # days
+
+
+class RollingAverageResponse(BaseModel):
+    """
+    Attributes:
+        success: status
+        code:
+            # 0 success
+        days: every day of the range, YYYY-MM-DD
+        income / outcome / net: the totals of each day
+        rolling_*: their trailing mean over ``window`` days
+    """
+
+    success: bool = Field(...)
+    msg: str = Field(...)
+    code: int = Field(...)
+    window: int
+    days: List[str]
+    income: List[float]
+    outcome: List[float]
+    net: List[float]
+    rolling_income: List[float]
+    rolling_outcome: List[float]
+    rolling_net: List[float]
+
+
+class CategoryPercentilesRequest(AnalyticsRequest):
+    percentiles: List[Annotated[float, Field(ge=0, le=100)]] = Field(
+        default_factory=lambda: [50.0, 90.0, 99.0], min_length=1, max_length=20
+    )
+
+
+class CategoryPercentileItem(BaseModel):
+    kind: Literal["income", "outcome"]
+    category: str  # "" when uncategorized
+    count: int
+    values: List[float]  # one per requested percentile, of the absolute amount
+
+
+class CategoryPercentilesResponse(BaseModel):
+    success: bool = Field(...)
+    msg: str = Field(...)
+    code: int = Field(...)
+    percentiles: List[float]
+    categories: List[CategoryPercentileItem]
+
+
+class BalanceCurveResponse(BaseModel):
+    """
+    Attributes:
+        days: the days with transactions, YYYY-MM-DD
+        balance: the balance of the book at the end of each of those days
+    """
+
+    success: bool = Field(...)
+    msg: str = Field(...)
+    code: int = Field(...)
+    days: List[str]
+    balance: List[float]
+
+
 class AddIncomeRequest(BaseModel):
     token: str = Field(...)
     account_book_id: int = Field(...)
@@ -225,4 +446,158 @@ class AddOutcomeResponse(BaseModel):
     code: int = Field(...)
 
 
-# NOTE: may be I should have a ops praraphase to the app so that it can have a more collective operation
+class BulkTransactionItem(BaseModel):
+    # a str is parsed by bulk_import, a bad one only rejects its own row
+    amount: Union[float, str] = Field(...)
+    time: str = ""  # empty -> now
+    note: str = ""
+    # income_idx / outcome_idx style index or a category name, None -> OTHER
+    category: Optional[Union[int, str]] = None
+
+
+class BulkImportRequest(BaseModel):
+    token: str = Field(...)
+    account_book_id: int = Field(...)
+    transactions: List[BulkTransactionItem] = Field(...)
+
+
+class BulkImportError(BaseModel):
+    row: int  # 1-based position in the upload
+    msg: str
+
+
+class BulkImportResponse(BaseModel):
+    """
+    Attributes:
+        success: True once the upload was processed, even if rows were rejected;
+            False for an error of the whole request (token, book, csv header)
+        msg: counts of imported and rejected rows, or the error message
+        code:
+            # 0 every row imported
+            # 1 some rows rejected, see errors
+        inserted: rows written to the book
+        failed: rows rejected by validation
+        errors: the first rejected rows with the reason
+    """
+
+    success: bool = Field(...)
+    msg: str = Field(...)
+    code: int = Field(...)
+    inserted: int = Field(...)
+    failed: int = Field(...)
+    errors: List[BulkImportError] = Field(default_factory=list)
+
+
+class DBMetricsResponse(BaseModel):
+    """
+    Attributes:
+        executor: queue depth, running jobs and wait / run time (ms) of the db executor
+        pool: opened / in use / idle connections of the connection pool
+        caches: entries / hits / misses of the in-process caches
+        write_batcher: queued rows, batches / rows written and average batch time
+                       (ms) of the group commit writer, empty when it is off
+    """
+
+    success: bool = Field(...)
+    msg: str = Field(...)
+    executor: Dict[str, Any] = Field(...)
+    pool: Dict[str, int] = Field(...)
+    caches: Dict[str, Dict[str, int]] = Field(default_factory=dict)
+    write_batcher: Dict[str, Any] = Field(default_factory=dict)
+
+
+class MaintenanceMetricsResponse(BaseModel):
+    """
+    Attributes:
+        jobs: per maintenance job, runs / slices / rows handled / errors and the
+              time (ms) of the last run, of the last and of the longest slice
+    """
+
+    success: bool = Field(...)
+    msg: str = Field(...)
+    jobs: Dict[str, Dict[str, Any]] = Field(default_factory=dict)
+
+
+# ------------------------- ops batch ------------------------- #
+class _BatchOp(BaseModel):
+    # applied at most once when set, see OpsBatchRequest
+    key: Optional[str] = Field(None, min_length=1, max_length=128)
+
+
+class AddIncomeOp(_BatchOp):
+    op: Literal["add_income"]
+    account_book_id: int
+    amount: float
+    time: str = ""  # empty -> now
+    note: str = ""
+    income_idx: int
+
+
+class AddOutcomeOp(_BatchOp):
+    op: Literal["add_outcome"]
+    account_book_id: int
+    amount: float
+    time: str = ""  # empty -> now
+    note: str = ""
+    outcome_idx: int
+
+
+class CreateBookOp(_BatchOp):
+    op: Literal["create_book"]
+    book_name: str
+
+
+class RemoveBookOp(_BatchOp):
+    op: Literal["remove_book"]
+    book_id: int
+
+
+BatchOp = Annotated[
+    Union[AddIncomeOp, AddOutcomeOp, CreateBookOp, RemoveBookOp],
+    Field(discriminator="op"),
+]
+
+
+class OpsBatchRequest(BaseModel):
+    """
+    Attributes:
+        token: checked once for the whole batch
+        ops: applied in order in one transaction; a rejected op does not stop
+             the others. An op with a ``key`` already applied (e.g. a batch
+             sent again after a timeout) is not applied twice, its first
+             result is returned with replayed = true.
+    """
+
+    token: str = Field(...)
+    ops: List[BatchOp] = Field(..., min_length=1, max_length=OPS_BATCH_MAX_OPS)
+
+
+class OpResultItem(BaseModel):
+    index: int  # position of the op in the request
+    key: Optional[str] = None
+    success: bool
+    code: int  # 0 or the code of the single op route error
+    msg: str
+    replayed: bool = False
+    transaction_id: Optional[int] = None  # add_income / add_outcome
+    book_id: Optional[int] = None  # create_book
+
+
+class OpsBatchResponse(BaseModel):
+    """
+    Attributes:
+        success: the batch was processed, see results for each op
+        code:
+            # 0 every op succeeded
+            # 1 some ops were rejected
+        applied: ops that succeeded (replayed ones included)
+        failed: ops that were rejected
+        results: one per op, in request order
+    """
+
+    success: bool = Field(...)
+    msg: str = Field(...)
+    code: int = Field(...)
+    applied: int = Field(...)
+    failed: int = Field(...)
+    results: List[OpResultItem] = Field(default_factory=list)
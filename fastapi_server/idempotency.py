@@ -0,0 +1,152 @@
+"""
+Store of idempotency keys: the result of a write made with a client supplied
+key is kept for IDEMPOTENCY_TTL seconds, a retry with the same key is answered
+with that result instead of being applied twice.
+
+A key is bound to the request it was first used with (its fingerprint), reusing
+it for a different request raises IdempotencyKeyConflictError.
+
+Two ways to use it:
+  - lookup() / store() inside the caller's own write transaction, the result is
+    kept exactly when the write is (ops_batch)
+  - reserve() / complete() / release() around a whole request, for the routes
+    taking an ``Idempotency-Key`` header: the key is claimed before the request
+    runs, so a retry arriving meanwhile, from any worker, is answered
+    IdempotencyKeyInProgressError instead of being applied a second time
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Any, Optional
+
+from config import IDEMPOTENCY_PENDING_TIMEOUT, IDEMPOTENCY_TTL
+from cus_exceptions import IdempotencyKeyConflictError, IdempotencyKeyInProgressError
+
+# response of a reserved key whose request is still running
+_PENDING = ""
+
+
+def fingerprint(*parts: Any) -> str:
+    """Stable hash of the JSON serializable ``parts`` of a request."""
+    data = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def lookup(
+    conn: sqlite3.Connection, scope: str, key: str, request_fingerprint: str
+) -> Optional[Any]:
+    """
+    The stored result of ``key``, None if the key is new or expired.
+    Raises IdempotencyKeyConflictError if it was used for another request,
+    IdempotencyKeyInProgressError if that request is still running.
+    """
+    now = int(time.time())
+    row = conn.execute(
+        """
+        SELECT fingerprint, response, created_at FROM idempotency_keys
+        WHERE scope = ? AND key = ? AND created_at >= ?
+        """,
+        (scope, key, now - IDEMPOTENCY_TTL),
+    ).fetchone()
+    if row is None:
+        return None
+    stored_fingerprint, response, created_at = row
+    if stored_fingerprint != request_fingerprint:
+        raise IdempotencyKeyConflictError(
+            f"Idempotency key '{key}' was already used for a different request."
+        )
+    if response == _PENDING:
+        if created_at >= now - IDEMPOTENCY_PENDING_TIMEOUT:
+            raise IdempotencyKeyInProgressError(
+                f"A request with idempotency key '{key}' is still in progress."
+            )
+        return None  # abandoned, the key may be used again
+    return json.loads(response)
+
+
+def store(
+    conn: sqlite3.Connection,
+    scope: str,
+    key: str,
+    request_fingerprint: str,
+    response: Any,
+) -> None:
+    """
+    Record the result of ``key`` in the caller's transaction (not committed),
+    so it is kept exactly when the write it belongs to is. None marks the key
+    as reserved, see reserve().
+    """
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO idempotency_keys
+            (scope, key, fingerprint, response, created_at)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        (
+            scope,
+            key,
+            request_fingerprint,
+            _PENDING if response is None else json.dumps(response),
+            int(time.time()),
+        ),
+    )
+
+
+def reserve(
+    conn: sqlite3.Connection, scope: str, key: str, request_fingerprint: str
+) -> Optional[Any]:
+    """
+    Claim ``key`` for a request about to run and return None, or return the
+    stored result of the request that already used it. Commits.
+    Raises like lookup().
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        stored = lookup(conn, scope, key, request_fingerprint)
+        if stored is None:
+            store(conn, scope, key, request_fingerprint, None)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return stored
+
+
+def complete(
+    conn: sqlite3.Connection,
+    scope: str,
+    key: str,
+    request_fingerprint: str,
+    response: Any,
+) -> None:
+    """Store the result of a request that reserved ``key``. Commits."""
+    store(conn, scope, key, request_fingerprint, response)
+    conn.commit()
+
+
+def release(conn: sqlite3.Connection, scope: str, key: str) -> None:
+    """
+    Give back a reserved key whose request failed, so a retry runs it again.
+    Commits.
+    """
+    conn.execute(
+        "DELETE FROM idempotency_keys WHERE scope = ? AND key = ? AND response = ?",
+        (scope, key, _PENDING),
+    )
+    conn.commit()
+
+
+def purge(conn: sqlite3.Connection, limit: int) -> int:
+    """Delete up to ``limit`` expired keys, a slice of the maintenance sweeper."""
+    cur = conn.execute(
+        """
+        DELETE FROM idempotency_keys WHERE (scope, key) IN (
+            SELECT scope, key FROM idempotency_keys WHERE created_at < ? LIMIT ?
+        )
+        """,
+        (int(time.time()) - IDEMPOTENCY_TTL, limit),
+    )
+    conn.commit()
+    return cur.rowcount
@@ -0,0 +1,273 @@
+"""
+Where the accounts, books and transactions of the routes are stored.
+
+LedgerBackend is the set of storage operations the account and book routes
+need, with one implementation per database: SQLiteLedger runs the db_api
+methods through the db executor (the default), postgres_ledger.PostgresLedger
+keeps accounts, sessions, books and transactions in PostgreSQL, so any number
+of server nodes can share them. The backend is picked at startup with
+COINVERSE_LEDGER_BACKEND.
+
+Scope: the interface covers register, login, refresh_token, logout, users/me,
+change_password, create_book, list_books, books/remove_book, books_detail
+(with /page and /stream), add_income and add_outcome. Summary, analytics,
+search, sync, bulk import and /ops read and write the sqlite tables directly;
+with another backend they answer LedgerBackendUnavailableError (see
+fast_router._require_sqlite_ledger), and the group commit writer is not used.
+"""
+
+import sqlite3
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, Awaitable, Callable, List, NamedTuple, Optional, Tuple
+
+from db_api import (
+    Account,
+    AccountBook,
+    BookStats,
+    Transaction,
+    TransactionRow,
+)
+
+# (time_epoch, id) of the last row of a page
+PageKey = Tuple[int, int]
+
+
+class Profile(NamedTuple):
+    name: str
+    email: str
+
+
+class LedgerBackend(ABC):
+    """
+    Async account, session and ledger operations; all but register, the
+    login steps and set_password act for the account of a token. Errors are
+    the db_api ones (TokenNotFoundError, AccessDenialAccountBookError,
+    DuplicatedAccountBookError, sqlite3.IntegrityError ...), so the routes
+    answer the same codes whatever the backend.
+    """
+
+    name: str = ""
+
+    async def start(self) -> None:
+        """Called by the app lifespan before the first request."""
+
+    async def close(self) -> None:
+        """Called by the app lifespan after the last request."""
+
+    # ------------------------- accounts and sessions ------------------------- #
+    @abstractmethod
+    async def register(self, name: str, email: str, pwd_hash: str) -> None:
+        """Create an account, ``pwd_hash`` is stored as given (see Account.register)."""
+
+    @abstractmethod
+    async def get_credentials(self, name_or_email: str) -> Optional[Tuple[int, str]]:
+        """(account_id, stored password hash) of the account, None if unknown."""
+
+    @abstractmethod
+    async def complete_login(
+        self, account_id: int, old_hash: str, rehashed: Optional[str] = None
+    ) -> str:
+        """A new session of a verified account, see Account.complete_login."""
+
+    @abstractmethod
+    async def refresh_token(self, old_token: str) -> Optional[str]:
+        """The token replacing ``old_token``, None if it is unknown."""
+
+    @abstractmethod
+    async def logout(self, token: str) -> bool:
+        """End the session of ``token``, see Account.logout."""
+
+    @abstractmethod
+    async def authenticate(self, token: str) -> int:
+        """The account_id of a valid token, see Account.authenticate."""
+
+    @abstractmethod
+    async def get_profile(self, token: str) -> Profile:
+        """Name and email of the token's account."""
+
+    @abstractmethod
+    async def set_password(self, account_id: int, new_hash: str) -> None:
+        """Store an already computed password hash, see Account.set_password."""
+
+    # ------------------------- books and transactions ------------------------- #
+    @abstractmethod
+    async def create_book(self, token: str, book_name: str) -> int:
+        """Create a book of the token's account and return its id."""
+
+    @abstractmethod
+    async def list_books(self, token: str) -> List[BookStats]:
+        """The books of the token's account, see AccountBook.list_book_stats."""
+
+    @abstractmethod
+    async def remove_book(self, token: str, book_id: int) -> None:
+        """Delete a book of the token's account with all its transactions."""
+
+    @abstractmethod
+    async def add_transaction(self, token: str, tx: Transaction) -> int:
+        """Insert ``tx`` into a book of the token's account and return its id."""
+
+    @abstractmethod
+    async def get_transaction_rows(
+        self,
+        token: str,
+        account_book_id: int,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        note: Optional[str] = None,
+    ) -> List[TransactionRow]:
+        """See AccountBook.get_transaction_rows."""
+
+    @abstractmethod
+    async def get_transaction_page(
+        self,
+        token: str,
+        account_book_id: int,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        note: Optional[str] = None,
+        after: Optional[PageKey] = None,
+        limit: int = 200,
+    ) -> Tuple[List[Transaction], Optional[PageKey]]:
+        """See AccountBook.get_transaction_page."""
+
+
+def _register(conn: sqlite3.Connection, name: str, email: str, pwd_hash: str) -> None:
+    Account.register(conn, name, email, pwd_hash)
+
+
+def _complete_login(
+    conn: sqlite3.Connection, account_id: int, old_hash: str, rehashed: Optional[str]
+) -> str:
+    return Account.complete_login(conn, account_id, old_hash, rehashed).token
+
+
+def _refresh_token(conn: sqlite3.Connection, old_token: str) -> Optional[str]:
+    account = Account.refresh_token(conn, old_token)
+    return None if account is None else account.token
+
+
+def _get_profile(conn: sqlite3.Connection, token: str) -> Profile:
+    account = Account.get_profile(conn, token)
+    return Profile(account.name, account.email)
+
+
+def _add_transaction(conn: sqlite3.Connection, token: str, tx: Transaction) -> int:
+    AccountBook.check_access(conn, token, tx.account_book_id)
+    return Transaction.execute_db_add(conn, tx)
+
+
+def _create_book(conn: sqlite3.Connection, token: str, book_name: str) -> int:
+    return Account.create_book(conn, token, book_name)._id
+
+
+class SQLiteLedger(LedgerBackend):
+    """The db_api implementation, every call is one job of ``run`` (the db executor)."""
+
+    name = "sqlite"
+
+    def __init__(self, run: Callable[..., Awaitable[Any]]) -> None:
+        self._run = run
+
+    async def register(self, name: str, email: str, pwd_hash: str) -> None:
+        await self._run(_register, name=name, email=email, pwd_hash=pwd_hash)
+
+    async def get_credentials(self, name_or_email: str) -> Optional[Tuple[int, str]]:
+        return await self._run(Account.get_credentials, name_or_email=name_or_email)
+
+    async def complete_login(
+        self, account_id: int, old_hash: str, rehashed: Optional[str] = None
+    ) -> str:
+        return await self._run(
+            _complete_login, account_id=account_id, old_hash=old_hash, rehashed=rehashed
+        )
+
+    async def refresh_token(self, old_token: str) -> Optional[str]:
+        return await self._run(_refresh_token, old_token=old_token)
+
+    async def logout(self, token: str) -> bool:
+        return await self._run(Account.logout, token=token)
+
+    async def authenticate(self, token: str) -> int:
+        return await self._run(Account.authenticate, token=token)
+
+    async def get_profile(self, token: str) -> Profile:
+        return await self._run(_get_profile, token=token)
+
+    async def set_password(self, account_id: int, new_hash: str) -> None:
+        await self._run(Account.set_password, account_id=account_id, new_hash=new_hash)
+
+    async def create_book(self, token: str, book_name: str) -> int:
+        return await self._run(_create_book, token=token, book_name=book_name)
+
+    async def list_books(self, token: str) -> List[BookStats]:
+        return await self._run(AccountBook.list_book_stats, token=token)
+
+    async def remove_book(self, token: str, book_id: int) -> None:
+        await self._run(Account.remove_account_book, token=token, book_id=book_id)
+
+    async def add_transaction(self, token: str, tx: Transaction) -> int:
+        return await self._run(_add_transaction, token=token, tx=tx)
+
+    async def get_transaction_rows(
+        self,
+        token: str,
+        account_book_id: int,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        note: Optional[str] = None,
+    ) -> List[TransactionRow]:
+        return await self._run(
+            AccountBook.get_transaction_rows,
+            token=token,
+            account_book_id=account_book_id,
+            start_time=start_time,
+            end_time=end_time,
+            note=note,
+        )
+
+    async def get_transaction_page(
+        self,
+        token: str,
+        account_book_id: int,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        note: Optional[str] = None,
+        after: Optional[PageKey] = None,
+        limit: int = 200,
+    ) -> Tuple[List[Transaction], Optional[PageKey]]:
+        return await self._run(
+            AccountBook.get_transaction_page,
+            token=token,
+            account_book_id=account_book_id,
+            start_time=start_time,
+            end_time=end_time,
+            note=note,
+            after=after,
+            limit=limit,
+        )
+
+
+def get_ledger_backend(name: str, run: Callable[..., Awaitable[Any]]) -> LedgerBackend:
+    """The backend called ``name``; ``run`` is the sqlite db executor."""
+    if name == "sqlite":
+        return SQLiteLedger(run)
+    if name == "postgres":
+        # asyncpg is only imported when postgres is configured
+        from config import (
+            POSTGRES_DSN,
+            POSTGRES_POOL_MAX,
+            POSTGRES_POOL_MIN,
+            POSTGRES_STATEMENT_CACHE,
+            POSTGRES_TIMEOUT,
+        )
+        from postgres_ledger import PostgresLedger
+
+        return PostgresLedger(
+            POSTGRES_DSN,
+            min_size=POSTGRES_POOL_MIN,
+            max_size=POSTGRES_POOL_MAX,
+            timeout=POSTGRES_TIMEOUT,
+            statement_cache_size=POSTGRES_STATEMENT_CACHE,
+        )
+    raise ValueError(f"unknown ledger backend '{name}', choose one of sqlite, postgres")
@@ -1,7 +1,10 @@
+import os
 import uvicorn
 import argparse
 import socket
 
+from storage_profile import PROFILES
+
 
 def get_local_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -27,7 +30,16 @@ if __name__ == "__main__":
     parser.add_argument(
         "--port", type=int, default=1919, help="Port to bind (default: 1919)"
     )
+    parser.add_argument(
+        "--storage-profile",
+        type=str,
+        choices=list(PROFILES),
+        default=os.environ.get("COINVERSE_STORAGE_PROFILE", "balanced"),
+        help="sqlite PRAGMA profile (default: balanced)",
+    )
     args = parser.parse_args()
+    # read by config.py, the env var also reaches the reloader's worker process
+    os.environ["COINVERSE_STORAGE_PROFILE"] = args.storage_profile
 
     from db_api import delete_all
 
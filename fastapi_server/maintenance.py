@@ -0,0 +1,111 @@
+"""
+Offline maintenance commands for the CoinVerse database.
+
+    python maintenance.py check-balances
+    python maintenance.py rebuild-balances [--book-id ID]
+    python maintenance.py check-rollups
+    python maintenance.py rebuild-rollups [--book-id ID]
+    python maintenance.py vacuum
+"""
+
+import argparse
+import logging
+import sys
+
+from db_api import MINOR_UNITS, AccountBook, init
+
+
+def check_balances(args: argparse.Namespace) -> int:
+    conn, _ = init()
+    drifted = AccountBook.check_balances(conn)
+    for book_id, stored, actual, stored_count, actual_count in drifted:
+        print(
+            f"book {book_id}: balance "
+            f"{None if stored is None else stored / MINOR_UNITS} != {actual / MINOR_UNITS} "
+            f"or count {stored_count} != {actual_count}"
+        )
+    print(f"{len(drifted)} book(s) out of sync")
+    conn.close()
+    return 1 if drifted else 0
+
+
+def rebuild_balances(args: argparse.Namespace) -> int:
+    conn, _ = init()
+    rebuilt = AccountBook.rebuild_balances(conn, account_book_id=args.book_id)
+    print(f"rebuilt the balance of {rebuilt} book(s)")
+    conn.close()
+    return 0
+
+
+def check_rollups(args: argparse.Namespace) -> int:
+    conn, _ = init()
+    drifted = AccountBook.check_rollups(conn)
+    for book_id, month, code, stored, actual, stored_count, actual_count in drifted:
+        print(
+            f"book {book_id} {month} category {code}: total {stored} != {actual} "
+            f"or count {stored_count} != {actual_count} (minor units)"
+        )
+    print(f"{len(drifted)} rollup row(s) out of sync")
+    conn.close()
+    return 1 if drifted else 0
+
+
+def rebuild_rollups(args: argparse.Namespace) -> int:
+    conn, _ = init()
+    rebuilt = AccountBook.rebuild_rollups(conn, account_book_id=args.book_id)
+    print(f"rebuilt {rebuilt} monthly rollup row(s)")
+    conn.close()
+    return 0
+
+
+def vacuum(args: argparse.Namespace) -> int:
+    # rewrites the whole file under an exclusive lock, run it with the server stopped
+    conn, _ = init()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    before = conn.execute("PRAGMA page_count").fetchone()[0]
+    conn.execute("VACUUM")
+    after = conn.execute("PRAGMA page_count").fetchone()[0]
+    print(f"vacuumed {before} -> {after} page(s), auto_vacuum = incremental")
+    conn.close()
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="CoinVerse db maintenance.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser(
+        "check-balances", help="compare book_balances with the transactions"
+    )
+    cmd.set_defaults(func=check_balances)
+
+    cmd = commands.add_parser(
+        "rebuild-balances", help="recompute book_balances from the transactions"
+    )
+    cmd.add_argument("--book-id", type=int, default=None, help="only this book")
+    cmd.set_defaults(func=rebuild_balances)
+
+    cmd = commands.add_parser(
+        "check-rollups", help="compare book_monthly_rollups with the transactions"
+    )
+    cmd.set_defaults(func=check_rollups)
+
+    cmd = commands.add_parser(
+        "rebuild-rollups", help="recompute book_monthly_rollups from the transactions"
+    )
+    cmd.add_argument("--book-id", type=int, default=None, help="only this book")
+    cmd.set_defaults(func=rebuild_rollups)
+
+    cmd = commands.add_parser(
+        "vacuum",
+        help="rewrite the db file and switch it to incremental auto_vacuum",
+    )
+    cmd.set_defaults(func=vacuum)
+
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
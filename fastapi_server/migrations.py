@@ -0,0 +1,782 @@
+import sqlite3
+import time
+import logging
+from typing import Callable, List, NamedTuple, Optional
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[sqlite3.Connection], None]
+    # False: apply() manages its own (short) transactions and must be resumable,
+    # the version row is recorded once it returns
+    transactional: bool = True
+
+
+# ------------------------- migrations ------------------------- #
+# append only: never edit or reorder a migration once it has been shipped
+
+
+def _m001_base_schema(conn: sqlite3.Connection) -> None:
+    # the tables created by db_api.init() before migrations existed, IF NOT EXISTS
+    # lets databases created by that code adopt the versioning untouched
+
+    # transactions table (uses single 'category' field instead of income_type/outcome_type)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS transactions (
+        id              INTEGER PRIMARY KEY AUTOINCREMENT,
+        account_book_id INTEGER NOT NULL,
+        amount          REAL    NOT NULL,
+        time            TEXT    NOT NULL,
+        note            TEXT,
+        category        TEXT,
+        FOREIGN KEY (account_book_id)
+            REFERENCES account_books(account_book_id)
+            ON DELETE CASCADE
+    )
+    """)
+
+    # account_books table (no ON DELETE CASCADE on account_id foreign key)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS account_books (
+        account_book_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name            TEXT NOT NULL,
+        account_id      INTEGER NOT NULL,
+        FOREIGN KEY (account_id)
+            REFERENCES accounts(account_id)
+    )
+    """)
+
+    # accounts table
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS accounts (
+        account_id    INTEGER PRIMARY KEY AUTOINCREMENT,
+        name          TEXT    NOT NULL UNIQUE,
+        email         TEXT    NOT NULL UNIQUE,
+        pwd           TEXT    NOT NULL,
+        token         TEXT    NOT NULL,
+        token_expire  INTEGER
+    );""")
+
+    # linking table for accounts and account_books (for future multi-user support)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS account_with_account_books (
+        account_id      INTEGER NOT NULL,
+        account_book_id INTEGER NOT NULL,
+        PRIMARY KEY (account_id, account_book_id),
+        FOREIGN KEY (account_id)
+            REFERENCES accounts(account_id) ON DELETE CASCADE,
+        FOREIGN KEY (account_book_id)
+            REFERENCES account_books(account_book_id) ON DELETE CASCADE
+    )
+    """)
+
+
+def _m002_lookup_indexes(conn: sqlite3.Connection) -> None:
+    # every authenticated call resolves the token
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_accounts_token ON accounts (token)")
+    # _load_books, the duplicated name check of create_book and the ownership check;
+    # account_book_id is the rowid so (account_id, account_book_id) is covered too
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_account_books_account_name "
+        "ON account_books (account_id, name)"
+    )
+    # get_transaction_list: equality on the book, range + ORDER BY on time
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_transactions_book_time "
+        "ON transactions (account_book_id, time)"
+    )
+    conn.execute("ANALYZE")
+
+
+def _m003_book_balances(conn: sqlite3.Connection) -> None:
+    # running balance per book, kept in the same transaction as every write by triggers
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS book_balances (
+        account_book_id INTEGER PRIMARY KEY,
+        balance         REAL    NOT NULL DEFAULT 0,
+        tx_count        INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (account_book_id)
+            REFERENCES account_books(account_book_id)
+            ON DELETE CASCADE
+    )
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_book_balances_book_insert
+    AFTER INSERT ON account_books
+    BEGIN
+        INSERT OR IGNORE INTO book_balances (account_book_id)
+        VALUES (NEW.account_book_id);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_book_balances_tx_insert
+    AFTER INSERT ON transactions
+    BEGIN
+        UPDATE book_balances
+        SET balance = balance + NEW.amount, tx_count = tx_count + 1
+        WHERE account_book_id = NEW.account_book_id;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_book_balances_tx_delete
+    AFTER DELETE ON transactions
+    BEGIN
+        UPDATE book_balances
+        SET balance = balance - OLD.amount, tx_count = tx_count - 1
+        WHERE account_book_id = OLD.account_book_id;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_book_balances_tx_update
+    AFTER UPDATE OF amount, account_book_id ON transactions
+    BEGIN
+        UPDATE book_balances
+        SET balance = balance - OLD.amount, tx_count = tx_count - 1
+        WHERE account_book_id = OLD.account_book_id;
+        UPDATE book_balances
+        SET balance = balance + NEW.amount, tx_count = tx_count + 1
+        WHERE account_book_id = NEW.account_book_id;
+    END
+    """)
+    # backfill the books that already exist
+    conn.execute("""
+    INSERT OR REPLACE INTO book_balances (account_book_id, balance, tx_count)
+    SELECT ab.account_book_id, COALESCE(SUM(t.amount), 0), COUNT(t.id)
+    FROM account_books AS ab
+    LEFT JOIN transactions AS t ON t.account_book_id = ab.account_book_id
+    GROUP BY ab.account_book_id
+    """)
+
+
+# frozen copies of the category codes of db_api at the time of migration 4:
+# IncomeType value for income, minus the OutcomeType value for outcome
+_V4_INCOME_CODES = {"SALARY": 1, "BONUS": 2, "INVEST": 3, "OTHER": 4}
+_V4_OUTCOME_CODES = {"FOOD": 1, "RENT": 2, "TRANSPORT": 3, "ENTERTAIN": 4, "OTHER": 5}
+_V4_MINOR_UNITS = 100
+_V4_BATCH_ROWS = 10000
+
+
+def _v4_converted(src: str) -> str:
+    # select list turning an old format row (alias ``src``) into a new format row
+    income = " ".join(f"WHEN '{n}' THEN {c}" for n, c in _V4_INCOME_CODES.items())
+    outcome = " ".join(f"WHEN '{n}' THEN {-c}" for n, c in _V4_OUTCOME_CODES.items())
+    return f"""
+        {src}.id,
+        {src}.account_book_id,
+        CAST(ROUND({src}.amount * {_V4_MINOR_UNITS}) AS INTEGER),
+        CAST(strftime('%s', {src}.time) AS INTEGER),
+        {src}.note,
+        CASE WHEN {src}.amount >= 0
+             THEN CASE {src}.category {income} END
+             ELSE CASE {src}.category {outcome} END
+        END
+    """
+
+
+def _v4_swapped(conn: sqlite3.Connection) -> bool:
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(transactions)")}
+    return "time_epoch" in columns
+
+
+def _v4_copy(conn: sqlite3.Connection, after_id: int, upto_id: Optional[int]) -> None:
+    sql = f"""
+    INSERT OR IGNORE INTO transactions_v4
+        (id, account_book_id, amount_minor, time_epoch, note, category_code)
+    SELECT {_v4_converted("t")}
+    FROM transactions AS t
+    WHERE t.id > ?
+    """
+    params: List = [after_id]
+    if upto_id is not None:
+        sql += " AND t.id <= ?"
+        params.append(upto_id)
+    conn.execute(sql, params)
+
+
+def _v4_swap(conn: sqlite3.Connection) -> None:
+    # caller holds the write lock and has copied every remaining row
+    for trigger in (
+        "trg_v4_mirror_insert",
+        "trg_v4_mirror_delete",
+        "trg_v4_mirror_update",
+        "trg_book_balances_tx_insert",
+        "trg_book_balances_tx_delete",
+        "trg_book_balances_tx_update",
+    ):
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    # keep ids of rows deleted at the end of the old table from being reused
+    seq = conn.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'transactions'"
+    ).fetchone()
+    conn.execute("DROP TABLE transactions")
+    conn.execute("ALTER TABLE transactions_v4 RENAME TO transactions")
+    if seq is not None:
+        cur = conn.execute(
+            "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'transactions'",
+            seq,
+        )
+        if cur.rowcount == 0:
+            conn.execute(
+                "INSERT INTO sqlite_sequence (name, seq) VALUES ('transactions', ?)",
+                seq,
+            )
+    conn.execute(
+        "CREATE INDEX idx_transactions_book_time "
+        "ON transactions (account_book_id, time_epoch)"
+    )
+
+    # balances move to minor units as well, rebuilt from the new table
+    conn.execute("DROP TABLE book_balances")
+    conn.execute("""
+    CREATE TABLE book_balances (
+        account_book_id INTEGER PRIMARY KEY,
+        balance_minor   INTEGER NOT NULL DEFAULT 0,
+        tx_count        INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (account_book_id)
+            REFERENCES account_books(account_book_id)
+            ON DELETE CASCADE
+    )
+    """)
+    conn.execute("""
+    CREATE TRIGGER trg_book_balances_tx_insert
+    AFTER INSERT ON transactions
+    BEGIN
+        UPDATE book_balances
+        SET balance_minor = balance_minor + NEW.amount_minor, tx_count = tx_count + 1
+        WHERE account_book_id = NEW.account_book_id;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER trg_book_balances_tx_delete
+    AFTER DELETE ON transactions
+    BEGIN
+        UPDATE book_balances
+        SET balance_minor = balance_minor - OLD.amount_minor, tx_count = tx_count - 1
+        WHERE account_book_id = OLD.account_book_id;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER trg_book_balances_tx_update
+    AFTER UPDATE OF amount_minor, account_book_id ON transactions
+    BEGIN
+        UPDATE book_balances
+        SET balance_minor = balance_minor - OLD.amount_minor, tx_count = tx_count - 1
+        WHERE account_book_id = OLD.account_book_id;
+        UPDATE book_balances
+        SET balance_minor = balance_minor + NEW.amount_minor, tx_count = tx_count + 1
+        WHERE account_book_id = NEW.account_book_id;
+    END
+    """)
+    conn.execute("""
+    INSERT INTO book_balances (account_book_id, balance_minor, tx_count)
+    SELECT ab.account_book_id, COALESCE(SUM(t.amount_minor), 0), COUNT(t.id)
+    FROM account_books AS ab
+    LEFT JOIN transactions AS t ON t.account_book_id = ab.account_book_id
+    GROUP BY ab.account_book_id
+    """)
+
+
+def _m004_integer_storage(conn: sqlite3.Connection) -> None:
+    """
+    transactions.time TEXT -> time_epoch INTEGER (wall clock seconds, offsets
+    converted to UTC), category name -> category_code INTEGER, amount REAL ->
+    amount_minor INTEGER (cents).
+
+    Online: the old table keeps serving while its rows are copied into
+    transactions_v4 in batches of _V4_BATCH_ROWS, each batch a short write
+    transaction. Triggers on the old table mirror concurrent writes into the new
+    one, so only the final batch and the table swap hold the write lock. A run
+    interrupted half way resumes, the copy is INSERT OR IGNORE.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if _v4_swapped(conn):
+            # swapped by a run that stopped before recording the version
+            conn.rollback()
+            return
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS transactions_v4 (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            account_book_id INTEGER NOT NULL,
+            amount_minor    INTEGER NOT NULL,
+            time_epoch      INTEGER NOT NULL,
+            note            TEXT,
+            category_code   INTEGER,
+            FOREIGN KEY (account_book_id)
+                REFERENCES account_books(account_book_id)
+                ON DELETE CASCADE
+        )
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_v4_mirror_insert
+        AFTER INSERT ON transactions
+        BEGIN
+            INSERT OR REPLACE INTO transactions_v4
+                (id, account_book_id, amount_minor, time_epoch, note, category_code)
+            SELECT {_v4_converted("NEW")};
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_v4_mirror_update
+        AFTER UPDATE ON transactions
+        BEGIN
+            DELETE FROM transactions_v4 WHERE id = OLD.id;
+            INSERT OR REPLACE INTO transactions_v4
+                (id, account_book_id, amount_minor, time_epoch, note, category_code)
+            SELECT {_v4_converted("NEW")};
+        END
+        """)
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_v4_mirror_delete
+        AFTER DELETE ON transactions
+        BEGIN
+            DELETE FROM transactions_v4 WHERE id = OLD.id;
+        END
+        """)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    after_id = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if _v4_swapped(conn):
+                # another worker finished the copy meanwhile
+                conn.rollback()
+                return
+            upper = conn.execute(
+                "SELECT id FROM transactions WHERE id > ? ORDER BY id LIMIT 1 OFFSET ?",
+                (after_id, _V4_BATCH_ROWS - 1),
+            ).fetchone()
+            if upper is None:
+                # less than a batch left: copy it and swap under the same lock
+                _v4_copy(conn, after_id, None)
+                _v4_swap(conn)
+                conn.commit()
+                return
+            _v4_copy(conn, after_id, upper[0])
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        after_id = upper[0]
+        logging.info(f"Migration 4: copied transactions up to id {after_id}")
+
+
+def _m005_monthly_rollups(conn: sqlite3.Connection) -> None:
+    # book x month x category -> sum / count, kept by triggers in the same
+    # transaction as every write; month is the first day, YYYY-MM-01, and an
+    # uncategorized row counts under category_code 0 (no enum has value 0)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS book_monthly_rollups (
+        account_book_id INTEGER NOT NULL,
+        month           TEXT    NOT NULL,
+        category_code   INTEGER NOT NULL,
+        total_minor     INTEGER NOT NULL DEFAULT 0,
+        tx_count        INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (account_book_id, month, category_code),
+        FOREIGN KEY (account_book_id)
+            REFERENCES account_books(account_book_id)
+            ON DELETE CASCADE
+    ) WITHOUT ROWID
+    """)
+    add = """
+        INSERT INTO book_monthly_rollups
+            (account_book_id, month, category_code, total_minor, tx_count)
+        VALUES (
+            NEW.account_book_id,
+            date(NEW.time_epoch, 'unixepoch', 'start of month'),
+            COALESCE(NEW.category_code, 0),
+            NEW.amount_minor,
+            1
+        )
+        ON CONFLICT (account_book_id, month, category_code) DO UPDATE
+        SET total_minor = total_minor + excluded.total_minor,
+            tx_count = tx_count + 1;
+    """
+    remove = """
+        UPDATE book_monthly_rollups
+        SET total_minor = total_minor - OLD.amount_minor, tx_count = tx_count - 1
+        WHERE account_book_id = OLD.account_book_id
+          AND month = date(OLD.time_epoch, 'unixepoch', 'start of month')
+          AND category_code = COALESCE(OLD.category_code, 0);
+        DELETE FROM book_monthly_rollups
+        WHERE account_book_id = OLD.account_book_id
+          AND month = date(OLD.time_epoch, 'unixepoch', 'start of month')
+          AND category_code = COALESCE(OLD.category_code, 0)
+          AND tx_count = 0;
+    """
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_monthly_rollups_tx_insert
+    AFTER INSERT ON transactions
+    BEGIN {add} END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_monthly_rollups_tx_delete
+    AFTER DELETE ON transactions
+    BEGIN {remove} END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_monthly_rollups_tx_update
+    AFTER UPDATE OF account_book_id, amount_minor, time_epoch, category_code
+    ON transactions
+    BEGIN {remove} {add} END
+    """)
+    # backfill
+    conn.execute("DELETE FROM book_monthly_rollups")
+    conn.execute("""
+    INSERT INTO book_monthly_rollups
+        (account_book_id, month, category_code, total_minor, tx_count)
+    SELECT account_book_id,
+           date(time_epoch, 'unixepoch', 'start of month'),
+           COALESCE(category_code, 0),
+           SUM(amount_minor),
+           COUNT(*)
+    FROM transactions
+    GROUP BY 1, 2, 3
+    """)
+
+
+def _m006_note_search(conn: sqlite3.Connection) -> None:
+    # FTS5 index of transactions.note, external content: the text lives only in
+    # transactions, the index keeps the tokens, kept in sync by triggers
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5(
+        note,
+        content = 'transactions',
+        content_rowid = 'id',
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_transactions_fts_insert
+    AFTER INSERT ON transactions
+    BEGIN
+        INSERT INTO transactions_fts (rowid, note) VALUES (NEW.id, NEW.note);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_transactions_fts_delete
+    AFTER DELETE ON transactions
+    BEGIN
+        INSERT INTO transactions_fts (transactions_fts, rowid, note)
+        VALUES ('delete', OLD.id, OLD.note);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_transactions_fts_update
+    AFTER UPDATE OF id, note ON transactions
+    BEGIN
+        INSERT INTO transactions_fts (transactions_fts, rowid, note)
+        VALUES ('delete', OLD.id, OLD.note);
+        INSERT INTO transactions_fts (rowid, note) VALUES (NEW.id, NEW.note);
+    END
+    """)
+    # index the existing notes
+    conn.execute("INSERT INTO transactions_fts (transactions_fts) VALUES ('rebuild')")
+
+
+def _m007_revoked_tokens(conn: sqlite3.Connection) -> None:
+    # logged out signed tokens, until they expire; the AUTOINCREMENT id is the
+    # watermark workers read new rows from, so it must never be reused
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS revoked_tokens (
+        id          INTEGER PRIMARY KEY AUTOINCREMENT,
+        jti         TEXT    NOT NULL UNIQUE,
+        expires_at  INTEGER NOT NULL
+    )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires "
+        "ON revoked_tokens (expires_at)"
+    )
+
+
+def _m008_sessions(conn: sqlite3.Connection) -> None:
+    # one row per logged in device instead of the single accounts.token, so a
+    # login no longer signs the account out everywhere else; keyed by the token
+    # itself, every authenticated call is one primary key lookup
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sessions (
+        token       TEXT    PRIMARY KEY,
+        account_id  INTEGER NOT NULL
+            REFERENCES accounts(account_id) ON DELETE CASCADE,
+        created_at  INTEGER NOT NULL,
+        expires_at  INTEGER NOT NULL,
+        last_seen   INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sessions_account ON sessions (account_id)"
+    )
+    # the periodic purge deletes by expiry
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)"
+    )
+    # keep the devices logged in today; a NULL token_expire is the unused random
+    # token set by register, nobody ever received it
+    now = int(time.time())
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO sessions
+            (token, account_id, created_at, expires_at, last_seen)
+        SELECT token, account_id, ?, token_expire, ?
+        FROM accounts
+        WHERE token_expire IS NOT NULL AND token_expire >= ?
+        """,
+        (now, now, now),
+    )
+
+
+def _m009_change_log(conn: sqlite3.Connection) -> None:
+    # every insert / update / delete of a book or a transaction, per account, in
+    # commit order: the seq a client has synced up to is its position in here
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS change_log (
+        seq         INTEGER PRIMARY KEY AUTOINCREMENT,
+        account_id  INTEGER NOT NULL,
+        entity      TEXT    NOT NULL,   -- 'book' or 'transaction'
+        entity_id   INTEGER NOT NULL,
+        deleted     INTEGER NOT NULL,   -- 0 inserted / updated, 1 deleted
+        changed_at  INTEGER NOT NULL
+    )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_change_log_account_seq "
+        "ON change_log (account_id, seq)"
+    )
+    # seq 1 stands for everything written before the log existed: the first
+    # logged change is 2, so a client at seq 0 is always told to reset
+    conn.execute("""
+    INSERT INTO sqlite_sequence (name, seq)
+    SELECT 'change_log', 1
+    WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'change_log')
+    """)
+    now = "CAST(strftime('%s', 'now') AS INTEGER)"
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_change_log_book_insert
+    AFTER INSERT ON account_books
+    BEGIN
+        INSERT INTO change_log (account_id, entity, entity_id, deleted, changed_at)
+        VALUES (NEW.account_id, 'book', NEW.account_book_id, 0, {now});
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_change_log_book_update
+    AFTER UPDATE OF name ON account_books
+    BEGIN
+        INSERT INTO change_log (account_id, entity, entity_id, deleted, changed_at)
+        VALUES (NEW.account_id, 'book', NEW.account_book_id, 0, {now});
+    END
+    """)
+    # the transactions of a removed book are not logged one by one: by the time
+    # the cascade deletes them the book row is gone and the SELECT finds no
+    # account, the book deletion stands for them
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_change_log_book_delete
+    AFTER DELETE ON account_books
+    BEGIN
+        INSERT INTO change_log (account_id, entity, entity_id, deleted, changed_at)
+        VALUES (OLD.account_id, 'book', OLD.account_book_id, 1, {now});
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_change_log_tx_insert
+    AFTER INSERT ON transactions
+    BEGIN
+        INSERT INTO change_log (account_id, entity, entity_id, deleted, changed_at)
+        SELECT account_id, 'transaction', NEW.id, 0, {now}
+        FROM account_books WHERE account_book_id = NEW.account_book_id;
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_change_log_tx_update
+    AFTER UPDATE ON transactions
+    BEGIN
+        INSERT INTO change_log (account_id, entity, entity_id, deleted, changed_at)
+        SELECT account_id, 'transaction', OLD.id, 1, {now}
+        FROM account_books
+        WHERE account_book_id = OLD.account_book_id
+          AND (OLD.id != NEW.id OR account_id != (
+              SELECT account_id FROM account_books
+              WHERE account_book_id = NEW.account_book_id));
+        INSERT INTO change_log (account_id, entity, entity_id, deleted, changed_at)
+        SELECT account_id, 'transaction', NEW.id, 0, {now}
+        FROM account_books WHERE account_book_id = NEW.account_book_id;
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_change_log_tx_delete
+    AFTER DELETE ON transactions
+    BEGIN
+        INSERT INTO change_log (account_id, entity, entity_id, deleted, changed_at)
+        SELECT account_id, 'transaction', OLD.id, 1, {now}
+        FROM account_books WHERE account_book_id = OLD.account_book_id;
+    END
+    """)
+
+
+def _m010_idempotency_keys(conn: sqlite3.Connection) -> None:
+    # result of a write made with a client supplied key, a retry with the same
+    # key is answered from here; scope keeps the keys of two clients apart
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        scope        TEXT    NOT NULL,
+        key          TEXT    NOT NULL,
+        fingerprint  TEXT    NOT NULL,   -- hash of the request the key was used for
+        response     TEXT    NOT NULL,   -- JSON
+        created_at   INTEGER NOT NULL,
+        PRIMARY KEY (scope, key)
+    ) WITHOUT ROWID
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created "
+        "ON idempotency_keys (created_at)"
+    )
+
+
+def _m011_note_search_by_book(conn: sqlite3.Connection) -> None:
+    # transactions_fts gets the book of every row as a second indexed column,
+    # a search matches "account_book_id : <id> AND note : (...)", so FTS5
+    # intersects the postings of the book with those of the terms instead of
+    # matching the notes of every account and filtering afterwards
+    for trigger in ("insert", "delete", "update"):
+        conn.execute(f"DROP TRIGGER IF EXISTS trg_transactions_fts_{trigger}")
+    conn.execute("DROP TABLE IF EXISTS transactions_fts")
+    conn.execute("""
+    CREATE VIRTUAL TABLE transactions_fts USING fts5(
+        note,
+        account_book_id,
+        content = 'transactions',
+        content_rowid = 'id',
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+    """)
+    conn.execute("""
+    CREATE TRIGGER trg_transactions_fts_insert
+    AFTER INSERT ON transactions
+    BEGIN
+        INSERT INTO transactions_fts (rowid, note, account_book_id)
+        VALUES (NEW.id, NEW.note, NEW.account_book_id);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER trg_transactions_fts_delete
+    AFTER DELETE ON transactions
+    BEGIN
+        INSERT INTO transactions_fts (transactions_fts, rowid, note, account_book_id)
+        VALUES ('delete', OLD.id, OLD.note, OLD.account_book_id);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER trg_transactions_fts_update
+    AFTER UPDATE OF id, note, account_book_id ON transactions
+    BEGIN
+        INSERT INTO transactions_fts (transactions_fts, rowid, note, account_book_id)
+        VALUES ('delete', OLD.id, OLD.note, OLD.account_book_id);
+        INSERT INTO transactions_fts (rowid, note, account_book_id)
+        VALUES (NEW.id, NEW.note, NEW.account_book_id);
+    END
+    """)
+    conn.execute("INSERT INTO transactions_fts (transactions_fts) VALUES ('rebuild')")
+
+
+def _m012_bulk_note_indexing(conn: sqlite3.Connection) -> None:
+    # the per row insert trigger costs a bulk load more than the load itself
+    # (100k rows: ~2.4s of triggers against ~0.35s for one INSERT ... SELECT of
+    # the same rows), so a bulk writer puts a row into fts_bulk_load inside its
+    # transaction, the trigger skips its rows and the writer indexes them in one
+    # statement before committing (AccountBook.import_transactions). The marker
+    # is never committed, other connections always see the table empty.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS fts_bulk_load (
+        active  INTEGER PRIMARY KEY
+    )
+    """)
+    conn.execute("DROP TRIGGER IF EXISTS trg_transactions_fts_insert")
+    conn.execute("""
+    CREATE TRIGGER trg_transactions_fts_insert
+    AFTER INSERT ON transactions
+    WHEN NOT EXISTS (SELECT 1 FROM fts_bulk_load)
+    BEGIN
+        INSERT INTO transactions_fts (rowid, note, account_book_id)
+        VALUES (NEW.id, NEW.note, NEW.account_book_id);
+    END
+    """)
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "base schema", _m001_base_schema),
+    Migration(2, "token / book / transaction time indexes", _m002_lookup_indexes),
+    Migration(3, "trigger maintained book balances", _m003_book_balances),
+    Migration(
+        4,
+        "integer time / category code / minor unit amount",
+        _m004_integer_storage,
+        transactional=False,
+    ),
+    Migration(5, "trigger maintained monthly rollups", _m005_monthly_rollups),
+    Migration(6, "FTS5 index of transaction notes", _m006_note_search),
+    Migration(7, "revocation list of signed tokens", _m007_revoked_tokens),
+    Migration(8, "multi-device sessions", _m008_sessions),
+    Migration(9, "change log of books and transactions", _m009_change_log),
+    Migration(10, "idempotency keys of writes", _m010_idempotency_keys),
+    Migration(11, "FTS5 index of notes by book", _m011_note_search_by_book),
+    Migration(
+        12, "bulk loads index their notes in one statement", _m012_bulk_note_indexing
+    ),
+]
+
+
+# ------------------------- runner ------------------------- #
+def current_version(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn: sqlite3.Connection, migrations: List[Migration] = MIGRATIONS) -> int:
+    """
+    Apply every migration newer than the version recorded in schema_version,
+    in order, each one in its own transaction together with its version row.
+    Safe to call on every startup and from several worker processes at once:
+    the write lock is taken before the version is re-checked. Non transactional
+    migrations run first and get their version row in a transaction of its own.
+
+    Returns:
+        int: the schema version after migrating.
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version     INTEGER PRIMARY KEY,
+        name        TEXT    NOT NULL,
+        applied_at  INTEGER NOT NULL
+    )
+    """)
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if migration.version <= current_version(conn):
+            continue
+        if not migration.transactional:
+            migration.apply(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # another worker may have applied it while we waited for the lock
+            if migration.version <= current_version(conn):
+                conn.rollback()
+                continue
+            if migration.transactional:
+                migration.apply(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                (migration.version, migration.name, int(time.time())),
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        logging.info(f"Applied schema migration {migration.version}: {migration.name}")
+    return current_version(conn)
@@ -0,0 +1,172 @@
+"""
+Several write operations of one account, e.g. the queue of an offline phone,
+applied by one request in one db transaction.
+
+Every operation runs in a SAVEPOINT of its own: a rejected one is rolled back
+and reported, the others are still applied, and the whole batch costs a single
+commit. An operation carrying an idempotency key is applied once, a replayed
+batch gets the stored result of the keys it already used.
+"""
+
+import sqlite3
+from datetime import datetime
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Union
+
+import idempotency
+from db_api import (
+    Account,
+    AccountBook,
+    IncomeType,
+    OutcomeType,
+    Transaction,
+    ownership_cache,
+)
+from cus_exceptions import (
+    AccessDenialAccountBookError,
+    DuplicatedAccountBookError,
+    IdempotencyKeyConflictError,
+    IncomeTypeIndexError,
+    IncomeValueError,
+    InvalidOutcomeIncomeValueError,
+    OutcomeTypeIndexError,
+    OutcomeValueError,
+    RequireInfoLostException,
+    TimeFormatError,
+)
+from utils import str_to_datetime
+
+# errors of a single operation, reported back instead of failing the batch
+OP_ERRORS = (
+    AccessDenialAccountBookError,
+    DuplicatedAccountBookError,
+    IdempotencyKeyConflictError,
+    IncomeTypeIndexError,
+    IncomeValueError,
+    InvalidOutcomeIncomeValueError,
+    OutcomeTypeIndexError,
+    OutcomeValueError,
+    RequireInfoLostException,
+    TimeFormatError,
+    sqlite3.IntegrityError,
+)
+
+
+class Op(NamedTuple):
+    kind: str  # add_income / add_outcome / create_book / remove_book
+    params: Dict[str, Any]  # the fields of the matching single operation route
+    key: Optional[str] = None  # idempotency key
+
+
+class OpResult(NamedTuple):
+    index: int  # position in the batch
+    key: Optional[str]
+    result: Dict[str, Any]  # e.g. {"transaction_id": 12}, empty on error
+    error: Optional[Exception] = None
+    replayed: bool = False  # answered from the idempotency store
+
+
+def _parse_time(raw: str) -> datetime:
+    # like the add_income / add_outcome routes: empty means now
+    return str_to_datetime(raw) if len(raw) > 1 else datetime.now()
+
+
+def _add_transaction(
+    conn: sqlite3.Connection,
+    token: str,
+    params: Dict[str, Any],
+    category: Union[IncomeType, OutcomeType],
+) -> Dict[str, Any]:
+    AccountBook.check_access(conn, token, params["account_book_id"])
+    tx = Transaction(
+        amount=params["amount"],
+        account_book_id=params["account_book_id"],
+        category=category,
+        time=_parse_time(params.get("time", "")),
+        note=params.get("note", ""),
+    )
+    return {"transaction_id": Transaction.execute_db_add(conn, tx, commit=False)}
+
+
+def _add_income(
+    conn: sqlite3.Connection, token: str, params: Dict[str, Any]
+) -> Dict[str, Any]:
+    category = IncomeType.index_2_income_type(params["income_idx"])
+    return _add_transaction(conn, token, params, category)
+
+
+def _add_outcome(
+    conn: sqlite3.Connection, token: str, params: Dict[str, Any]
+) -> Dict[str, Any]:
+    category = OutcomeType.index_2_outcome_type(params["outcome_idx"])
+    return _add_transaction(conn, token, params, category)
+
+
+def _create_book(
+    conn: sqlite3.Connection, token: str, params: Dict[str, Any]
+) -> Dict[str, Any]:
+    book = Account.create_book(conn, token, params["book_name"], commit=False)
+    return {"book_id": book._id}
+
+
+def _remove_book(
+    conn: sqlite3.Connection, token: str, params: Dict[str, Any]
+) -> Dict[str, Any]:
+    Account.remove_account_book(conn, token, params["book_id"], commit=False)
+    return {}
+
+
+# op kind -> fn(conn, token, params) -> result, nothing committed
+APPLY: Dict[
+    str, Callable[[sqlite3.Connection, str, Dict[str, Any]], Dict[str, Any]]
+] = {
+    "add_income": _add_income,
+    "add_outcome": _add_outcome,
+    "create_book": _create_book,
+    "remove_book": _remove_book,
+}
+
+
+def execute_ops(conn: sqlite3.Connection, token: str, ops: List[Op]) -> List[OpResult]:
+    """
+    Apply ``ops`` in order in one transaction and return one OpResult per op.
+
+    The token is checked once up front, an invalid one fails the whole batch;
+    the later checks of the operations are answered by session_cache. The
+    write lock is taken for the whole batch, so it should stay small
+    (OPS_BATCH_MAX_OPS).
+    """
+    account_id = Account.authenticate(conn, token)
+    scope = f"account:{account_id}"
+    results: List[OpResult] = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for index, op in enumerate(ops):
+            request_fingerprint = idempotency.fingerprint(op.kind, op.params)
+            conn.execute("SAVEPOINT op")
+            try:
+                stored = (
+                    idempotency.lookup(conn, scope, op.key, request_fingerprint)
+                    if op.key
+                    else None
+                )
+                if stored is not None:
+                    results.append(OpResult(index, op.key, stored, replayed=True))
+                else:
+                    result = APPLY[op.kind](conn, token, op.params)
+                    if op.key:
+                        idempotency.store(
+                            conn, scope, op.key, request_fingerprint, result
+                        )
+                    results.append(OpResult(index, op.key, result))
+                conn.execute("RELEASE op")
+            except OP_ERRORS as e:
+                conn.execute("ROLLBACK TO op")
+                conn.execute("RELEASE op")
+                results.append(OpResult(index, op.key, {}, error=e))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        # books created by the batch may have been cached by an ownership check
+        ownership_cache.invalidate_account(account_id)
+        raise
+    return results
@@ -0,0 +1,158 @@
+"""
+Password storage: scrypt hashes computed in a bounded process pool.
+
+The client sends a hash of the password (``pwd_hash``), the server stores a
+salted scrypt of it:
+
+    scrypt$<n>$<r>$<p>$<salt b64>$<key b64>
+
+Rows written before this module hold the client hash itself. They still
+verify (constant time) and are replaced by a scrypt hash at the next login,
+like hashes made with older scrypt parameters.
+"""
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from config import (
+    PASSWORD_HASH_MAX_PENDING,
+    PASSWORD_HASH_TIMEOUT,
+    PASSWORD_HASH_WORKERS,
+    SCRYPT_N,
+    SCRYPT_P,
+    SCRYPT_R,
+)
+from cus_exceptions import PasswordHasherBusyError
+
+SCHEME = "scrypt"
+_SALT_BYTES = 16
+_KEY_BYTES = 32
+_MAXMEM = 256 * 1024 * 1024
+
+
+def _b64(raw: bytes) -> str:
+    return base64.b64encode(raw).decode()
+
+
+def hash_password(
+    secret: str, n: int = SCRYPT_N, r: int = SCRYPT_R, p: int = SCRYPT_P
+) -> str:
+    """Salted scrypt of ``secret`` in the stored format. CPU heavy, see PasswordHasher."""
+    salt = secrets.token_bytes(_SALT_BYTES)
+    key = hashlib.scrypt(
+        secret.encode(), salt=salt, n=n, r=r, p=p, maxmem=_MAXMEM, dklen=_KEY_BYTES
+    )
+    return f"{SCHEME}${n}${r}${p}${_b64(salt)}${_b64(key)}"
+
+
+def is_legacy(stored: str) -> bool:
+    """True for a client hash stored as is, before scrypt hashes."""
+    return not stored.startswith(SCHEME + "$")
+
+
+def needs_rehash(stored: str) -> bool:
+    if is_legacy(stored):
+        return True
+    _, n, r, p, _, _ = stored.split("$")
+    return (int(n), int(r), int(p)) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+def verify_password(secret: str, stored: str) -> bool:
+    """Check ``secret`` against a stored hash, in constant time for its length."""
+    if is_legacy(stored):
+        return hmac.compare_digest(secret.encode(), stored.encode())
+    try:
+        _, n, r, p, salt, key = stored.split("$")
+        expected = base64.b64decode(key)
+        actual = hashlib.scrypt(
+            secret.encode(),
+            salt=base64.b64decode(salt),
+            n=int(n),
+            r=int(r),
+            p=int(p),
+            maxmem=_MAXMEM,
+            dklen=len(expected),
+        )
+    except ValueError:
+        return False
+    return hmac.compare_digest(actual, expected)
+
+
+def verify_and_upgrade(secret: str, stored: str) -> Tuple[bool, Optional[str]]:
+    """
+    verify_password, plus the hash that should replace ``stored`` when it is a
+    legacy or outdated one and the secret matched, in one pool round trip.
+    """
+    if not verify_password(secret, stored):
+        return False, None
+    return True, hash_password(secret) if needs_rehash(stored) else None
+
+
+# verified instead of a missing account, so an unknown name costs the same time
+DUMMY_HASH = (
+    f"{SCHEME}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$"
+    f"{_b64(secrets.token_bytes(_SALT_BYTES))}${_b64(secrets.token_bytes(_KEY_BYTES))}"
+)
+
+
+class PasswordHasher:
+    """
+    Runs the KDF in a process pool so a login storm neither blocks the event
+    loop nor starves the db worker threads.
+
+    At most ``max_workers`` hashes run at once and at most ``max_pending`` are
+    queued or running; a call waiting longer than ``timeout`` for a slot raises
+    PasswordHasherBusyError instead of growing the queue. The pool is started
+    on first use, with the spawn start method (the server process has threads).
+    """
+
+    def __init__(
+        self,
+        max_workers: int = PASSWORD_HASH_WORKERS,
+        max_pending: int = PASSWORD_HASH_MAX_PENDING,
+        timeout: float = PASSWORD_HASH_TIMEOUT,
+    ) -> None:
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(max_pending)
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    async def _run(self, fn, *args):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise PasswordHasherBusyError(
+                "Too many logins in progress, try again later."
+            ) from None
+        try:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self._slots.release()
+
+    async def hash(self, secret: str) -> str:
+        return await self._run(hash_password, secret)
+
+    async def verify(self, secret: str, stored: str) -> bool:
+        return await self._run(verify_password, secret, stored)
+
+    async def verify_and_upgrade(
+        self, secret: str, stored: str
+    ) -> Tuple[bool, Optional[str]]:
+        return await self._run(verify_and_upgrade, secret, stored)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
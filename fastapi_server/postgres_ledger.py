@@ -0,0 +1,644 @@
+"""
+PostgreSQL ledger backend: the accounts, sessions, books and transactions of
+every account in one PostgreSQL database, shared by any number of server nodes.
+
+Each worker process keeps an asyncpg pool; asyncpg prepares every statement
+once per connection and reuses it from its statement cache, so the queries
+below are parsed and planned once, not per request. The tables mirror the
+sqlite schema (integer minor units, epoch seconds, category codes), the
+balance and count of a book are kept on its account_books row by the insert
+itself. asyncpg is an optional dependency, only this backend needs it:
+
+    pip install asyncpg
+
+A token issued by one node is accepted by every other: opaque tokens are
+sessions rows, signed ones are verified with the shared COINVERSE_TOKEN_KEYS
+against the revoked_tokens table. Like in sqlite, each process caches live
+sessions (SESSION_CACHE_TTL), batches the last_seen writes and reads new
+revocations every TOKEN_REVOCATION_REFRESH seconds; a background task of the
+backend does the flush and the purges the sqlite Sweeper does for db_api.
+
+Only the LedgerBackend operations are implemented here, the routes beyond
+them stay sqlite only (see ledger_backend). check_postgres_ledger.py runs
+every operation and query variant against a real server.
+"""
+
+import asyncio
+import logging
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator, List, Optional, Tuple
+
+try:
+    import asyncpg
+except ImportError:  # pragma: no cover - depends on the install
+    asyncpg = None
+
+from caches import LastSeenBuffer, SessionCache
+from config import (
+    SESSION_CACHE_SIZE,
+    SESSION_CACHE_TTL,
+    SESSION_LAST_SEEN_FLUSH,
+    SESSION_LAST_SEEN_MAX,
+    SESSION_PURGE_INTERVAL,
+    TOKEN_REVOCATION_REFRESH,
+)
+from cus_exceptions import (
+    AccessDenialAccountBookError,
+    DBPoolExhaustedError,
+    DuplicatedAccountBookError,
+    EmailFormatError,
+    LedgerBackendUnavailableError,
+    RequireInfoLostException,
+    TokenExpireException,
+    TokenNotFoundError,
+)
+from db_api import (
+    MINOR_UNITS,
+    BookStats,
+    Transaction,
+    TransactionRow,
+    datetime_to_epoch,
+    epoch_to_datetime,
+    issue_token,
+    token_signer,
+)
+from ledger_backend import LedgerBackend, PageKey, Profile
+from tokens import RevocationList, TokenClaims, is_signed
+from utils import verify_email_format
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    account_id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    name       TEXT NOT NULL UNIQUE,
+    email      TEXT NOT NULL UNIQUE,
+    pwd        TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    token      TEXT   PRIMARY KEY,
+    account_id BIGINT NOT NULL REFERENCES accounts (account_id) ON DELETE CASCADE,
+    created_at BIGINT NOT NULL,
+    expires_at BIGINT NOT NULL,
+    last_seen  BIGINT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_account ON sessions (account_id);
+CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at);
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+    id         BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    jti        TEXT   NOT NULL UNIQUE,
+    expires_at BIGINT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires ON revoked_tokens (expires_at);
+CREATE TABLE IF NOT EXISTS account_books (
+    account_book_id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    account_id      BIGINT NOT NULL
+        REFERENCES accounts (account_id) ON DELETE CASCADE,
+    name            TEXT   NOT NULL,
+    balance_minor   BIGINT NOT NULL DEFAULT 0,
+    tx_count        BIGINT NOT NULL DEFAULT 0,
+    UNIQUE (account_id, name)
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id              BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    account_book_id BIGINT NOT NULL
+        REFERENCES account_books (account_book_id) ON DELETE CASCADE,
+    amount_minor    BIGINT NOT NULL,
+    time_epoch      BIGINT NOT NULL,
+    note            TEXT   NOT NULL DEFAULT '',
+    category_code   INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_book_time
+    ON transactions (account_book_id, time_epoch, id);
+"""
+# serializes the CREATE ... IF NOT EXISTS of workers starting together
+_SCHEMA_LOCK_KEY = 0x436F696E
+# serializes revocations: their ids commit in order, so a reader that has seen
+# id n never misses a smaller one committed later
+_REVOKE_LOCK_KEY = 0x436F696F
+
+_SESSION_SQL = "SELECT account_id, expires_at FROM sessions WHERE token = $1"
+
+_START_SESSION_SQL = """
+    INSERT INTO sessions (token, account_id, created_at, expires_at, last_seen)
+    VALUES ($1, $2, $3, $4, $3)
+"""
+
+_ROW_COLUMNS = "id, amount_minor, time_epoch, note, category_code"
+
+_CHECK_ACCESS_SQL = """
+    SELECT 1 FROM account_books WHERE account_book_id = $1 AND account_id = $2
+"""
+
+_CREATE_BOOK_SQL = """
+    INSERT INTO account_books (account_id, name) VALUES ($1, $2)
+    ON CONFLICT (account_id, name) DO NOTHING
+    RETURNING account_book_id
+"""
+
+_REMOVE_BOOK_SQL = """
+    DELETE FROM account_books WHERE account_book_id = $1 AND account_id = $2
+    RETURNING account_book_id
+"""
+
+_LIST_BOOKS_SQL = """
+    SELECT ab.account_book_id,
+           ab.name,
+           ab.balance_minor,
+           ab.tx_count,
+           (SELECT MAX(t.time_epoch)
+            FROM transactions AS t
+            WHERE t.account_book_id = ab.account_book_id)
+    FROM account_books AS ab
+    WHERE ab.account_id = $1
+    ORDER BY ab.account_book_id
+"""
+
+# ownership check, balance update and insert in one statement: no row of a
+# book the account does not own is ever written
+_ADD_TRANSACTION_SQL = """
+    WITH book AS (
+        UPDATE account_books
+        SET balance_minor = balance_minor + $2, tx_count = tx_count + 1
+        WHERE account_book_id = $1 AND account_id = $6
+        RETURNING account_book_id
+    )
+    INSERT INTO transactions (
+        account_book_id,
+        amount_minor,
+        time_epoch,
+        note,
+        category_code
+    )
+    SELECT account_book_id, $2, $3, $4, $5 FROM book
+    RETURNING id
+"""
+
+
+def _rows_query(
+    has_start: bool, has_note: bool, has_after: bool, has_limit: bool
+) -> str:
+    """
+    Text of a transactions range query. Every filter combination is its own
+    statement (12 are used: 4 unpaged, 8 paged, each prepared once) rather than
+    one with ``$n IS NULL OR ...`` conditions, which a generic plan can not index.
+    """
+    sql = (
+        f"SELECT {_ROW_COLUMNS} FROM transactions"
+        " WHERE account_book_id = $1 AND time_epoch <= $2"
+    )
+    n = 2
+    if has_start:
+        n += 1
+        sql += f" AND time_epoch >= ${n}"
+    if has_after:
+        sql += f" AND (time_epoch, id) > (${n + 1}, ${n + 2})"
+        n += 2
+    if has_note:
+        n += 1
+        # ILIKE: the sqlite LIKE of db_api is case insensitive too
+        sql += f" AND note ILIKE ${n}"
+    sql += " ORDER BY time_epoch ASC, id ASC"
+    if has_limit:
+        sql += f" LIMIT ${n + 1}"
+    return sql
+
+
+class PostgresLedger(LedgerBackend):
+    """
+    LedgerBackend on a PostgreSQL database.
+
+    ``revocation_refresh``, ``last_seen_flush`` and ``purge_interval`` are the
+    seconds between two reads of new revocations, two last_seen writes and two
+    purges of expired sessions and revocations.
+    """
+
+    name = "postgres"
+
+    def __init__(
+        self,
+        dsn: str,
+        min_size: int = 2,
+        max_size: int = 10,
+        timeout: float = 5.0,
+        statement_cache_size: int = 256,
+        revocation_refresh: float = TOKEN_REVOCATION_REFRESH,
+        last_seen_flush: float = SESSION_LAST_SEEN_FLUSH,
+        purge_interval: float = SESSION_PURGE_INTERVAL,
+    ) -> None:
+        if asyncpg is None:
+            raise LedgerBackendUnavailableError(
+                "The postgres ledger backend needs asyncpg: pip install asyncpg"
+            )
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.statement_cache_size = statement_cache_size
+        self.last_seen_flush = last_seen_flush
+        self.purge_interval = purge_interval
+        self._pool: Optional["asyncpg.Pool"] = None
+        self._housekeeping: Optional["asyncio.Task[None]"] = None
+        # the same per process state db_api keeps for the sqlite sessions
+        self._sessions = SessionCache(
+            max_entries=SESSION_CACHE_SIZE, max_ttl=SESSION_CACHE_TTL
+        )
+        self._last_seen = LastSeenBuffer(max_entries=SESSION_LAST_SEEN_MAX)
+        self._revocations = RevocationList(refresh_interval=revocation_refresh)
+
+    async def start(self) -> None:
+        self._pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            command_timeout=self.timeout,
+            statement_cache_size=self.statement_cache_size,
+        )
+        async with self._connection() as conn:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", _SCHEMA_LOCK_KEY)
+                await conn.execute(SCHEMA)
+        self._housekeeping = asyncio.create_task(self._run_housekeeping())
+
+    async def close(self) -> None:
+        if self._housekeeping is not None:
+            self._housekeeping.cancel()
+            try:
+                await self._housekeeping
+            except asyncio.CancelledError:
+                pass
+            self._housekeeping = None
+        if self._pool is not None:
+            # keep the last uses of this process
+            await self.flush_last_seen()
+            await self._pool.close()
+            self._pool = None
+
+    @asynccontextmanager
+    async def _connection(self) -> AsyncIterator["asyncpg.Connection"]:
+        if self._pool is None:
+            raise LedgerBackendUnavailableError("The postgres ledger is not started.")
+        try:
+            conn = await self._pool.acquire(timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise DBPoolExhaustedError(
+                f"No free postgres connection within {self.timeout:.1f}s "
+                f"(pool size {self.max_size})."
+            ) from None
+        try:
+            yield conn
+        finally:
+            await self._pool.release(conn)
+
+    # ------------------------- housekeeping ------------------------- #
+    async def _run_housekeeping(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_purge = loop.time() + self.purge_interval
+        while True:
+            await asyncio.sleep(self.last_seen_flush)
+            try:
+                await self.flush_last_seen()
+                if loop.time() >= next_purge:
+                    next_purge = loop.time() + self.purge_interval
+                    await self.purge_expired()
+            except Exception as e:
+                logging.warning(
+                    f"Postgres session housekeeping failed: {type(e).__name__}: {e}"
+                )
+
+    async def flush_last_seen(self) -> int:
+        """Write the buffered uses to sessions.last_seen, see Account.flush_last_seen."""
+        pending = self._last_seen.take()
+        if not pending:
+            return 0
+        async with self._connection() as conn:
+            await conn.executemany(
+                "UPDATE sessions SET last_seen = GREATEST(last_seen, $1)"
+                " WHERE token = $2",
+                pending,
+            )
+        return len(pending)
+
+    async def purge_expired(self, now: Optional[int] = None) -> Tuple[int, int]:
+        """Delete the sessions and revocations expired before ``now``."""
+        now = int(time.time()) if now is None else now
+        async with self._connection() as conn:
+            sessions = await conn.execute(
+                "DELETE FROM sessions WHERE expires_at < $1", now
+            )
+            revoked = await conn.execute(
+                "DELETE FROM revoked_tokens WHERE expires_at < $1", now
+            )
+        # "DELETE <count>"
+        return int(sessions.split()[-1]), int(revoked.split()[-1])
+
+    # ------------------------- tokens ------------------------- #
+    async def _is_revoked(self, jti: str) -> bool:
+        if self._revocations.due():
+            async with self._connection() as conn:
+                rows = await conn.fetch(
+                    "SELECT id, jti, expires_at FROM revoked_tokens"
+                    " WHERE id > $1 ORDER BY id",
+                    self._revocations.last_id,
+                )
+            self._revocations.load(rows)
+        return self._revocations.contains(jti)
+
+    async def _revoke(self, conn: Any, claims: TokenClaims) -> None:
+        """Revoke a signed token, inside the caller's transaction."""
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", _REVOKE_LOCK_KEY)
+        await conn.execute(
+            "INSERT INTO revoked_tokens (jti, expires_at) VALUES ($1, $2)"
+            " ON CONFLICT (jti) DO NOTHING",
+            claims.jti,
+            claims.expires_at,
+        )
+
+    async def _verify_signed(
+        self, token: str, check_expiry: bool = True, check_revoked: bool = True
+    ) -> TokenClaims:
+        """See db_api._verify_signed."""
+        if token_signer is None:
+            raise TokenNotFoundError("Token not found.")
+        claims = token_signer.verify(token, check_expiry)
+        if check_revoked and await self._is_revoked(claims.jti):
+            raise TokenExpireException("Token expired.")
+        return claims
+
+    @staticmethod
+    async def _start_session(conn: Any, account_id: int) -> str:
+        """See db_api._start_session."""
+        token, expire = issue_token(account_id)
+        if not is_signed(token):
+            await conn.execute(
+                _START_SESSION_SQL, token, account_id, int(time.time()), expire
+            )
+        return token
+
+    def _end_session(self, token: str) -> None:
+        self._sessions.invalidate(token)
+        self._last_seen.discard(token)
+
+    # ------------------------- accounts and sessions ------------------------- #
+    async def register(self, name: str, email: str, pwd_hash: str) -> None:
+        if not verify_email_format(email):
+            raise EmailFormatError("Invalid email format")
+        try:
+            async with self._connection() as conn:
+                acc_id = await conn.fetchval(
+                    "INSERT INTO accounts (name, email, pwd) VALUES ($1, $2, $3)"
+                    " RETURNING account_id",
+                    name,
+                    email,
+                    pwd_hash,
+                )
+        except asyncpg.UniqueViolationError as e:
+            # the error of the sqlite UNIQUE constraint: the route answers 1002 alike
+            raise sqlite3.IntegrityError(str(e)) from e
+        logging.info(f"Account created with ID: {acc_id}, Name: {name}, Email: {email}")
+
+    async def get_credentials(self, name_or_email: str) -> Optional[Tuple[int, str]]:
+        async with self._connection() as conn:
+            row = await conn.fetchrow(
+                "SELECT account_id, pwd FROM accounts WHERE name = $1 OR email = $1",
+                name_or_email,
+            )
+        return None if row is None else (row[0], row[1])
+
+    async def complete_login(
+        self, account_id: int, old_hash: str, rehashed: Optional[str] = None
+    ) -> str:
+        async with self._connection() as conn:
+            async with conn.transaction():
+                token = await self._start_session(conn, account_id)
+                if rehashed is not None:
+                    await conn.execute(
+                        "UPDATE accounts SET pwd = $1"
+                        " WHERE account_id = $2 AND pwd = $3",
+                        rehashed,
+                        account_id,
+                        old_hash,
+                    )
+        return token
+
+    async def refresh_token(self, old_token: str) -> Optional[str]:
+        if is_signed(old_token):
+            # the old token is revoked, other tokens of the account stay valid
+            claims = await self._verify_signed(old_token)
+            async with self._connection() as conn:
+                async with conn.transaction():
+                    exists = await conn.fetchval(
+                        "SELECT 1 FROM accounts WHERE account_id = $1",
+                        claims.account_id,
+                    )
+                    if exists is None:
+                        raise TokenNotFoundError("Token not found")
+                    token = await self._start_session(conn, claims.account_id)
+                    await self._revoke(conn, claims)
+            self._revocations.add(claims.jti, claims.expires_at)
+            return token
+        async with self._connection() as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow(_SESSION_SQL + " FOR UPDATE", old_token)
+                if row is None:
+                    return None
+                account_id, expires_at = row
+                if int(time.time()) > expires_at:
+                    raise TokenExpireException("Token expired")
+                token = await self._start_session(conn, account_id)
+                await conn.execute("DELETE FROM sessions WHERE token = $1", old_token)
+        self._end_session(old_token)
+        return token
+
+    async def logout(self, token: str) -> bool:
+        if is_signed(token):
+            # logging out twice succeeds, like for an opaque token
+            claims = await self._verify_signed(
+                token, check_expiry=False, check_revoked=False
+            )
+            if time.time() <= claims.expires_at and not await self._is_revoked(
+                claims.jti
+            ):
+                async with self._connection() as conn:
+                    async with conn.transaction():
+                        await self._revoke(conn, claims)
+                self._revocations.add(claims.jti, claims.expires_at)
+            return True
+        now = int(time.time())
+        async with self._connection() as conn:
+            expires_at = await conn.fetchval(
+                "SELECT expires_at FROM sessions WHERE token = $1", token
+            )
+            if expires_at is None:
+                raise TokenNotFoundError("Token not found")
+            if now > expires_at:
+                return True
+            # only this session; the purge deletes the row later
+            await conn.execute(
+                "UPDATE sessions SET expires_at = $1 WHERE token = $2", now - 1, token
+            )
+        self._end_session(token)
+        return True
+
+    async def authenticate(self, token: str) -> int:
+        """See db_api._resolve_token."""
+        if is_signed(token):
+            return (await self._verify_signed(token)).account_id
+        account_id = self._sessions.get(token)
+        if account_id is None:
+            # taken before the read, so a logout racing with it is not undone
+            generation = self._sessions.generation()
+            async with self._connection() as conn:
+                row = await conn.fetchrow(_SESSION_SQL, token)
+            if row is None:
+                raise TokenNotFoundError("Token not found.")
+            account_id, expires_at = row
+            if int(time.time()) > expires_at:
+                raise TokenExpireException("Token expired.")
+            self._sessions.put(token, account_id, expires_at, generation)
+        self._last_seen.touch(token)
+        return account_id
+
+    async def get_profile(self, token: str) -> Profile:
+        account_id = await self.authenticate(token)
+        async with self._connection() as conn:
+            row = await conn.fetchrow(
+                "SELECT name, email FROM accounts WHERE account_id = $1", account_id
+            )
+        if row is None:
+            raise TokenNotFoundError("Token not found")
+        return Profile(row[0], row[1])
+
+    async def set_password(self, account_id: int, new_hash: str) -> None:
+        async with self._connection() as conn:
+            await conn.execute(
+                "UPDATE accounts SET pwd = $1 WHERE account_id = $2",
+                new_hash,
+                account_id,
+            )
+        self._sessions.invalidate_account(account_id)
+
+    @staticmethod
+    async def _check_access(conn: Any, account_id: int, account_book_id: int) -> None:
+        if await conn.fetchval(_CHECK_ACCESS_SQL, account_book_id, account_id) is None:
+            raise AccessDenialAccountBookError(
+                "Account book not found or does not belong to this account."
+            )
+
+    # ------------------------- books ------------------------- #
+    async def create_book(self, token: str, book_name: str) -> int:
+        if book_name is None or book_name.strip() == "":
+            raise RequireInfoLostException("Book name is required.")
+        account_id = await self.authenticate(token)
+        async with self._connection() as conn:
+            book_id = await conn.fetchval(_CREATE_BOOK_SQL, account_id, book_name)
+        if book_id is None:
+            raise DuplicatedAccountBookError(
+                "Account book name already exists for this account."
+            )
+        return book_id
+
+    async def list_books(self, token: str) -> List[BookStats]:
+        account_id = await self.authenticate(token)
+        async with self._connection() as conn:
+            rows = await conn.fetch(_LIST_BOOKS_SQL, account_id)
+        return [
+            BookStats(
+                book_id,
+                name,
+                balance_minor / MINOR_UNITS,
+                tx_count,
+                None if last is None else epoch_to_datetime(last).isoformat(),
+            )
+            for book_id, name, balance_minor, tx_count, last in rows
+        ]
+
+    async def remove_book(self, token: str, book_id: int) -> None:
+        account_id = await self.authenticate(token)
+        async with self._connection() as conn:
+            removed = await conn.fetchval(_REMOVE_BOOK_SQL, book_id, account_id)
+        if removed is None:
+            raise AccessDenialAccountBookError(
+                "Account book not found or does not belong to this account."
+            )
+
+    # ------------------------- transactions ------------------------- #
+    async def add_transaction(self, token: str, tx: Transaction) -> int:
+        account_id = await self.authenticate(token)
+        async with self._connection() as conn:
+            tx_id = await conn.fetchval(
+                _ADD_TRANSACTION_SQL, *tx._to_db_row(), account_id
+            )
+        if tx_id is None:
+            raise AccessDenialAccountBookError(
+                "Account book not found or does not belong to this account."
+            )
+        tx.id = tx_id
+        return tx_id
+
+    async def _fetch_rows(
+        self,
+        token: str,
+        account_book_id: int,
+        start_time: Optional[datetime],
+        end_time: Optional[datetime],
+        note: Optional[str],
+        after: Optional[PageKey] = None,
+        limit: Optional[int] = None,
+    ) -> List["asyncpg.Record"]:
+        account_id = await self.authenticate(token)
+        if end_time is None:
+            end_time = datetime.now()
+        params: List[Any] = [account_book_id, datetime_to_epoch(end_time)]
+        if start_time is not None:
+            params.append(datetime_to_epoch(start_time))
+        if after is not None:
+            params.extend(after)
+        if note is not None:
+            params.append(f"%{note}%")
+        if limit is not None:
+            params.append(limit)
+        sql = _rows_query(
+            start_time is not None,
+            note is not None,
+            after is not None,
+            limit is not None,
+        )
+        async with self._connection() as conn:
+            await self._check_access(conn, account_id, account_book_id)
+            return await conn.fetch(sql, *params)
+
+    async def get_transaction_rows(
+        self,
+        token: str,
+        account_book_id: int,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        note: Optional[str] = None,
+    ) -> List[TransactionRow]:
+        rows = await self._fetch_rows(
+            token, account_book_id, start_time, end_time, note
+        )
+        return list(map(TransactionRow._make, rows))
+
+    async def get_transaction_page(
+        self,
+        token: str,
+        account_book_id: int,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        note: Optional[str] = None,
+        after: Optional[PageKey] = None,
+        limit: int = 200,
+    ) -> Tuple[List[Transaction], Optional[PageKey]]:
+        # one extra row tells whether another page exists
+        rows = await self._fetch_rows(
+            token, account_book_id, start_time, end_time, note, after, limit + 1
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_key = (rows[-1][2], rows[-1][0]) if has_more else None
+        return [
+            Transaction._from_db_row(tuple(row), account_book_id) for row in rows
+        ], next_key
@@ -0,0 +1,80 @@
+import sqlite3
+from dataclasses import dataclass
+from typing import Dict
+
+
+@dataclass(frozen=True)
+class StorageProfile:
+    """
+    A set of sqlite PRAGMAs applied to every connection opened by db_api.connect().
+
+    Attributes:
+        name: profile name, selected at startup with COINVERSE_STORAGE_PROFILE
+        journal_mode: DELETE (sqlite default, writers block readers) or WAL
+        synchronous: OFF / NORMAL / FULL, how often sqlite fsyncs
+        cache_size: page cache, negative values are KiB, positive values are pages
+        mmap_size: bytes of the db file memory mapped for reads, 0 disables it
+        temp_store: DEFAULT / FILE / MEMORY, where temp tables and indexes live
+        busy_timeout: ms a connection waits for a lock before "database is locked"
+    """
+
+    name: str
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    cache_size: int = -2000
+    mmap_size: int = 0
+    temp_store: str = "DEFAULT"
+    busy_timeout: int = 5000
+
+    def apply(self, conn: sqlite3.Connection) -> None:
+        # journal_mode answers with the mode really in use, e.g. memory dbs can't WAL
+        conn.execute(f"PRAGMA journal_mode = {self.journal_mode}").fetchone()
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        conn.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.execute(f"PRAGMA temp_store = {self.temp_store}")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+
+
+PROFILES: Dict[str, StorageProfile] = {
+    # what the server ran with before profiles existed
+    "legacy": StorageProfile(
+        name="legacy",
+        journal_mode="DELETE",
+        synchronous="FULL",
+    ),
+    # WAL, but still fsync on every commit
+    "durable": StorageProfile(
+        name="durable",
+        journal_mode="WAL",
+        synchronous="FULL",
+        cache_size=-16000,
+    ),
+    # WAL + NORMAL: a commit may roll back on power loss, the db never corrupts
+    "balanced": StorageProfile(
+        name="balanced",
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        cache_size=-64000,
+        mmap_size=256 * 1024 * 1024,
+        temp_store="MEMORY",
+    ),
+    # no fsync at all, only for benchmarks and throw-away test servers
+    "fast": StorageProfile(
+        name="fast",
+        journal_mode="WAL",
+        synchronous="OFF",
+        cache_size=-256000,
+        mmap_size=1024 * 1024 * 1024,
+        temp_store="MEMORY",
+    ),
+}
+
+
+def get_storage_profile(name: str) -> StorageProfile:
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError(
+            f"unknown storage profile '{name}', choose one of {', '.join(PROFILES)}"
+        ) from None
@@ -0,0 +1,177 @@
+"""
+Periodic maintenance run by the server itself, see fast_router.lifespan.
+
+Every job works in slices: one slice is one short db job handling at most
+``batch`` rows (or pages), followed by another slice as long as the previous
+one was full, up to ``max_slices`` per run. Requests queued on the db executor
+get their turn between two slices, and the time of every slice is exported by
+Sweeper.stats() for /metrics/maintenance.
+"""
+
+import asyncio
+import logging
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+
+class SweepJob(NamedTuple):
+    name: str
+    # fn(conn, limit) -> rows / pages handled by one slice, commits its own work
+    fn: Callable[[sqlite3.Connection, int], int]
+    interval: float  # seconds between two runs
+    batch: int = 0  # 0: a run is a single slice
+
+
+# ------------------------- slices ------------------------- #
+def purge_revoked_tokens(conn: sqlite3.Connection, limit: int) -> int:
+    """Delete revocations of signed tokens that expired anyway."""
+    cur = conn.execute(
+        """
+        DELETE FROM revoked_tokens WHERE id IN (
+            SELECT id FROM revoked_tokens WHERE expires_at < ? LIMIT ?
+        )
+        """,
+        (int(time.time()), limit),
+    )
+    conn.commit()
+    return cur.rowcount
+
+
+def purge_orphan_links(conn: sqlite3.Connection, limit: int) -> int:
+    """Delete account_with_account_books rows whose account or book is gone."""
+    cur = conn.execute(
+        """
+        DELETE FROM account_with_account_books WHERE rowid IN (
+            SELECT l.rowid
+            FROM account_with_account_books l
+            LEFT JOIN accounts a ON a.account_id = l.account_id
+            LEFT JOIN account_books b ON b.account_book_id = l.account_book_id
+            WHERE a.account_id IS NULL OR b.account_book_id IS NULL
+            LIMIT ?
+        )
+        """,
+        (limit,),
+    )
+    conn.commit()
+    return cur.rowcount
+
+
+def incremental_vacuum(conn: sqlite3.Connection, limit: int) -> int:
+    """
+    Give back at most ``limit`` free pages to the file system. Only databases
+    created with auto_vacuum = INCREMENTAL have any, older files are converted
+    offline by ``python maintenance.py vacuum``.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    conn.commit()
+    # execute() steps the pragma once, i.e. frees a single page; executescript
+    # runs it to completion
+    conn.executescript(f"PRAGMA incremental_vacuum({int(limit)})")
+    return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def make_optimize(analysis_limit: int) -> Callable[[sqlite3.Connection, int], int]:
+    """
+    A slice refreshing the planner statistics of the tables that changed
+    enough, each table reading at most ``analysis_limit`` rows per index.
+    """
+
+    def optimize(conn: sqlite3.Connection, limit: int) -> int:
+        conn.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+        # 0x10000: look at every table, not only those queried on this connection
+        conn.execute("PRAGMA optimize(0x10002)").fetchall()
+        conn.commit()
+        return 0
+
+    return optimize
+
+
+def _timed_slice(
+    conn: sqlite3.Connection, job: SweepJob, limit: int
+) -> Tuple[int, float]:
+    # timed on the db worker thread, the executor queue wait is not included
+    begin = time.perf_counter()
+    done = job.fn(conn, limit)
+    return done, time.perf_counter() - begin
+
+
+class Sweeper:
+    """
+    Runs each SweepJob every ``interval`` seconds through ``run`` (the db
+    executor), one job at a time. A failing slice is logged and counted, the
+    job is retried at its next run.
+    """
+
+    def __init__(
+        self,
+        run: Callable[..., Awaitable[Any]],
+        jobs: List[SweepJob],
+        max_slices: int = 50,
+    ) -> None:
+        self._run = run
+        self.jobs = jobs
+        self.max_slices = max_slices
+        self._stats: Dict[str, Dict[str, Any]] = {
+            job.name: {
+                "runs": 0,
+                "slices": 0,
+                "handled": 0,
+                "errors": 0,
+                "last_run_at": None,
+                "last_handled": 0,
+                "last_run_ms": 0.0,
+                "last_slice_ms": 0.0,
+                "max_slice_ms": 0.0,
+                "total_ms": 0.0,
+            }
+            for job in jobs
+        }
+
+    async def run_forever(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_run = {job.name: loop.time() for job in self.jobs}
+        while True:
+            for job in self.jobs:
+                if loop.time() >= next_run[job.name]:
+                    await self.run_job(job)
+                    next_run[job.name] = loop.time() + job.interval
+            await asyncio.sleep(max(0.0, min(next_run.values()) - loop.time()))
+
+    async def run_job(self, job: SweepJob) -> Optional[int]:
+        """One run of ``job``: slices until one is not full. None if it failed."""
+        stats = self._stats[job.name]
+        handled = 0
+        run_ms = 0.0
+        try:
+            for _ in range(max(1, self.max_slices)):
+                done, elapsed = await self._run(_timed_slice, job=job, limit=job.batch)
+                slice_ms = elapsed * 1000
+                handled += done
+                run_ms += slice_ms
+                stats["slices"] += 1
+                stats["last_slice_ms"] = round(slice_ms, 3)
+                stats["max_slice_ms"] = round(max(stats["max_slice_ms"], slice_ms), 3)
+                if job.batch <= 0 or done < job.batch:
+                    break
+        except Exception as e:
+            stats["errors"] += 1
+            logging.warning(
+                f"Maintenance job {job.name} failed: {type(e).__name__}: {e}"
+            )
+            return None
+        finally:
+            stats["runs"] += 1
+            stats["handled"] += handled
+            stats["last_run_at"] = int(time.time())
+            stats["last_handled"] = handled
+            stats["last_run_ms"] = round(run_ms, 3)
+            stats["total_ms"] = round(stats["total_ms"] + run_ms, 3)
+        if handled:
+            logging.debug(f"Maintenance job {job.name}: {handled} in {run_ms:.1f} ms")
+        return handled
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: dict(stats) for name, stats in self._stats.items()}
@@ -0,0 +1,194 @@
+"""
+HMAC signed access tokens, verified without a db lookup.
+
+    v1.<kid>.<payload>.<signature>
+
+payload is base64url JSON {"a": account_id, "e": expiry (epoch s), "j": token id},
+signature the base64url HMAC-SHA256 of "v1.<kid>.<payload>" with key <kid>.
+Logged out tokens are listed by token id in revoked_tokens until they expire,
+every worker keeps the list in memory and reads the new rows periodically.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, NamedTuple, Tuple
+
+from cus_exceptions import TokenExpireException, TokenNotFoundError
+
+VERSION = "v1"
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def is_signed(token: str) -> bool:
+    return token.startswith(VERSION + ".")
+
+
+class TokenClaims(NamedTuple):
+    account_id: int
+    expires_at: int  # epoch seconds
+    jti: str  # token id, the key of a revocation
+
+
+class TokenSigner:
+    """Issues and verifies signed tokens with a set of keys, see TOKEN_KEYS."""
+
+    def __init__(self, keys: Dict[str, bytes], active_kid: str) -> None:
+        if active_kid not in keys:
+            raise ValueError(f"unknown signing key '{active_kid}'")
+        self._keys = keys
+        self.active_kid = active_kid
+
+    @classmethod
+    def from_config(cls, spec: str) -> "TokenSigner":
+        """
+        Keys from "kid:secret,kid:secret", the first one is active. Without
+        keys a random one is generated: its tokens die with the process and are
+        only valid in it, fine for development only.
+        """
+        keys: Dict[str, bytes] = {}
+        active = None
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            kid, sep, secret = item.partition(":")
+            if not sep or not kid or not secret or "." in kid:
+                raise ValueError(f"token key '{kid}' must look like 'kid:secret'")
+            keys[kid] = secret.encode()
+            active = active or kid
+        if active is None:
+            logging.warning(
+                "COINVERSE_TOKEN_KEYS is empty, signing tokens with a random key"
+            )
+            active = "dev"
+            keys[active] = secrets.token_bytes(32)
+        return cls(keys, active)
+
+    def _sign(self, kid: str, signed_part: str) -> str:
+        digest = hmac.new(self._keys[kid], signed_part.encode(), hashlib.sha256)
+        return _b64encode(digest.digest())
+
+    def issue(self, account_id: int, ttl: int) -> Tuple[str, int]:
+        """Return (token, expiry epoch seconds)."""
+        expires_at = int(time.time()) + ttl
+        payload = _b64encode(
+            json.dumps(
+                {"a": account_id, "e": expires_at, "j": secrets.token_urlsafe(12)},
+                separators=(",", ":"),
+            ).encode()
+        )
+        signed_part = f"{VERSION}.{self.active_kid}.{payload}"
+        return f"{signed_part}.{self._sign(self.active_kid, signed_part)}", expires_at
+
+    def verify(self, token: str, check_expiry: bool = True) -> TokenClaims:
+        """
+        Check the signature (and expiry) of a token.
+        Raises TokenNotFoundError if it is malformed or forged, or signed with
+        a key that was retired, TokenExpireException if it expired.
+        """
+        try:
+            version, kid, payload, signature = token.split(".")
+            if version != VERSION or kid not in self._keys:
+                raise ValueError("unknown token version or key")
+            expected = self._sign(kid, f"{version}.{kid}.{payload}")
+            if not hmac.compare_digest(signature.encode(), expected.encode()):
+                raise ValueError("bad signature")
+            data = json.loads(_b64decode(payload))
+            claims = TokenClaims(int(data["a"]), int(data["e"]), str(data["j"]))
+        except (ValueError, KeyError, TypeError):
+            raise TokenNotFoundError("Token not found.") from None
+        if check_expiry and time.time() > claims.expires_at:
+            raise TokenExpireException("Token expired.")
+        return claims
+
+
+class RevocationList:
+    """
+    In-memory copy of revoked_tokens: token id -> expiry.
+
+    Revocations made here are visible at once, those of other worker
+    processes after at most ``refresh_interval`` seconds: is_revoked() reads
+    the rows added since the last read when the interval has elapsed.
+
+    is_revoked / revoke / refresh work on the sqlite table, another store
+    (postgres_ledger) keeps the list with due / contains / add / load.
+    """
+
+    def __init__(self, refresh_interval: float = 5.0) -> None:
+        self.refresh_interval = refresh_interval
+        self._revoked: Dict[str, int] = {}
+        self._last_id = 0
+        self._next_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def is_revoked(self, conn: sqlite3.Connection, jti: str) -> bool:
+        if self.due():
+            self.refresh(conn)
+        return self.contains(jti)
+
+    def revoke(self, conn: sqlite3.Connection, jti: str, expires_at: int) -> None:
+        conn.execute(
+            "INSERT OR IGNORE INTO revoked_tokens (jti, expires_at) VALUES (?, ?)",
+            (jti, expires_at),
+        )
+        conn.commit()
+        self.add(jti, expires_at)
+
+    def refresh(self, conn: sqlite3.Connection) -> None:
+        """Load the revocations added since the last refresh, drop expired ones."""
+        rows = conn.execute(
+            "SELECT id, jti, expires_at FROM revoked_tokens WHERE id > ? ORDER BY id",
+            (self.last_id,),
+        ).fetchall()
+        self.load(rows)
+
+    @property
+    def last_id(self) -> int:
+        """Highest revoked_tokens id loaded so far."""
+        with self._lock:
+            return self._last_id
+
+    def due(self) -> bool:
+        """Whether the next check should read the new revocations first."""
+        return time.monotonic() >= self._next_refresh
+
+    def contains(self, jti: str) -> bool:
+        with self._lock:
+            return jti in self._revoked
+
+    def add(self, jti: str, expires_at: int) -> None:
+        """A revocation stored by this process."""
+        with self._lock:
+            self._revoked[jti] = expires_at
+
+    def load(self, rows: Iterable[Tuple[int, str, int]]) -> None:
+        """Merge (id, jti, expires_at) rows read from the store, drop expired ones."""
+        now = int(time.time())
+        with self._lock:
+            for row_id, jti, expires_at in rows:
+                self._revoked[jti] = expires_at
+                self._last_id = max(self._last_id, row_id)
+            for jti in [j for j, exp in self._revoked.items() if exp < now]:
+                del self._revoked[jti]
+            self._next_refresh = time.monotonic() + self.refresh_interval
+
+    def clear(self) -> None:
+        with self._lock:
+            self._revoked.clear()
+            self._last_id = 0
+            self._next_refresh = 0.0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._revoked), "last_id": self._last_id}
@@ -1,7 +1,14 @@
 import re
+import json
+import base64
 from datetime import datetime
+from typing import Tuple
 
-from cus_exceptions import TimeFormatError
+from cus_exceptions import (
+    InvalidCursorError,
+    RequireInfoLostException,
+    TimeFormatError,
+)
 
 
 def verify_email_format(email: str) -> bool:
@@ -32,5 +39,41 @@ def str_to_datetime(datetime_str: str) -> datetime:
         )
 
 
+def encode_cursor(key: Tuple[int, int]) -> str:
+    """Opaque url-safe cursor for the (time_epoch, id) key of the last row of a page."""
+    raw = json.dumps([key[0], key[1]], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        time_epoch, tx_id = json.loads(raw)
+        if not isinstance(time_epoch, int) or not isinstance(tx_id, int):
+            raise ValueError("unexpected cursor content")
+        return time_epoch, tx_id
+    except (ValueError, TypeError):
+        raise InvalidCursorError(f"cursor '{cursor}' is invalid") from None
+
+
+def build_fts_query(text: str, match_all: bool = True) -> str:
+    """
+    Turn a user search string into an FTS5 MATCH expression: every whitespace
+    separated term is quoted, so FTS5 operators typed by the user are plain
+    text, a trailing '*' keeps a term a prefix query, and the terms are joined
+    with AND (match_all) or OR.
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if not word:
+            continue
+        terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    if not terms:
+        raise RequireInfoLostException("search query is empty")
+    return (" AND " if match_all else " OR ").join(terms)
+
+
 if __name__ == "__main__":
     print(verify_email_format("s@gmail.comfads@gmail.com"))
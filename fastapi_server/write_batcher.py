@@ -0,0 +1,161 @@
+"""
+Group commit of single transaction inserts (add_income / add_outcome).
+
+Requests hand a validated Transaction to WriteBatcher.add() and wait. One writer
+task collects what is queued for up to ``max_delay`` seconds or ``max_rows``
+rows, inserts the lot in one db transaction and resolves every waiting request
+once that transaction is committed: a request still only returns after its row
+is as durable as the storage profile makes a commit, but a burst of N inserts
+costs one commit (one fsync) instead of N.
+"""
+
+import asyncio
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from db_api import AccountBook, Transaction
+from cus_exceptions import (
+    AccessDenialAccountBookError,
+    TokenExpireException,
+    TokenNotFoundError,
+)
+
+# errors of a single row, given to its request instead of failing the batch
+ROW_ERRORS = (
+    AccessDenialAccountBookError,
+    TokenExpireException,
+    TokenNotFoundError,
+    sqlite3.IntegrityError,
+)
+
+
+def write_batch(
+    conn: sqlite3.Connection, items: List[Tuple[str, Transaction]]
+) -> List[Union[int, Exception]]:
+    """
+    Check access and insert every (token, transaction) in one transaction.
+    Returns the new id, or the error, of each item in order.
+    """
+    results: List[Union[int, Exception]] = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for token, tx in items:
+            try:
+                AccountBook.check_access(conn, token, tx.account_book_id)
+                # a failing INSERT only undoes itself, the batch goes on
+                results.append(Transaction.execute_db_add(conn, tx, commit=False))
+            except ROW_ERRORS as e:
+                results.append(e)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return results
+
+
+class WriteBatcher:
+    """
+    Single writer in front of ``run`` (the db executor). start() / stop() are
+    called by the app lifespan; stop() writes what is still queued.
+    """
+
+    def __init__(
+        self,
+        run: Callable[..., Awaitable[Any]],
+        max_rows: int = 256,
+        max_delay: float = 0.005,
+    ) -> None:
+        self._run = run
+        self.max_rows = max(1, max_rows)
+        self.max_delay = max_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.rows = 0
+        self.largest_batch = 0
+        self.commit_ms = 0.0
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._write_forever())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def add(self, token: str, tx: Transaction) -> int:
+        """Queue ``tx`` and return its id once the batch holding it is committed."""
+        if self._task is None:
+            raise RuntimeError("WriteBatcher is not running")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((token, tx, future))
+        return await future
+
+    async def _write_forever(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            stopping = False
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_rows:
+                try:
+                    if self._queue.empty():
+                        timeout = deadline - loop.time()
+                        if timeout <= 0:
+                            break
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    else:
+                        item = self._queue.get_nowait()
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def _flush(
+        self, batch: List[Tuple[str, Transaction, asyncio.Future]]
+    ) -> None:
+        begin = time.perf_counter()
+        try:
+            results = await self._run(
+                write_batch, items=[(token, tx) for token, tx, _ in batch]
+            )
+        except Exception as e:
+            # the whole transaction failed (pool exhausted, disk full ...)
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.rows += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        self.commit_ms += (time.perf_counter() - begin) * 1000
+        for (_, _, future), result in zip(batch, results):
+            if future.done():  # the request was cancelled meanwhile
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self.batches,
+            "rows": self.rows,
+            "largest_batch": self.largest_batch,
+            "avg_batch_ms": round(self.commit_ms / self.batches, 3)
+            if self.batches
+            else 0.0,
+        }